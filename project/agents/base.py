@@ -9,16 +9,23 @@ import gym
 import tensorflow as tf
 
 from project.model import Model
+from project.util.tf.compilation import xla_function
+from project.util.tf.tracing import count_traces
 
 Observations = Union[tf.Tensor, Dict[str, tf.Tensor]]
 
 
 class Agent(abc.ABC):
-    def __init__(self, action_space: gym.Space) -> None:
+    """
+    An agent acting in `batch_size` environments at once. If batch_size is 1, observations and actions have no batch
+    dimension; otherwise the first dimension of both is the batch dimension.
+    """
+    def __init__(self, action_space: gym.Space, batch_size: int = 1) -> None:
         self.action_space = action_space
+        self.batch_size = batch_size
 
-    def reset(self) -> None:
-        """Reset agent's state"""
+    def reset(self, mask: Optional[tf.Tensor] = None) -> None:
+        """Reset agent's state, or only the states of the batch elements where mask is True"""
         pass
 
     @abc.abstractmethod
@@ -31,10 +38,15 @@ class Agent(abc.ABC):
         """Decide the next action"""
         raise NotImplementedError
 
+    @property
+    def plan_statistics(self) -> Dict[str, Union[tf.Tensor, tf.Variable]]:
+        """Scalar statistics about the last call to act(), e.g. the number of planner iterations used"""
+        return {}
+
 
 class BlindAgent(Agent):
-    def __init__(self, action_space: gym.Space) -> None:
-        super().__init__(action_space)
+    def __init__(self, action_space: gym.Space, batch_size: int = 1) -> None:
+        super().__init__(action_space, batch_size)
 
     def observe(self, observations: Observations, action: Optional[tf.Tensor]) -> None:
         """Ignore observations; child classes should not override this method"""
@@ -48,11 +60,12 @@ class BlindAgent(Agent):
 
 class ModelBasedAgent(Agent):
     """Base class for agents that use a model and need to keep its state up to date."""
-    def __init__(self, action_space: gym.Space, model: Model) -> None:
-        super().__init__(action_space)
+    def __init__(self, action_space: gym.Space, model: Model, batch_size: int = 1) -> None:
+        super().__init__(action_space, batch_size)
         self._predictor = model.rnn.predictor
         self._encoder = model.encoder
-        self._state = tuple(tf.Variable(x) for x in self._predictor.zero_state(1, tf.float32))
+        self._preprocess = model.preprocess
+        self._state = tuple(tf.Variable(x) for x in self._predictor.zero_state(batch_size, tf.float32))
 
     @property
     def state(self) -> Tuple[tf.Variable, ...]:
@@ -60,25 +73,44 @@ class ModelBasedAgent(Agent):
 
     @state.setter  # type: ignore[misc]  # mypy/issues/1362
     @tf.function
+    @count_traces
     def state(self, value: Tuple[tf.Tensor, ...]) -> None:
         tf.nest.assert_same_structure(value, self._state)
         assert all(a.shape == b.shape for a, b in zip(value, self._state))
         for s, v in zip(self._state, value):
-            s.assign(v)
+            s.assign(tf.cast(v, s.dtype))  # The model may compute in lower precision
 
-    @tf.function
-    def reset(self) -> None:
-        self.state = tuple(tf.zeros_like(s) for s in self.state)  # type: ignore[misc]  # mypy/issues/1362
+    def reset(self, mask: Optional[tf.Tensor] = None) -> None:
+        # Missing arguments are replaced by tensors here, so that the tf.functions below are only traced once
+        if mask is None:
+            mask = tf.ones([self.batch_size], tf.bool)
+        self._reset(mask)
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.bool)])
+    @count_traces
+    def _reset(self, mask: tf.Tensor) -> None:
+        new_state = tuple(tf.where(tf.reshape(mask, [-1] + [1] * (s.shape.ndims - 1)), tf.zeros_like(s), s)
+                          for s in self.state)
+        self.state = new_state  # type: ignore[misc]  # mypy/issues/1362
 
-    @tf.function
     def observe(self, observations: Observations, action: Optional[tf.Tensor]) -> None:
         """Update model state based on observations."""
         if action is None:
             action = tf.zeros_like(self.action_space.low)
-        observations = tf.nest.map_structure(lambda t: t[tf.newaxis, tf.newaxis, :], observations)
-        embedded = self._encoder(observations, training=False)[0]
-        action = action[tf.newaxis, :]
-        use_obs = tf.constant([[True]])
+            if self.batch_size > 1:
+                action = tf.tile(action[tf.newaxis, :], [self.batch_size, 1])
+        self._observe(observations, action)
+
+    @xla_function('observe')
+    def _observe(self, observations: Observations, action: tf.Tensor) -> None:
+        if self.batch_size == 1:
+            observations = tf.nest.map_structure(lambda t: t[tf.newaxis], observations)
+            action = action[tf.newaxis, :]
+        observations = tf.nest.map_structure(lambda t: t[:, tf.newaxis], observations)  # Add time dimension
+        if isinstance(observations, dict):
+            observations = self._preprocess(observations)
+        embedded = self._encoder(observations, training=False)[:, 0]
+        use_obs = tf.ones([self.batch_size, 1], tf.bool)
         state = tuple(v.value() for v in self._state)  # This is needed to prevent weird errors with dead weakrefs
         _, self.state = self._predictor((embedded, action, use_obs), state, training=False)  # type: ignore[misc]  # mypy/issues/1362
 
@@ -2,23 +2,28 @@
 #
 # (C) 2019, Daniel Mouritzen
 
-from typing import Optional, Type, Union
+from typing import Dict, Optional, Type, Union
 
 import gin
 import gym.spaces
 import tensorflow as tf
 
 from project.model import Model
-from project.planning import Planner
+from project.planning import CrossEntropyMethod, Planner
+from project.util.tf.compilation import xla_function
+from project.util.tf.tracing import count_traces
 
 from .base import ModelBasedAgent, Observations
 
 
-@gin.configurable(whitelist=['objective', 'planner', 'exploration_noise', 'visualize'])
+@gin.configurable(whitelist=['objective', 'planner', 'exploration_noise', 'visualize', 'warm_start'])
 class MPCAgent(ModelBasedAgent):
     """
     At each time step, uses a predictive model together with a planning algorithm to choose the best sequence of
     actions and executes the first one.
+
+    With `warm_start`, the plan from the previous time step is kept and used (shifted by one step) to initialize the
+    planner, which can then use fewer iterations and samples. This requires a CrossEntropyMethod planner.
     """
     def __init__(self,
                  action_space: gym.Space,
@@ -27,32 +32,63 @@ class MPCAgent(ModelBasedAgent):
                  planner: Type[Planner] = gin.REQUIRED,
                  exploration_noise: float = 0.0,
                  visualize: bool = False,
+                 warm_start: bool = False,
+                 batch_size: int = 1,
                  ) -> None:
         assert isinstance(action_space, gym.spaces.Box), f'Unsupported action space {action_space}'
-        super().__init__(action_space, model)
+        assert not (visualize and batch_size > 1), 'Visualization is only supported with batch size 1'
+        super().__init__(action_space, model, batch_size)
         self._objective_decoder = model.decoders[objective]
         self._planner = planner.from_model(model, self.action_space)
         self._exploration_noise = exploration_noise
-        self._goal = tf.Variable([0.0, 0.0])
+        self._goal = tf.Variable(tf.zeros([2] if batch_size == 1 else [batch_size, 2]))
         self._visualize = tf.Variable(visualize)
+        self._warm_start = warm_start
+        if warm_start:
+            assert isinstance(self._planner, CrossEntropyMethod), 'Warm starting is only supported with CrossEntropyMethod'
+            batch_shape = [] if batch_size == 1 else [batch_size]
+            plan_shape = batch_shape + [self._planner.horizon] + list(self.action_space.low.shape)
+            self._plan_mean = tf.Variable(tf.zeros(plan_shape))
+            self._plan_std_dev = tf.Variable(tf.zeros(plan_shape))
+            self._plan_valid = tf.Variable(tf.zeros(batch_shape, tf.bool))
 
     @property
     def visualize(self) -> tf.Variable:
         return self._visualize
 
     @visualize.setter  # type: ignore[misc]  # mypy/issues/1362
-    @tf.function
+    @tf.function(input_signature=[tf.TensorSpec([], tf.bool)])
+    @count_traces
     def visualize(self, value: Union[tf.Tensor, bool]) -> None:
         self._visualize.assign(value)
 
-    @tf.function
-    def observe(self, observations: Observations, action: Optional[tf.Tensor]) -> None:
-        super().observe(observations, action)
+    @property
+    def plan_statistics(self) -> Dict[str, Union[tf.Tensor, tf.Variable]]:
+        return self._planner.statistics
+
+    @tf.function(input_signature=[tf.TensorSpec([None], tf.bool)])
+    @count_traces
+    def _reset(self, mask: tf.Tensor) -> None:
+        super()._reset(mask)
+        if self._warm_start:
+            self._plan_valid.assign(tf.logical_and(self._plan_valid,
+                                                   tf.reshape(tf.logical_not(mask), self._plan_valid.shape)))
+
+    @xla_function('observe')
+    def _observe(self, observations: Observations, action: tf.Tensor) -> None:
+        super()._observe(observations, action)
         self._goal.assign(observations['goal'])
 
-    @tf.function
+    @xla_function('act', input_signature=[])
     def act(self) -> tf.Tensor:
-        if self.visualize:
+        if self._warm_start:
+            if self.batch_size == 1 and self.visualize:
+                action = self._warm_started_action(visualization_goal=self._goal)
+            else:
+                action = self._warm_started_action()
+        elif self.batch_size > 1:
+            action = self._planner.get_actions(self.state)
+        elif self.visualize:
             action = self._planner.get_action(self.state, visualization_goal=self._goal)
         else:
             action = self._planner.get_action(self.state)
@@ -60,3 +96,15 @@ class MPCAgent(ModelBasedAgent):
         if self._exploration_noise:
             action += tf.random.normal(action.shape, stddev=self._exploration_noise)
         return action
+
+    def _warm_started_action(self, visualization_goal: Optional[tf.Tensor] = None) -> tf.Tensor:
+        assert isinstance(self._planner, CrossEntropyMethod)
+        mean, std_dev = self._planner.get_warm_started_plan(self.state,
+                                                            self._plan_mean,
+                                                            self._plan_std_dev,
+                                                            self._plan_valid,
+                                                            visualization_goal)
+        self._plan_mean.assign(mean)
+        self._plan_std_dev.assign(std_dev)
+        self._plan_valid.assign(tf.ones_like(self._plan_valid))
+        return mean[:, 0] if self.batch_size > 1 else mean[0]
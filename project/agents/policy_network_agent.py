@@ -7,6 +7,7 @@ import gym.spaces
 import tensorflow as tf
 
 from project.model import Model
+from project.util.tf.compilation import xla_function
 
 from .base import ModelBasedAgent
 
@@ -14,17 +15,18 @@ from .base import ModelBasedAgent
 @gin.configurable(whitelist=['sample'])
 class PolicyNetworkAgent(ModelBasedAgent):
     """At each time step, uses a policy network to choose the best action and executes it."""
-    def __init__(self, action_space: gym.Space, model: Model, sample: bool = True) -> None:
-        super().__init__(action_space, model)
+    def __init__(self, action_space: gym.Space, model: Model, batch_size: int = 1, sample: bool = True) -> None:
+        super().__init__(action_space, model, batch_size)
         assert model.action_network is not None
         self._policy = model.action_network
         self._sample = sample
 
-    @tf.function
+    @xla_function('act', input_signature=[])
     def act(self) -> tf.Tensor:
         action_dist = self._policy(self._predictor.state_to_features(self.state)[tf.newaxis, :], training=False)
         if self._sample:
-            action = action_dist.sample()[0, 0, :]
+            action = action_dist.sample()[0]
         else:
-            action = action_dist.mode()[0, 0, :]
-        return action
+            action = action_dist.mode()[0]
+        action = tf.cast(action, self.action_space.dtype)
+        return action[0] if self.batch_size == 1 else action
@@ -5,6 +5,7 @@
 from typing import Optional
 
 import gym
+import numpy as np
 import tensorflow as tf
 
 from .base import BlindAgent
@@ -12,16 +13,20 @@ from .base import BlindAgent
 
 class RandomAgent(BlindAgent):
     def act(self) -> tf.Tensor:
-        return tf.convert_to_tensor(self.action_space.sample())
+        if self.batch_size == 1:
+            return tf.convert_to_tensor(self.action_space.sample())
+        return tf.convert_to_tensor(np.stack([self.action_space.sample() for _ in range(self.batch_size)]))
 
 
 class ConstantAgent(BlindAgent):
-    def __init__(self, action_space: gym.Space, value: Optional[tf.Tensor] = None) -> None:
-        super().__init__(action_space)
+    def __init__(self, action_space: gym.Space, value: Optional[tf.Tensor] = None, batch_size: int = 1) -> None:
+        super().__init__(action_space, batch_size)
         if value is None:
             value = tf.zeros_like(self.action_space.sample())
         assert self.action_space.contains(value.numpy())
         self._value = value
 
     def act(self) -> tf.Tensor:
-        return self._value
+        if self.batch_size == 1:
+            return self._value
+        return tf.tile(self._value[tf.newaxis], [self.batch_size] + [1] * self._value.shape.ndims)
@@ -27,7 +27,7 @@ class SLAMAgent(Agent):
         config.freeze()
         self._agent = ORBSLAM2Agent(config.ORBSLAM2, device=torch.device('cpu'))
 
-    def reset(self) -> None:
+    def reset(self, mask: Optional[tf.Tensor] = None) -> None:
         """Reset agent's state"""
         self._agent.reset()
 
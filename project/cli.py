@@ -136,6 +136,31 @@ def evaluate_command(configs: Sequence[str],
         main.evaluate(num_episodes, not no_video, visualize_planner, seed, no_sync, baseline)
 
 
+@cli.command(name='benchmark')
+@with_global_options
+@click.option('-n', '--name', required=True, help='Name of benchmark to run')
+def benchmark_command(configs: Sequence[str],
+                      data: Optional[str],
+                      verbosity: str,
+                      debug: bool,
+                      checkpoint: Optional[str],
+                      extra_options: Tuple[str, ...],
+                      wandb_run: Optional[str],
+                      name: str,
+                      ) -> None:
+    """Run a performance benchmark."""
+    os.environ[wandb.env.MODE] = 'dryrun'
+    with main_configure(configs,
+                        extra_options,
+                        verbosity,
+                        debug,
+                        checkpoint,
+                        data=data,
+                        job_type='benchmark',
+                        extension=f'benchmark-{name}') as main:
+        main.benchmark(name)
+
+
 @cli.command(name='habitat-baseline')
 @with_global_options
 @click.option('--run-type', type=click.Choice(['train', 'eval']), required=True)
@@ -0,0 +1,121 @@
+# episodes.py: Indexing and scheduling of Habitat dataset episodes
+#
+# (C) 2020, Daniel Mouritzen
+
+import random
+from math import inf
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+Episode = Any  # habitat.core.dataset.Episode
+
+
+def episode_length(episode: Episode) -> float:
+    return float(episode.info['geodesic_distance'])
+
+
+class EpisodeIndex:
+    """Index of episodes sorted by geodesic distance, both in total and grouped by scene"""
+    def __init__(self, episodes: Iterable[Episode]) -> None:
+        by_scene: Dict[str, List[Episode]] = {}
+        for episode in episodes:
+            by_scene.setdefault(episode.scene_id, []).append(episode)
+        self._scenes = {scene: self._sorted(scene_episodes) for scene, scene_episodes in by_scene.items()}
+        self._all = self._sorted([episode for scene_episodes in by_scene.values() for episode in scene_episodes])
+
+    @staticmethod
+    def _sorted(episodes: List[Episode]) -> Tuple[np.ndarray, List[Episode]]:
+        lengths = np.array([episode_length(episode) for episode in episodes])
+        order = np.argsort(lengths, kind='stable')
+        return lengths[order], [episodes[i] for i in order]
+
+    def __len__(self) -> int:
+        return len(self._all[1])
+
+    @property
+    def scenes(self) -> List[str]:
+        return list(self._scenes.keys())
+
+    @property
+    def min_length(self) -> float:
+        return float(self._all[0][0]) if len(self) else inf
+
+    def count(self, max_length: float, scene: Optional[str] = None) -> int:
+        """Number of episodes no longer than `max_length`, in `scene` if given"""
+        lengths, _ = self._all if scene is None else self._scenes.get(scene, (np.zeros([0]), []))
+        return int(np.searchsorted(lengths, max_length, side='right'))
+
+    def sample(self, max_length: float, scene: Optional[str] = None) -> Optional[Episode]:
+        """A random episode no longer than `max_length`, in `scene` if given, or None if there are none"""
+        count = self.count(max_length, scene)
+        if not count:
+            return None
+        _, episodes = self._all if scene is None else self._scenes[scene]
+        return episodes[random.randrange(count)]
+
+
+class CurriculumEpisodeIterator(Iterator[Episode]):
+    """
+    Wraps an episode iterator, replacing episodes longer than `max_length` by a random episode that is short enough. The
+    replacement is taken from the same scene if possible, so the scene schedule of the wrapped iterator is kept and no
+    extra scene loads are needed.
+
+    Unlike resetting until a short enough episode is found, this is biased: short episodes in scenes with many long
+    episodes are picked more often than those in other scenes. This holds even if the wrapped iterator is unbiased, like
+    a shuffled SceneAffinityEpisodeIterator.
+    """
+    def __init__(self, iterator: Iterator[Episode], index: EpisodeIndex) -> None:
+        self._iterator = iterator
+        self.index = index
+        self.max_length = inf
+
+    def __next__(self) -> Episode:
+        episode = next(self._iterator)
+        if episode_length(episode) <= self.max_length:
+            return episode
+        replacement = self.index.sample(self.max_length, episode.scene_id)
+        if replacement is None:
+            replacement = self.index.sample(self.max_length)
+        return episode if replacement is None else replacement
+
+
+class SceneAffinityEpisodeIterator(Iterator[Episode]):
+    """
+    Infinite episode iterator that yields `episodes_per_scene` episodes from a scene before switching to another, so the
+    scene is reloaded at most once every `episodes_per_scene` episodes.
+
+    If `shuffle` is set, scenes are chosen at random with probability proportional to their number of episodes, and the
+    episodes of each scene are taken from a random permutation, so all episodes are equally likely in the long run.
+    Otherwise scenes and episodes are visited in dataset order.
+    """
+    def __init__(self, episodes: Iterable[Episode], episodes_per_scene: int, shuffle: bool = True) -> None:
+        assert episodes_per_scene > 0, 'episodes_per_scene must be positive'
+        self._episodes: Dict[str, List[Episode]] = {}
+        for episode in episodes:
+            self._episodes.setdefault(episode.scene_id, []).append(episode)
+        assert self._episodes, 'No episodes'
+        self._scenes = list(self._episodes.keys())
+        self._weights = [len(scene_episodes) for scene_episodes in self._episodes.values()]
+        self._positions = {scene: 0 for scene in self._scenes}
+        self._episodes_per_scene = episodes_per_scene
+        self._shuffle = shuffle
+        self._scene = self._scenes[-1]
+        self._remaining = 0
+
+    def __next__(self) -> Episode:
+        if not self._remaining:
+            self._scene = self._next_scene()
+            self._remaining = self._episodes_per_scene
+        self._remaining -= 1
+        episodes = self._episodes[self._scene]
+        position = self._positions[self._scene]
+        if position == 0 and self._shuffle:
+            random.shuffle(episodes)
+        self._positions[self._scene] = (position + 1) % len(episodes)
+        return episodes[position]
+
+    def _next_scene(self) -> str:
+        if self._shuffle:
+            return random.choices(self._scenes, weights=self._weights)[0]
+        return self._scenes[(self._scenes.index(self._scene) + 1) % len(self._scenes)]
@@ -4,10 +4,15 @@
 
 from __future__ import annotations
 
+import functools
+import os
 import random
+import tempfile
+import time
+import weakref
 from pathlib import Path
 from shutil import copyfile
-from typing import Any, Callable, Dict, List, Mapping, Optional, Tuple, TypeVar, Union, cast
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple, TypeVar, Union, cast
 from unittest.mock import MagicMock
 
 import gin
@@ -27,13 +32,54 @@ from habitat_sim.agent.controls.default_controls import LookLeft
 
 from project.util.config import get_config_dir
 from project.util.logging import capture_output
-from project.util.timing import measure_time
+from project.util.timing import Timer, measure_time
 
+from .episodes import SceneAffinityEpisodeIterator
 from .rewards import RewardFunction
+from .wrappers import Wrapper
 
 ObsTuple = Tuple[Observations, Any, bool, dict]
 
 
+@gin.configurable(whitelist=['enabled'])
+class NavigationCache:
+    """
+    Memoizes pathfinder queries for the current agent position, since the same geodesic distance is needed several
+    times per step (automatic stop, success check, rewards and measures). Queries are keyed by their start and end
+    positions, so the cache is invalidated when the agent moves. It must be cleared when the scene changes.
+    """
+    def __init__(self, sim: habitat.Simulator, enabled: bool = True) -> None:
+        self._sim = sim
+        self._enabled = enabled
+        self._position: Optional[Tuple[float, ...]] = None
+        self._distances: Dict[Tuple[float, ...], float] = {}
+
+    def geodesic_distance(self, position: Sequence[float], target: Sequence[float]) -> float:
+        if not self._enabled:
+            return cast(float, self._sim.geodesic_distance(list(position), list(target)))
+        position_key, target_key = tuple(position), tuple(target)
+        if position_key != self._position:
+            self._position = position_key
+            self._distances = {}
+        if target_key not in self._distances:
+            self._distances[target_key] = self._sim.geodesic_distance(list(position), list(target))
+        return self._distances[target_key]
+
+    def clear(self) -> None:
+        self._position = None
+        self._distances = {}
+
+
+_navigation_caches: 'weakref.WeakKeyDictionary[habitat.Simulator, NavigationCache]' = weakref.WeakKeyDictionary()
+
+
+def get_navigation_cache(sim: habitat.Simulator) -> NavigationCache:
+    """The NavigationCache of a simulator, shared between the environment and its measures"""
+    if sim not in _navigation_caches:
+        _navigation_caches[sim] = NavigationCache(sim)
+    return _navigation_caches[sim]
+
+
 @habitat.registry.register_measure
 class Success(habitat.Measure):
     def __init__(self, *args: Any, sim: habitat.Simulator, config: habitat.Config, **kwargs: Any) -> None:
@@ -53,7 +99,7 @@ class Success(habitat.Measure):
                       task: habitat.EmbodiedTask,
                       **kwargs: Any) -> None:
         current_position = self._sim.get_agent_state().position.tolist()
-        distance_to_target = self._sim.geodesic_distance(current_position, episode.goals[0].position)
+        distance_to_target = get_navigation_cache(self._sim).geodesic_distance(current_position, episode.goals[0].position)
 
         self._metric = int(getattr(task, 'is_stop_called', False) and distance_to_target < self._config.SUCCESS_DISTANCE)
 
@@ -81,6 +127,30 @@ class TurnAngleAction(SimulatorTaskAction):
         return self._sim.step(HabitatSimActions.TURN_ANGLE)
 
 
+@habitat.registry.register_task_action
+class TurnMoveTurnAction(SimulatorTaskAction):
+    """
+    Composite action that turns by `TurnAngle.angle`, moves forward and turns again, as a single simulator step. The
+    first two sub-actions are applied to the agent directly, so sensors are only rendered (and measures updated) once.
+    A collision in any sub-action is reported as a collision of the whole step, and the number of colliding sub-actions
+    is stored in `collided_substeps` on the simulator, so collisions can be counted as if the sub-actions were run
+    separately.
+    """
+    def _get_uuid(self, *args: Any, **kwargs: Any) -> str:
+        return 'turn_move_turn'
+
+    def step(self, *args: Any, **kwargs: Any) -> Observations:
+        agent = self._sim.get_agent(self._sim.habitat_config.DEFAULT_AGENT_ID)
+        collisions = int(agent.act(HabitatSimActions.TURN_ANGLE))
+        collisions += int(agent.act(HabitatSimActions.MOVE_FORWARD))
+        obs = self._sim.step(HabitatSimActions.TURN_ANGLE)
+        collisions += int(self._sim.previous_step_collided)
+        self._sim.collided_substeps = collisions
+        if collisions:
+            self._sim._prev_sim_obs['collided'] = True  # Read by HabitatSim.previous_step_collided
+        return obs
+
+
 @habitat.registry.register_action_space_configuration
 class TurnAngleActionSpace(HabitatSimV1ActionSpaceConfiguration):
     def get(self) -> Dict[int, habitat_sim.ActionSpec]:
@@ -100,6 +170,9 @@ class Habitat(habitat.RLEnv):
                  seed: Optional[int] = None,
                  min_duration: int = 0,
                  max_duration: int = 500,
+                 composite_actions: bool = True,
+                 episodes_per_scene: Optional[int] = None,
+                 shuffle_scenes: bool = True,
                  **_: Any) -> None:
         self._image_key = image_key
         self._goal_key = goal_key
@@ -116,6 +189,8 @@ class Habitat(habitat.RLEnv):
             random.seed(seed)
             np.random.seed(seed)
         super().__init__(config)
+        if episodes_per_scene:
+            self._env.episode_iterator = SceneAffinityEpisodeIterator(self._env.episodes, episodes_per_scene, shuffle_scenes)
         if seed is not None:
             self.seed(seed)
         self.observation_space: gym.spaces.Dict = gym.spaces.Dict(self._update_keys(self._env.observation_space.spaces))
@@ -123,7 +198,12 @@ class Habitat(habitat.RLEnv):
         self.action_space = gym.spaces.Box(low=-1, high=1, shape=(1,), dtype=np.float32)
         self._min_duration = min_duration
         self._max_duration = max_duration
+        self._composite_actions = composite_actions
         self._step_count = 0
+        self.steps_per_action = 1
+        self._substep_collisions = 0
+        self._scene: Optional[str] = None
+        self._scene_load_time = 0.0
 
     def reconfigure(self,
                     config: habitat.Config,
@@ -138,6 +218,7 @@ class Habitat(habitat.RLEnv):
             # This is needed for reproducible episode shuffling
             random.seed(seed)
             np.random.seed(seed)
+        self.navigation.clear()
         with capture_output('habitat_sim'):
             self.habitat_env.reconfigure(config)
             # Habitat's reconfigure doesn't update the task config, so we do that manually:
@@ -166,13 +247,14 @@ class Habitat(habitat.RLEnv):
     def episode_success(self) -> bool:
         return self._called_stop and self.distance_to_target() < self.success_distance
 
+    @property
+    def navigation(self) -> NavigationCache:
+        return get_navigation_cache(self._env.sim)
+
     def distance_to_target(self) -> float:
         current_position = self._env.sim.get_agent_state().position.tolist()
         target_position = self._env.current_episode.goals[0].position  # type: ignore[attr-defined]
-        distance = self._env.sim.geodesic_distance(
-            current_position, target_position
-        )
-        return distance
+        return self.navigation.geodesic_distance(current_position, target_position)
 
     def get_info(self, observations: Observations) -> Dict[str, Any]:
         metrics = cast(Dict[str, Any], self.habitat_env.get_metrics())
@@ -198,16 +280,29 @@ class Habitat(habitat.RLEnv):
             info['timeout'] = not self.episode_success()
         else:
             TurnAngle.angle = action * 90.0 / 2
-            sum_reward = 0.0
-            for sub_action in ['TURN_ANGLE',
-                               'MOVE_FORWARD',
-                               'TURN_ANGLE']:
-                obs, reward, done, info = super().step(sub_action)
-                sum_reward += reward
-                if done:
-                    break
+            if self._composite_actions:
+                # Rewards given per simulator step are scaled, to match running the sub-actions separately
+                self.steps_per_action = 3
+                obs, reward, done, info = super().step('TURN_MOVE_TURN')
+                self.steps_per_action = 1
+                # The collisions measure counts at most one collision per simulator step
+                self._substep_collisions += max(self._env.sim.collided_substeps - 1, 0)
+            else:
+                sum_reward = 0.0
+                for sub_action in ['TURN_ANGLE',
+                                   'MOVE_FORWARD',
+                                   'TURN_ANGLE']:
+                    obs, reward, done, info = super().step(sub_action)
+                    sum_reward += reward
+                    if done:
+                        break
+                reward = sum_reward
             info['taken_action'] = action
-            reward = sum_reward
+        if 'collisions' in info:
+            info['collisions'] += self._substep_collisions
+        # Time spent loading the scene in the last reset is reported once, in the first step after it
+        info['scene_load_time'] = self._scene_load_time
+        self._scene_load_time = 0.0
         obs = self._update_keys(obs)
         if self._capture_video:
             self._store_video_frame(obs, info['taken_action'], self.habitat_env.get_metrics())
@@ -216,10 +311,15 @@ class Habitat(habitat.RLEnv):
     def reset(self) -> Observations:
         self._called_stop = False
         self._step_count = 0
+        self._substep_collisions = 0
         self._reward_function.reset()
         self._rgb_frames = []
-        with capture_output('habitat_sim'):
+        self.navigation.clear()  # The scene may change
+        with capture_output('habitat_sim'), Timer() as t:
             obs = super().reset()
+        if self.habitat_env.current_episode.scene_id != self._scene:
+            self._scene = self.habitat_env.current_episode.scene_id
+            self._scene_load_time = t.interval
         obs = self._update_keys(obs)
         if self._capture_video:
             self._store_video_frame(obs)
@@ -289,11 +389,16 @@ class Habitat(habitat.RLEnv):
 
 
 class DummyHabitat(gym.Env):
+    """
+    Stand-in for Habitat without a simulator. The agent moves randomly, and pathfinder queries return the euclidean
+    distance after sleeping for `query_time` seconds, to emulate their cost.
+    """
     def __init__(self,
                  config: habitat.Config,
                  image_key: str,
                  goal_key: str,
                  reward_function: RewardFunction,
+                 query_time: float = 0.0,
                  **_: Any) -> None:
         self._image_key = image_key
         self._goal_key = goal_key
@@ -306,6 +411,11 @@ class DummyHabitat(gym.Env):
         self.sim.config = config.SIMULATOR
         self.sim.previous_step_collided = False
         self.sim.distance_to_closest_obstacle = MagicMock(return_value=0.5)
+        self.sim.get_agent_state = MagicMock(side_effect=lambda: MagicMock(position=self._position.copy()))
+        self.sim.geodesic_distance = MagicMock(side_effect=self._geodesic_distance)
+        self._query_time = query_time
+        self._position = np.zeros(3)
+        self._target = np.array([5.0, 0.0, 0.0])
         self.habitat_env = MagicMock()
         self.habitat_env.current_episode.info = {"geodesic_distance": 5.0}
 
@@ -317,13 +427,23 @@ class DummyHabitat(gym.Env):
                                                              'TURN_RIGHT': habitat.core.spaces.EmptySpace()})
         self.reward_range = self._reward_function.get_reward_range()
 
+    @property
+    def navigation(self) -> NavigationCache:
+        return get_navigation_cache(self.sim)
+
     def distance_to_target(self) -> float:
-        return random.uniform(0, 5)
+        return self.navigation.geodesic_distance(self.sim.get_agent_state().position.tolist(), self._target.tolist())
+
+    def _geodesic_distance(self, position: Sequence[float], target: Sequence[float]) -> float:
+        time.sleep(self._query_time)
+        return float(np.linalg.norm(np.subtract(target, position)))
 
     def episode_success(self) -> bool:
         return random.random() < 0.05
 
     def step(self, action: int) -> ObsTuple:
+        if action != self.stop_action:
+            self._position += np.random.uniform(-0.25, 0.25, 3)
         obs = self.observation_space.sample()
         reward = self._reward_function.get_reward(obs)
         done = random.random() < 0.05
@@ -338,24 +458,96 @@ class DummyHabitat(gym.Env):
 
     def reset(self) -> Observations:
         self._reward_function.reset()
+        self._position = np.zeros(3)
+        self.navigation.clear()
         return cast(Observations, self.observation_space.sample())
 
 
+BufferSpec = Tuple[str, Tuple[int, ...], str]  # path, shape and dtype of a memory-mapped observation buffer
+
+
+class SharedObservations(Wrapper):
+    """
+    Worker side of VectorHabitat's shared memory transport. Once attach_buffers() has been called, observations are
+    written to the buffers in place, and only observations without a buffer are returned through the pipe.
+    """
+    def __init__(self, env: gym.Env) -> None:
+        super().__init__(env)
+        self._buffers: Optional[Dict[str, np.memmap]] = None
+
+    def attach_buffers(self, specs: Mapping[str, BufferSpec]) -> None:
+        self._buffers = {key: np.memmap(path, dtype=dtype, mode='r+', shape=shape) for key, (path, shape, dtype) in specs.items()}
+
+    def step(self, action: Any) -> ObsTuple:
+        obs, reward, done, info = self.env.step(action)
+        return self._share(obs), reward, done, info
+
+    def reset(self) -> Observations:
+        return self._share(self.env.reset())
+
+    def _share(self, obs: Observations) -> Observations:
+        if self._buffers is None:
+            return obs
+        for key, buffer in self._buffers.items():
+            buffer[...] = obs[key]
+        return cast(Observations, {key: value for key, value in obs.items() if key not in self._buffers})
+
+
+def _shared_env_ctor(env_ctor: Callable[..., gym.Env], *args: Any) -> gym.Env:
+    return SharedObservations(env_ctor(*args))
+
+
+@gin.configurable(whitelist=['shared_memory'])
 class VectorHabitat(VectorEnv):
+    """
+    Runs an environment in a worker process. If `shared_memory` is set, observations are passed through preallocated
+    memory-mapped buffers (in /dev/shm if available), so only rewards, infos etc. are pickled and sent through the pipe.
+    Attributes that don't change during the lifetime of the environment are fetched from the worker only once.
+    """
+    STATIC_ATTRS = {'reward_range', 'metadata', 'spec', 'success_distance', 'stop_action'}
+
     def __init__(self,
                  env_ctor: Callable[..., gym.Env],
                  params: Mapping[str, Any],
-                 auto_reset_done: bool = False) -> None:
-        super().__init__(env_ctor, [tuple(params.items())], auto_reset_done=auto_reset_done, multiprocessing_start_method='fork')
+                 auto_reset_done: bool = False,
+                 shared_memory: bool = True) -> None:
+        self._attr_cache: Dict[str, Any] = {}
+        self._buffers: Optional[Dict[str, np.memmap]] = None
+        self._buffer_dir: Optional[tempfile.TemporaryDirectory] = None
+        super().__init__(functools.partial(_shared_env_ctor, env_ctor),
+                         [tuple(params.items())],
+                         auto_reset_done=auto_reset_done,
+                         multiprocessing_start_method='fork')
         self.observation_space = self.observation_spaces[0]
         self.action_space = self.action_spaces[0]
         self._valid_attrs = {'observation_space', 'action_space', 'reward_range', 'metadata', 'reward_range', 'spec',
                              '_config', '_capture_video', '_min_duration'}
-        self._valid_attrs |= set(Habitat.__dict__.keys())
+        self._valid_attrs |= set(Habitat.__dict__.keys()) | self.STATIC_ATTRS
+        if shared_memory and isinstance(self.observation_space, gym.spaces.Dict):
+            self._attach_buffers(self.observation_space)
+
+    def _attach_buffers(self, space: gym.spaces.Dict) -> None:
+        self._buffer_dir = tempfile.TemporaryDirectory(prefix='vector_habitat_', dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+        specs: Dict[str, BufferSpec] = {key: (str(Path(self._buffer_dir.name) / f'{key}.buf'), tuple(subspace.shape), np.dtype(subspace.dtype).str)
+                                        for key, subspace in space.spaces.items()}
+        self._buffers = {key: np.memmap(path, dtype=dtype, mode='w+', shape=shape) for key, (path, shape, dtype) in specs.items()}
+        self.call_at(0, 'attach_buffers', {'specs': specs})
+
+    def _read_buffers(self, obs: Observations) -> Observations:
+        if self._buffers is None:
+            return obs
+        obs = dict(obs)
+        # Copy, since the buffers are overwritten by the next step
+        obs.update({key: np.array(buffer) for key, buffer in self._buffers.items()})
+        return cast(Observations, obs)
 
     def __getattr__(self, name: str) -> Any:
         if name not in self._valid_attrs:
             raise AttributeError(f'Invalid attribute {name}')
+        if name in self.STATIC_ATTRS:
+            if name not in self._attr_cache:
+                self._attr_cache[name] = self.call_at(0, '__getattr__', {'name': name})
+            return self._attr_cache[name]
         return self.call_at(0, '__getattr__', {'name': name})
 
     def save_video(self, file: Union[str, Path], **kwargs: Any) -> None:
@@ -363,6 +555,7 @@ class VectorHabitat(VectorEnv):
         self.call_at(0, 'save_video', kwargs)
 
     def reconfigure(self, **kwargs: Any) -> None:
+        self._attr_cache.clear()
         self.call_at(0, 'reconfigure', kwargs)
 
     def seed(self, seed: int) -> None:
@@ -370,20 +563,25 @@ class VectorHabitat(VectorEnv):
 
     def step(self, action: Any) -> ObsTuple:  # type: ignore[override]
         obs, reward, done, info = super().step(data=[{'action': action}])[0]
-        return obs, reward, done, info
+        return self._read_buffers(obs), reward, done, info
 
     def reset(self) -> Observations:
-        return cast(Observations, super().reset()[0])
+        return self._read_buffers(super().reset()[0])
 
     def close(self) -> None:
         try:
             super().close()
         except (BrokenPipeError, EOFError):
             pass
+        self._buffers = None
+        if self._buffer_dir is not None:
+            self._buffer_dir.cleanup()
+            self._buffer_dir = None
 
 
 @gin.configurable('Habitat', whitelist=['task', 'train_dataset', 'train_split', 'eval_dataset', 'eval_split', 'gpu_id',
-                                        'image_key', 'goal_key', 'depth_key', 'reward_function', 'eval_episodes_per_scene'])
+                                        'image_key', 'goal_key', 'depth_key', 'reward_function', 'eval_episodes_per_scene',
+                                        'composite_actions', 'train_episodes_per_scene', 'shuffle_scenes'])
 def get_config(training: bool = False,
                top_down_map: bool = False,
                max_steps: Optional[Union[int, float]] = None,
@@ -397,7 +595,10 @@ def get_config(training: bool = False,
                goal_key: str = 'pointgoal_with_gps_compass',
                depth_key: Optional[str] = None,
                reward_function: RewardFunction = gin.REQUIRED,
-               eval_episodes_per_scene: int = 3
+               eval_episodes_per_scene: int = 3,
+               composite_actions: bool = True,
+               train_episodes_per_scene: Optional[int] = None,
+               shuffle_scenes: bool = True,
                ) -> Dict[str, Any]:
     mode = 'train' if training else 'eval'
     dataset = train_dataset if training else eval_dataset
@@ -429,7 +630,9 @@ def get_config(training: bool = False,
     config.TASK.MEASUREMENTS.append('SUCCESS')
     config.TASK.ACTIONS.TURN_ANGLE = habitat.Config()
     config.TASK.ACTIONS.TURN_ANGLE.TYPE = 'TurnAngleAction'
-    config.TASK.POSSIBLE_ACTIONS = ['STOP', 'MOVE_FORWARD', 'TURN_ANGLE']
+    config.TASK.ACTIONS.TURN_MOVE_TURN = habitat.Config()
+    config.TASK.ACTIONS.TURN_MOVE_TURN.TYPE = 'TurnMoveTurnAction'
+    config.TASK.POSSIBLE_ACTIONS = ['STOP', 'MOVE_FORWARD', 'TURN_ANGLE', 'TURN_MOVE_TURN']
     if top_down_map and 'TOP_DOWN_MAP' not in config.TASK.MEASUREMENTS:
         # Top-down map is expensive to compute, so we only enable it when needed.
         config.TASK.MEASUREMENTS.append('TOP_DOWN_MAP')
@@ -438,4 +641,8 @@ def get_config(training: bool = False,
             'image_key': image_key,
             'goal_key': goal_key,
             'depth_key': depth_key,
-            'reward_function': reward_function}
+            'reward_function': reward_function,
+            'composite_actions': composite_actions,
+            # Evaluation episodes are grouped by scene with MAX_SCENE_REPEAT_EPISODES instead
+            'episodes_per_scene': train_episodes_per_scene if training else None,
+            'shuffle_scenes': shuffle_scenes}
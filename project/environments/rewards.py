@@ -31,6 +31,11 @@ class RewardFunction:
     def assert_env(self) -> None:
         assert self._env is not None, 'set_env has not been called yet!'
 
+    @property
+    def steps_per_action(self) -> int:
+        """Number of simulator steps taken by the current action, for rewards that are given per simulator step"""
+        return getattr(self._env, 'steps_per_action', 1)
+
 
 class CombinedRewards(RewardFunction):
     def __init__(self, rewards: Iterable[RewardFunction]) -> None:
@@ -87,7 +92,7 @@ class DenseReward(RewardFunction):
             # New episode
             self._previous_target_distance = self._env.habitat_env.current_episode.info["geodesic_distance"]  # type: ignore[union-attr]
 
-        reward = self._slack_reward
+        reward = self._slack_reward * self.steps_per_action
 
         current_target_distance: float = self._env.distance_to_target()  # type: ignore[union-attr]
         reward += self._distance_scaling * (self._previous_target_distance - current_target_distance)
@@ -145,9 +150,13 @@ class CollisionPenalty(RewardFunction):
 
     def get_reward(self, observations: Observations) -> float:
         self.assert_env()
-        if self._env.sim.previous_step_collided:  # type: ignore[union-attr]
-            return -self._scaling
-        return 0.0
+        sim = self._env.sim  # type: ignore[union-attr]
+        if not sim.previous_step_collided:
+            return 0.0
+        if self.steps_per_action > 1:
+            # Composite actions penalize each colliding sub-action, as if they were run separately
+            return -self._scaling * getattr(sim, 'collided_substeps', 1)
+        return -self._scaling
 
 
 @gin.configurable(whitelist=['scaling'])
@@ -174,7 +183,7 @@ class ObstacleDistancePenalty(RewardFunction):
         distance: float = self._env.sim.distance_to_closest_obstacle(  # type: ignore[union-attr]
             self._env.sim.get_agent_state().position, self._threshold) - self._env.sim.config.AGENT_0.RADIUS  # type: ignore[union-attr]
         if distance < self._threshold:
-            return self._scaling * (distance / self._threshold - 1.0)
+            return self._scaling * (distance / self._threshold - 1.0) * self.steps_per_action
         return 0.0
 
 
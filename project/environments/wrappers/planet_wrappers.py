@@ -27,6 +27,7 @@ import skimage.transform
 import tensorflow as tf
 from loguru import logger
 
+from project.util.planet.episode_store import STORE_DIR, EpisodeStore
 from project.util.typing import Action, Observations, ObsTuple, Reward
 
 from .base import Wrapper
@@ -163,11 +164,16 @@ class ActionRepeat(Wrapper):
     def step(self, action: Action) -> ObsTuple:
         done = False
         total_reward = 0.0
+        scene_load_time = 0.0
         current_step = 0
         while current_step < self._amount and not done:
             observ, reward, done, info = super().step(action)
             total_reward += reward
+            # Only reported in the first step after a reset, so it would be lost when that isn't the last step
+            scene_load_time += info.get('scene_load_time', 0.0)
             current_step += 1
+        if 'scene_load_time' in info:
+            info['scene_load_time'] = scene_load_time
         return observ, total_reward, done, info
 
 
@@ -314,7 +320,7 @@ class PadActions(Wrapper):
         return gym.spaces.Box(low, high, dtype=np.float32)
 
 
-@gin.configurable(whitelist=['rejection_metric', 'rejection_threshold'])
+@gin.configurable(whitelist=['rejection_metric', 'rejection_threshold', 'episode_store'])
 class CollectGymDataset(Wrapper):
     """Collect transition tuples and store episodes as Numpy files.
 
@@ -332,6 +338,11 @@ class CollectGymDataset(Wrapper):
 
     If rejection_metric is specified, only episodes for which the specified metric
     exceeds rejection_threshold are saved.
+
+    If episode_store is set, episodes are additionally appended to an EpisodeStore
+    in the subdirectory STORE_DIR of outdir, which can be read by store_loader.
+    Wrappers collecting into the same outdir at the same time must share a single
+    store, by passing the `store` of the first wrapper to the others.
     """
 
     def __init__(self,
@@ -339,12 +350,21 @@ class CollectGymDataset(Wrapper):
                  outdir: Optional[str],
                  rejection_metric: Optional[str] = None,
                  rejection_threshold: float = 0.0,
+                 episode_store: bool = False,
+                 store: Optional[EpisodeStore] = None,
                  ) -> None:
         super().__init__(env)
         self._outdir = outdir and os.path.expanduser(outdir)
         self._episode: List[Dict[str, Any]] = []
         self._rejection_metric = rejection_metric
         self._rejection_threshold = rejection_threshold
+        if store is None and self._outdir and episode_store:
+            store = EpisodeStore(os.path.join(self._outdir, STORE_DIR))
+        self._store = store
+
+    @property
+    def store(self) -> Optional[EpisodeStore]:
+        return self._store
 
     def step(self, action: Action) -> ObsTuple:
         observ, reward, done, info = super().step(action)
@@ -409,10 +429,15 @@ class CollectGymDataset(Wrapper):
         with io.BytesIO() as file_:
             np.savez_compressed(file_, **episode)
             file_.seek(0)
-            with tf.io.gfile.GFile(filename, 'w') as ff:
+            # Loaders in other threads or processes glob for *.npz, so they must never see a partially written file
+            tmp_filename = filename + '.tmp'
+            with tf.io.gfile.GFile(tmp_filename, 'w') as ff:
                 ff.write(file_.read())
+            tf.io.gfile.rename(tmp_filename, filename, overwrite=True)
         folder = os.path.basename(self._outdir)
         name = os.path.splitext(os.path.basename(filename))[0]
+        if self._store is not None:
+            self._store.append(episode, name)
         logger.debug('Recorded episode {} to {}.'.format(name, folder))
 
 
@@ -4,6 +4,7 @@
 #
 # (C) 2019, Daniel Mouritzen
 
+from math import inf
 from typing import Any, Callable, Dict, Tuple, Type, cast
 
 import gin
@@ -11,6 +12,7 @@ import gym.spaces
 import numpy as np
 from loguru import logger
 
+from project.environments.episodes import CurriculumEpisodeIterator, EpisodeIndex
 from project.util.typing import Action, Observations, ObsTuple
 
 from .base import Wrapper
@@ -108,7 +110,11 @@ def automatic_stop(enable: bool = False) -> Tuple[Type[AutomaticStop], Callable[
 
 
 class Curriculum(Wrapper):
-    """Rejects episodes longer than a gradually increasing threshold."""
+    """
+    Restricts episodes to those shorter than a gradually increasing threshold. The episode iterator of the Habitat env
+    is replaced by a CurriculumEpisodeIterator, which picks qualifying episodes from an index of the dataset instead of
+    resetting until one is found.
+    """
 
     def __init__(self,
                  env: gym.Env,
@@ -142,24 +148,32 @@ class Curriculum(Wrapper):
         self._enabled = enable
 
     def reset(self) -> Observations:
+        if not self._enabled:
+            if isinstance(self.env.habitat_env.episode_iterator, CurriculumEpisodeIterator):
+                self.env.habitat_env.episode_iterator.max_length = inf
+            return super().reset()
+        iterator = self._episode_iterator()
+        if not len(iterator.index):
+            # Nothing to choose from, e.g. if the dataset isn't loaded
+            return super().reset()
+        if self.threshold < iterator.index.min_length:
+            logger.warning(f'Curriculum: No episodes are shorter than the threshold {self.threshold:.2f}m; increasing '
+                           f'start_threshold by {iterator.index.min_length - self.threshold:.2f}m.')
+            self._start_threshold += iterator.index.min_length - self.threshold
+        iterator.max_length = self.threshold
         obs = super().reset()
-        if self._enabled:
-            count = 0
-            while self.episode_length > self.threshold:
-                logger.trace(f'Curriculum: Rejected episode with length {self.episode_length:.2f}m due to threshold '
-                             f'{self.threshold:.2f}m')
-                if count >= 500:
-                    logger.warning(f'Curriculum: Failed to find a suitable episode with threshold {self.threshold:.2f}m '
-                                   f'in 500 steps; increasing start_threshold to '
-                                   f'{self._start_threshold + self._increase_rate:.2f}m.')
-                    self._start_threshold += self._increase_rate
-                    count = 0
-                else:
-                    count += 1
-                obs = self.env.reset()
-            self._episodes += 1
+        logger.trace(f'Curriculum: Episode with length {self.episode_length:.2f}m, threshold {self.threshold:.2f}m')
+        self._episodes += 1
         return obs
 
+    def _episode_iterator(self) -> CurriculumEpisodeIterator:
+        """The CurriculumEpisodeIterator of the Habitat env, which is created the first time this is called"""
+        habitat_env = self.env.habitat_env
+        if not isinstance(habitat_env.episode_iterator, CurriculumEpisodeIterator):
+            habitat_env.episode_iterator = CurriculumEpisodeIterator(habitat_env.episode_iterator,
+                                                                     EpisodeIndex(habitat_env.episodes))
+        return cast(CurriculumEpisodeIterator, habitat_env.episode_iterator)
+
 
 @gin.configurable(whitelist=['enabled', 'start_threshold', 'initial_delay', 'increase_rate'])
 def curriculum(enabled: bool = True,
@@ -2,9 +2,13 @@
 #
 # (C) 2019, Daniel Mouritzen
 
+from .async_evaluator import AsyncEvaluator
+from .benchmark import run_benchmark
+from .collector import AsyncCollector
 from .evaluator import Evaluator
 from .run_baseline import run_baseline
-from .simulator import Simulator
+from .simulator import BatchedSimulator, Simulator
 from .train import train
 
-__all__ = ['Evaluator', 'run_baseline', 'Simulator', 'train']
+__all__ = ['AsyncCollector', 'AsyncEvaluator', 'BatchedSimulator', 'Evaluator', 'run_baseline', 'run_benchmark', 'Simulator',
+           'train']
@@ -0,0 +1,102 @@
+# async_evaluator.py: Evaluation of checkpoints in a process pool
+#
+# (C) 2020, Daniel Mouritzen
+
+import multiprocessing as mp
+import re
+from concurrent.futures import Future, ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Set
+
+import gin
+import tensorflow as tf
+from loguru import logger
+
+from .evaluator import Evaluator
+
+
+class EvaluationResult(NamedTuple):
+    epoch: int
+    checkpoint: Path
+    metrics: Dict[str, Dict[str, float]]
+    videos: Dict[str, List[Path]]
+
+
+@gin.configurable('async_evaluation', whitelist=['num_workers', 'num_episodes', 'period', 'use_gpu'])
+class AsyncEvaluator:
+    """
+    Evaluates the checkpoints written during training in a pool of `num_workers` processes, so training doesn't have to
+    wait for evaluation. Checkpoints from every `period`th epoch are evaluated, with `num_episodes` episodes per task.
+
+    The workers are spawned with the current gin config, and each creates its own evaluation environments. They run on
+    CPU unless `use_gpu` is set. If `num_workers` is 0, no workers are started.
+    """
+    def __init__(self,
+                 logdir: Path,
+                 num_workers: int = 0,
+                 num_episodes: int = 10,
+                 period: int = 10,
+                 use_gpu: bool = False,
+                 ) -> None:
+        self._logdir = logdir
+        self._num_episodes = num_episodes
+        self._period = period
+        self._pool: Optional[ProcessPoolExecutor] = None
+        if num_workers:
+            self._pool = ProcessPoolExecutor(num_workers,
+                                             mp_context=mp.get_context('spawn'),
+                                             initializer=_init_worker,
+                                             initargs=(gin.config_str(), logdir, use_gpu))
+        self._submitted: Set[Path] = set()
+        self._pending: List[Future] = []
+
+    @property
+    def enabled(self) -> bool:
+        return self._pool is not None
+
+    def poll(self) -> List[EvaluationResult]:
+        """Submit checkpoints written since the last call and return the results of finished evaluations"""
+        assert self._pool is not None, 'Asynchronous evaluation is disabled'
+        for checkpoint in sorted(self._logdir.glob('checkpoint_epoch_*.h5')):
+            if checkpoint in self._submitted:
+                continue
+            self._submitted.add(checkpoint)
+            epoch = int(re.findall(r'epoch_(\d+)', checkpoint.name)[0])
+            if self._period and epoch % self._period == 0:
+                logger.debug(f'Submitting checkpoint from epoch {epoch} for evaluation.')
+                self._pending.append(self._pool.submit(_evaluate, checkpoint, epoch, self._num_episodes))
+        done = [future for future in self._pending if future.done()]
+        self._pending = [future for future in self._pending if not future.done()]
+        return [future.result() for future in done]
+
+    def close(self) -> List[EvaluationResult]:
+        """Wait for submitted evaluations to finish and shut down the workers. Returns the remaining results."""
+        if self._pool is None:
+            return []
+        results = [future.result() for future in self._pending]
+        self._pending = []
+        self._pool.shutdown()
+        self._pool = None
+        return results
+
+
+_evaluator: Optional[Evaluator] = None
+
+
+def _init_worker(config: str, logdir: Path, use_gpu: bool) -> None:
+    global _evaluator
+    if not use_gpu:
+        # Only hide the GPUs from TF, since habitat-sim renders on the GPU
+        tf.config.experimental.set_visible_devices([], 'GPU')
+    import gin.tf.external_configurables  # noqa: F401
+    import project.main  # noqa: F401  # Register all configurables
+    gin.parse_config(config)
+    _evaluator = Evaluator(logdir=logdir, video=True)
+
+
+def _evaluate(checkpoint: Path, epoch: int, num_episodes: int) -> EvaluationResult:
+    assert _evaluator is not None
+    metrics, videos = _evaluator.run(checkpoint=checkpoint,
+                                     num_episodes=num_episodes,
+                                     save_dir=_evaluator.logdir / 'eval' / f'epoch_{epoch:03d}')
+    return EvaluationResult(epoch, checkpoint, metrics, videos)
@@ -0,0 +1,343 @@
+# benchmark.py: Benchmarks of performance-critical code paths
+#
+# (C) 2020, Daniel Mouritzen
+
+from pathlib import Path
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+import gin
+import gym.spaces
+import numpy as np
+import tensorflow as tf
+import wandb
+from loguru import logger
+
+from project.agents import MPCAgent
+from project.environments.habitat import DummyHabitat, VectorHabitat, get_config
+from project.environments.wrappers import AutomaticStop
+from project.model import Model, get_model, restore_model
+from project.planning import CrossEntropyMethod, Planner
+from project.util import PrettyPrinter
+from project.util.planet.preprocess import preprocess
+from project.util.tf.compilation import XLA_FAMILIES
+from project.util.timing import Timer
+
+Results = Dict[str, Dict[str, float]]
+BenchmarkFn = Callable[[Path, Optional[Path]], Results]
+
+BENCHMARKS: Dict[str, BenchmarkFn] = {}
+
+
+def register_benchmark(name: str) -> Callable[[BenchmarkFn], BenchmarkFn]:
+    """Decorator registering a benchmark function under `name`. It should return a dict of results for each variant."""
+    def decorator(func: BenchmarkFn) -> BenchmarkFn:
+        BENCHMARKS[name] = func
+        return func
+    return decorator
+
+
+def run_benchmark(name: str, logdir: Path, checkpoint: Optional[Path] = None) -> Results:
+    """Run a registered benchmark. Benchmarks that need a model use `checkpoint` if given, or random weights otherwise."""
+    if name not in BENCHMARKS:
+        raise ValueError(f'Unknown benchmark {name!r}. Available benchmarks: {", ".join(sorted(BENCHMARKS.keys()))}')
+    logger.info(f'Running benchmark {name}.')
+    results = BENCHMARKS[name](logdir, checkpoint)
+    keys = sorted({key for variant in results.values() for key in variant.keys()})
+    pp = PrettyPrinter(['variant'] + keys, log_fn=logger.info)
+    pp.print_header()
+    for variant, values in results.items():
+        pp.print_row(dict(variant=variant, **values))
+    wandb.log({f'benchmark/{name}/{variant}/{k}': v for variant, values in results.items() for k, v in values.items()})
+    return results
+
+
+def time_repeated(func: Callable[[], object], repeats: int, warmup: int = 1) -> float:
+    """Mean wall time of `func` in seconds, excluding `warmup` initial calls (e.g. for tracing)"""
+    for _ in range(warmup):
+        func()
+    with Timer() as t:
+        for _ in range(repeats):
+            func()
+    return t.interval / repeats
+
+
+def get_benchmark_model(checkpoint: Optional[Path],
+                        image_shape: Sequence[int] = (64, 64, 3),
+                        action_shape: Sequence[int] = (1,),
+                        batch_shape: Sequence[int] = (1, 2),
+                        ) -> Model:
+    """Restore model from checkpoint, or create one with random weights for a Habitat-like observation space"""
+    if checkpoint is not None:
+        model, _ = restore_model(checkpoint)
+        return model
+    batch_shape = list(batch_shape)
+    data_spec = {'image': tf.TensorSpec(batch_shape + list(image_shape), tf.float32),
+                 'goal': tf.TensorSpec(batch_shape + [2], tf.float32),
+                 'action': tf.TensorSpec(batch_shape + list(action_shape), tf.float32),
+                 'reward': tf.TensorSpec(batch_shape, tf.float32),
+                 'done': tf.TensorSpec(batch_shape, tf.float32),
+                 'length': tf.TensorSpec(batch_shape[:1] + [1], tf.int32)}
+    return get_model(['image', 'goal'], data_spec)
+
+
+@register_benchmark('preprocess')
+@gin.configurable('benchmark.preprocess', whitelist=['batch_shape', 'image_shape', 'repeats'])
+def preprocess_benchmark(logdir: Path,
+                         checkpoint: Optional[Path],
+                         batch_shape: Tuple[int, int] = (64, 64),
+                         image_shape: Tuple[int, int, int] = (64, 64, 3),
+                         repeats: int = 20,
+                         ) -> Results:
+    """Compares host-to-device transfer of image batches preprocessed on the host vs on the device"""
+    device = '/gpu:0' if tf.config.experimental.list_physical_devices('GPU') else '/cpu:0'
+    with tf.device('/cpu:0'):
+        raw = tf.constant(np.random.randint(0, 256, batch_shape + image_shape, dtype=np.uint8))
+        host_preprocessed = preprocess(raw)
+
+    # Outputs are reduced on the device, so that copying them back does not affect the timing
+    @tf.function
+    def to_device(image: tf.Tensor) -> tf.Tensor:
+        with tf.device(device):
+            return tf.reduce_sum(tf.identity(image))
+
+    @tf.function
+    def to_device_and_preprocess(image: tf.Tensor) -> tf.Tensor:
+        with tf.device(device):
+            return tf.reduce_sum(preprocess(image))
+
+    results = {}
+    for variant, image, func in [('host', host_preprocessed, to_device), ('device', raw, to_device_and_preprocess)]:
+        results[variant] = {'bytes_per_batch': float(image.numpy().nbytes),
+                            'time_per_batch': time_repeated(lambda: func(image).numpy(), repeats)}
+    return results
+
+
+@register_benchmark('cem')
+@gin.configurable('benchmark.cem', whitelist=['batch_sizes', 'repeats'])
+def cem_benchmark(logdir: Path,
+                  checkpoint: Optional[Path],
+                  batch_sizes: Sequence[int] = (1, 8, 32),
+                  repeats: int = 5,
+                  ) -> Results:
+    """Compares CEM planning for K states at once with planning for each state separately"""
+    model = get_benchmark_model(checkpoint)
+    action_space = gym.spaces.Box(-1.0, 1.0, tuple(model.input_shape['action'][2:].as_list()), dtype=np.float32)
+    planner = CrossEntropyMethod.from_model(model, action_space)
+    results = {}
+    for batch_size in batch_sizes:
+        state = model.rnn.predictor.zero_state(batch_size, tf.float32)
+        for variant, func in [('batched', planner.get_actions),
+                              ('sequential', lambda s: Planner.get_actions(planner, s))]:
+            time = time_repeated(lambda: func(state).numpy(), repeats)
+            results[f'{variant}_{batch_size}'] = {'time_per_call': time, 'states_per_second': batch_size / time}
+    return results
+
+
+@register_benchmark('rollout')
+@gin.configurable('benchmark.rollout', whitelist=['amount', 'horizon', 'repeats'])
+def rollout_benchmark(logdir: Path,
+                      checkpoint: Optional[Path],
+                      amount: int = 1000,
+                      horizon: int = 12,
+                      repeats: int = 10,
+                      ) -> Results:
+    """Compares open-loop prediction of `amount` action sequences using an RNN layer and the fused rollout"""
+    model = get_benchmark_model(checkpoint)
+    predictor = model.rnn.predictor.open_loop_predictor
+    rnn = tf.keras.layers.RNN(predictor, return_sequences=True)
+    actions = tf.random.uniform([amount, horizon] + model.input_shape['action'][2:].as_list(), -1.0, 1.0)
+    initial_state = predictor.zero_state(amount, tf.float32)
+
+    @tf.function
+    def rnn_rollout() -> tf.Tensor:
+        return tf.reduce_sum(predictor.state_to_features(rnn(actions, initial_state=initial_state, training=False)))
+
+    @tf.function
+    def fused_rollout() -> tf.Tensor:
+        return tf.reduce_sum(predictor.state_to_features(predictor.rollout(actions, initial_state)))
+
+    @tf.function
+    def xla_rollout() -> tf.Tensor:
+        return tf.reduce_sum(predictor.state_to_features(predictor.rollout(actions, initial_state, xla=True)))
+
+    results = {}
+    for variant, func in [('rnn', rnn_rollout), ('fused', fused_rollout), ('fused_xla', xla_rollout)]:
+        time = time_repeated(lambda: func().numpy(), repeats)
+        results[variant] = {'time_per_rollout': time, 'steps_per_second': amount * horizon / time}
+    return results
+
+
+def random_batch(model: Model, batch_shape: Sequence[int]) -> Dict[str, tf.Tensor]:
+    """Random training data with the given batch shape for the model's data spec"""
+    batch = {}
+    for key, spec in model.input_spec.items():
+        shape = list(batch_shape) + tf.TensorShape(spec.shape)[2:].as_list()
+        dtype = tf.as_dtype(spec.dtype)
+        if key == 'length':
+            batch[key] = tf.fill(shape, tf.cast(batch_shape[1], dtype))
+        elif dtype.is_floating:
+            batch[key] = tf.random.uniform(shape, dtype=dtype)
+        else:
+            batch[key] = tf.zeros(shape, dtype)
+    return batch
+
+
+@register_benchmark('train_step')
+@gin.configurable('benchmark.train_step', whitelist=['batch_shape', 'repeats'])
+def train_step_benchmark(logdir: Path,
+                         checkpoint: Optional[Path],
+                         batch_shape: Tuple[int, int] = (64, 64),
+                         repeats: int = 10,
+                         ) -> Results:
+    """Compares training steps with one backward pass per optimizer and one per layer with its own loss"""
+    from .train import run_on_batch  # Avoid circular import
+    model = get_benchmark_model(checkpoint, batch_shape=batch_shape)
+    batch = random_batch(model, batch_shape)
+    results = {}
+    for variant, group_losses in [('per_optimizer', True), ('per_layer', False)]:
+        time = time_repeated(lambda: run_on_batch(model, batch, training=True, group_losses=group_losses)['loss'].numpy(),
+                             repeats)
+        results[variant] = {'step_time': time}
+    return results
+
+
+@register_benchmark('remat')
+@gin.configurable('benchmark.remat', whitelist=['batch_shape', 'segment_length', 'repeats'])
+def remat_benchmark(logdir: Path,
+                    checkpoint: Optional[Path],
+                    batch_shape: Tuple[int, int] = (64, 64),
+                    segment_length: int = 8,
+                    repeats: int = 10,
+                    ) -> Results:
+    """Measures the recomputation overhead of gradient checkpointing in the RSSM time loop and the imagination scan"""
+    from .train import run_on_batch  # Avoid circular import
+    parameters = ['SimpleRNN.checkpoint_segment_length', 'imagine_forward.checkpoint_segment_length']
+    original = {name: gin.query_parameter(name) for name in parameters}
+    results = {}
+    try:
+        for variant, length in [('baseline', None), ('checkpointed', segment_length)]:
+            with gin.unlock_config():
+                for name in parameters:
+                    gin.bind_parameter(name, length)
+            model = get_benchmark_model(checkpoint, batch_shape=batch_shape)
+            batch = random_batch(model, batch_shape)
+            time = time_repeated(lambda: run_on_batch(model, batch, training=True)['loss'].numpy(), repeats)
+            results[variant] = {'step_time': time}
+    finally:
+        with gin.unlock_config():
+            for name, value in original.items():
+                gin.bind_parameter(name, value)
+    results['checkpointed']['overhead'] = results['checkpointed']['step_time'] / results['baseline']['step_time'] - 1
+    return results
+
+
+@register_benchmark('xla')
+@gin.configurable('benchmark.xla', whitelist=['batch_shape', 'repeats'])
+def xla_benchmark(logdir: Path,
+                  checkpoint: Optional[Path],
+                  batch_shape: Tuple[int, int] = (64, 64),
+                  repeats: int = 10,
+                  ) -> Results:
+    """
+    Compares per-call latency of each function family with and without XLA compilation. XlaFunctions called from other
+    tf.functions are compiled or not when the caller is traced, so a new agent and planner are created for each variant.
+    """
+    from .train import run_on_batch  # Avoid circular import
+    model = get_benchmark_model(checkpoint, batch_shape=batch_shape)
+    batch = random_batch(model, batch_shape)
+    action_space = gym.spaces.Box(-1.0, 1.0, tuple(model.input_shape['action'][2:].as_list()), dtype=np.float32)
+    observations = {key: tf.zeros(tf.TensorShape(spec.shape)[2:], tf.as_dtype(spec.dtype))
+                    for key, spec in model.input_spec.items() if key in ['image', 'goal']}
+    action = tf.zeros(action_space.shape)
+    original = gin.query_parameter('xla.families')
+    results: Results = {family: {} for family in XLA_FAMILIES}
+    try:
+        for variant, families in [('plain', ()), ('xla', XLA_FAMILIES)]:
+            with gin.unlock_config():
+                gin.bind_parameter('xla.families', families)
+            agent = MPCAgent(action_space, model, planner=CrossEntropyMethod)
+            planner = CrossEntropyMethod.from_model(model, action_space)
+            calls = {'train_step': lambda: run_on_batch(model, batch, training=True)['loss'].numpy(),
+                     'planner': lambda: planner.get_action(agent.state).numpy(),
+                     'observe': lambda: agent.observe(observations, action),
+                     'act': lambda: agent.act().numpy()}
+            assert set(calls.keys()) == set(XLA_FAMILIES)
+            for family, func in calls.items():
+                results[family][f'latency_{variant}'] = time_repeated(func, repeats)
+    finally:
+        with gin.unlock_config():
+            gin.bind_parameter('xla.families', original)
+    for values in results.values():
+        values['speedup'] = values['latency_plain'] / values['latency_xla']
+    return results
+
+
+@register_benchmark('navigation')
+@gin.configurable('benchmark.navigation', whitelist=['steps', 'query_time'])
+def navigation_benchmark(logdir: Path,
+                         checkpoint: Optional[Path],
+                         steps: int = 1000,
+                         query_time: float = 1e-3,
+                         ) -> Results:
+    """
+    Compares the step rate of DummyHabitat with automatic stop and the configured reward function, with and without the
+    navigation cache. Pathfinder queries are emulated by sleeping for `query_time` seconds.
+    """
+    original = gin.query_parameter('NavigationCache.enabled')
+    results = {}
+    try:
+        for variant, enabled in [('uncached', False), ('cached', True)]:
+            with gin.unlock_config():
+                gin.bind_parameter('NavigationCache.enabled', enabled)
+            env = DummyHabitat(**get_config(training=True), query_time=query_time)
+            wrapped_env = AutomaticStop(env, enable=True)
+            wrapped_env.reset()
+            with Timer() as t:
+                for _ in range(steps):
+                    _, _, done, _ = wrapped_env.step(int(np.random.randint(wrapped_env.action_space.n)))
+                    if done:
+                        wrapped_env.reset()
+            results[variant] = {'steps_per_sec': steps / t.interval,
+                                'queries_per_step': env.sim.geodesic_distance.call_count / steps}
+    finally:
+        with gin.unlock_config():
+            gin.bind_parameter('NavigationCache.enabled', original)
+    results['cached']['speedup'] = results['cached']['steps_per_sec'] / results['uncached']['steps_per_sec']
+    return results
+
+
+def _dummy_env_ctor(*params: Tuple[str, object]) -> DummyHabitat:
+    return DummyHabitat(**dict(params))
+
+
+@register_benchmark('vector_env')
+@gin.configurable('benchmark.vector_env', whitelist=['steps', 'attr_repeats'])
+def vector_env_benchmark(logdir: Path,
+                         checkpoint: Optional[Path],
+                         steps: int = 1000,
+                         attr_repeats: int = 1000,
+                         ) -> Results:
+    """
+    Measures the per-step overhead of running DummyHabitat in a VectorHabitat worker process, with observations sent
+    through the pipe and through shared memory, relative to running it in this process. Also measures the latency of
+    reading a static attribute, with and without the attribute cache.
+    """
+    params = get_config(training=True)
+    local_env = DummyHabitat(**params)
+    local_env.reset()
+    local_step = time_repeated(lambda: local_env.step(0), steps)
+    results = {'local': {'step_time': local_step}}
+    for variant, shared_memory in [('pipe', False), ('shared_memory', True)]:
+        env = VectorHabitat(_dummy_env_ctor, params, shared_memory=shared_memory)
+        try:
+            env.reset()
+            step_time = time_repeated(lambda: env.step(0), steps)
+            results[variant] = {'step_time': step_time,
+                                'ipc_overhead': step_time - local_step,
+                                'attr_time': time_repeated(lambda: env.call_at(0, '__getattr__', {'name': 'success_distance'}),
+                                                           attr_repeats),
+                                'cached_attr_time': time_repeated(lambda: env.success_distance, attr_repeats)}
+        finally:
+            env.close()
+    results['shared_memory']['overhead_reduction'] = results['pipe']['ipc_overhead'] / results['shared_memory']['ipc_overhead']
+    return results
@@ -0,0 +1,228 @@
+# collector.py: Asynchronous data collection in worker processes
+#
+# (C) 2020, Daniel Mouritzen
+
+import atexit
+import itertools
+import multiprocessing as mp
+import os
+import pickle
+import queue
+import random
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Mapping, NamedTuple, Optional, Sequence, Type
+
+import gin
+import tensorflow as tf
+from loguru import logger
+
+from project.agents import ModelBasedAgent
+from project.model import Model, get_model
+from project.tasks import Task
+from project.util.planet.numpy_episodes import import_npz_episodes
+from project.util.timing import Timer
+
+from .simulator import Simulator
+
+
+class CollectionResult(NamedTuple):
+    worker: int
+    task: str
+    phase: str
+    version: int
+    steps: int
+    duration: float
+    metrics: Dict[str, float]
+
+
+@gin.configurable('async_collection', whitelist=['num_workers', 'train_episodes', 'test_episodes', 'max_staleness',
+                                                 'keep_snapshots', 'use_gpu'])
+class AsyncCollector:
+    """
+    Collects episodes in `num_workers` worker processes per task while the model is trained. Each worker runs its own
+    environment and a copy of the model, and writes episodes to the dataset directories, where the training data
+    loaders pick them up. Workers collect `train_episodes` training episodes for every `test_episodes` test episodes.
+
+    The learner publishes weight snapshots with publish(), and workers load the newest snapshot before each episode. If
+    `max_staleness` is set, wait_for_workers() blocks until no worker is running an episode with weights more than that
+    many snapshots older than the newest one.
+
+    The worker processes are forked, so the collector must be created before TF is initialized in this process. Workers
+    run on CPU unless `use_gpu` is set. If `num_workers` is 0, no workers are started.
+
+    An EpisodeStore only allows a single writer, so workers only write NPZ files. If CollectGymDataset.episode_store is
+    enabled, results() appends the new episodes to the stores from this process.
+    """
+    def __init__(self,
+                 tasks: Sequence[Task],
+                 agent_cls: Type[ModelBasedAgent],
+                 dirs: Mapping[str, Path],
+                 snapshot_dir: Path,
+                 num_workers: int = 0,
+                 train_episodes: int = 5,
+                 test_episodes: int = 1,
+                 max_staleness: Optional[int] = 1,
+                 keep_snapshots: int = 3,
+                 use_gpu: bool = False,
+                 ) -> None:
+        self._dirs = dirs
+        self._episode_store = _episode_store_enabled()
+        self._snapshot_dir = snapshot_dir
+        self._max_staleness = max_staleness
+        self._keep_snapshots = keep_snapshots
+        self._snapshots: List[Path] = []
+        ctx = mp.get_context('fork')
+        self._version = ctx.Value('i', -1)
+        self._worker_versions = ctx.Array('i', [-1] * num_workers * len(tasks))
+        self._results: 'mp.Queue[CollectionResult]' = ctx.Queue()
+        self._stop = ctx.Event()
+        phases = ['train'] * train_episodes + ['test'] * test_episodes
+        seed = random.randrange(2 ** 31 - num_workers * len(tasks))
+        self._workers = [ctx.Process(target=_collection_worker,
+                                     name=f'collector_{task.name}_{i}',
+                                     args=(index,
+                                           task,
+                                           agent_cls,
+                                           dirs,
+                                           phases,
+                                           self._snapshot_dir,
+                                           self._version,
+                                           self._worker_versions,
+                                           self._results,
+                                           self._stop,
+                                           seed + index,
+                                           use_gpu))
+                         for index, (task, i) in enumerate(itertools.product(tasks, range(num_workers)))]
+        if self._workers:
+            self._snapshot_dir.mkdir(parents=True, exist_ok=True)
+            logger.info(f'Starting {len(self._workers)} data collection workers.')
+            atexit.register(self.close)  # Runs before multiprocessing joins the workers at exit
+        for worker in self._workers:
+            worker.start()
+
+    @property
+    def num_workers(self) -> int:
+        return len(self._workers)
+
+    @property
+    def version(self) -> int:
+        """Version of the newest published snapshot, or -1 if none have been published"""
+        return self._version.value
+
+    def publish(self, model: Model) -> None:
+        """Save a snapshot of the model's weights for the workers. Old snapshots are deleted."""
+        version = self.version + 1
+        if version == 0:
+            # Workers should never see partially written files, so they are written under a temporary name first
+            additional_data_file = self._snapshot_dir / 'checkpoint_additional_data.pickle'
+            tmp_file = additional_data_file.with_suffix('.tmp')
+            with open(tmp_file, 'wb') as f:
+                pickle.dump(model.additional_data, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp_file, additional_data_file)
+        path = self._snapshot_dir / f'snapshot_{version:06d}.h5'
+        tmp_path = path.with_suffix('.tmp.h5')
+        # Model.save_weights would also rewrite the additional data, which workers may be reading
+        tf.keras.Model.save_weights(model, str(tmp_path))
+        os.replace(tmp_path, path)
+        self._version.value = version
+        self._snapshots.append(path)
+        while len(self._snapshots) > self._keep_snapshots:
+            self._snapshots.pop(0).unlink()
+
+    def wait_for_workers(self, timeout: float = 600.0) -> float:
+        """Wait until all workers satisfy the staleness bound. Returns the time spent waiting."""
+        with Timer() as t:
+            if self._max_staleness is not None:
+                min_version = self.version - self._max_staleness
+                while min(self._worker_versions[:], default=min_version) < min_version:
+                    self._check_workers()
+                    if time.perf_counter() - t.start > timeout:
+                        logger.warning(f'Data collection workers are still using weights older than version {min_version} '
+                                       f'after {timeout:.0f}s, continuing training.')
+                        break
+                    time.sleep(0.1)
+        return t.interval
+
+    def results(self) -> List[CollectionResult]:
+        """All results received since the last call. Their episodes are added to the episode stores if enabled."""
+        self._check_workers()
+        results = []
+        while True:
+            try:
+                results.append(self._results.get_nowait())
+            except queue.Empty:
+                break
+        if self._episode_store:
+            for phase in sorted({result.phase for result in results}):
+                import_npz_episodes(str(self._dirs[phase]))
+        return results
+
+    def close(self, timeout: float = 60.0) -> None:
+        """Stop the workers. Episodes in progress are finished first, unless they take longer than `timeout`."""
+        self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout)
+            if worker.is_alive():
+                logger.warning(f'Terminating data collection worker {worker.name}.')
+                worker.terminate()
+        self._workers = []
+
+    def _check_workers(self) -> None:
+        for worker in self._workers:
+            if not worker.is_alive():
+                raise RuntimeError(f'Data collection worker {worker.name} died with exit code {worker.exitcode}')
+
+
+def _collection_worker(index: int,
+                       task: Task,
+                       agent_cls: Type[ModelBasedAgent],
+                       dirs: Mapping[str, Path],
+                       phases: Sequence[str],
+                       snapshot_dir: Path,
+                       version: Any,
+                       worker_versions: Any,
+                       results: 'mp.Queue[CollectionResult]',
+                       stop: Any,
+                       seed: int,
+                       use_gpu: bool,
+                       ) -> None:
+    if not use_gpu:
+        # Only hide the GPUs from TF, since habitat-sim renders on the GPU
+        tf.config.experimental.set_visible_devices([], 'GPU')
+    with gin.unlock_config():
+        gin.bind_parameter('CollectGymDataset.episode_store', False)  # The learner appends our episodes to the store
+    sim = Simulator(task)
+    sim.seed(seed)
+    model: Optional[Model] = None
+    agent = None
+    loaded = -1
+    for phase in itertools.cycle(phases):
+        while version.value < 0 and not stop.is_set():
+            time.sleep(0.1)
+        if stop.is_set():
+            break
+        if version.value != loaded:
+            if model is None:
+                model = _build_model(snapshot_dir)
+                agent = agent_cls(sim.action_space, model, batch_size=1)
+            # Read after building the model, since old snapshots may have been deleted in the meantime
+            loaded = version.value
+            model.load_weights(str(snapshot_dir / f'snapshot_{loaded:06d}.h5'), by_name=True)
+            worker_versions[index] = loaded
+        with Timer() as t:
+            metrics = sim.run(agent, 1, save_dir=dirs[phase], save_data=True, count=phase == 'train')
+        results.put(CollectionResult(index, task.name, phase, loaded, int(metrics['steps']), t.interval, metrics))
+
+
+def _episode_store_enabled() -> bool:
+    try:
+        return bool(gin.query_parameter('CollectGymDataset.episode_store'))
+    except ValueError:  # Not bound in the config
+        return False
+
+
+def _build_model(snapshot_dir: Path) -> Model:
+    with open(snapshot_dir / 'checkpoint_additional_data.pickle', 'rb') as f:
+        additional_data = pickle.load(f)
+    return get_model(**additional_data)
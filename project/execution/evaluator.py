@@ -45,6 +45,36 @@ class Evaluator:
                  sync_wandb: bool = True,
                  ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, List[wandb.Video]]]:
         """Evaluate trained model in all environments."""
+        mean_metrics, video_files = self.run(checkpoint, baseline, agents, num_episodes, visualize_planner, seed)
+        videos = {task: [wandb.Video(str(vid), fps=10, format="mp4") for vid in task_videos]
+                  for task, task_videos in video_files.items()}
+
+        if sync_wandb:
+            # First delete existing summary items
+            for k in list(wandb.run.summary._json_dict.keys()):
+                wandb.run.summary._root_del((k,))
+            wandb.run.summary.update(mean_metrics)
+            wandb.run.summary['seed'] = seed
+            if self.video:
+                for task, task_videos in videos.items():
+                    for i, vid in enumerate(task_videos):
+                        wandb.run.summary[f'{task}/video_{i}'] = vid
+
+        return mean_metrics, videos
+
+    def run(self,
+            checkpoint: Optional[Path] = None,
+            baseline: Optional[str] = None,
+            agents: Optional[Mapping[str, Agent]] = None,
+            num_episodes: int = 10,
+            visualize_planner: bool = False,
+            seed: Optional[int] = None,
+            save_dir: Optional[Path] = None,
+            ) -> Tuple[Dict[str, Dict[str, float]], Dict[str, List[Path]]]:
+        """
+        Run the evaluation episodes without touching wandb. Returns the mean metrics and the video files for each task.
+        Episode data is saved in a timestamped directory for each task in `save_dir`, which defaults to logdir/eval.
+        """
         assert [checkpoint, baseline, agents].count(None) == 2, 'Exactly one of checkpoint, baseline and agents must be provided'
 
         mean_metrics = {}
@@ -56,7 +86,7 @@ class Evaluator:
                 # TODO: Make deterministic mode work again
                 sim.seed(seed)
 
-            save_dir = self.logdir / 'eval' / task / f'{datetime.now():%Y%m%d-%H%M%S}'
+            task_dir = (save_dir or self.logdir / 'eval') / task / f'{datetime.now():%Y%m%d-%H%M%S}'
 
             get_distribution_strategy()
             if agents is not None:
@@ -65,22 +95,10 @@ class Evaluator:
                 agent = self.get_agent(sim.action_space, checkpoint, baseline)
             if isinstance(agent, MPCAgent):
                 agent.visualize = visualize_planner  # type: ignore[misc]  # mypy/issues/1362
-            mean_metrics[task] = sim.run(agent, num_episodes, log=True, save_dir=save_dir, save_video=self.video)
+            mean_metrics[task] = sim.run(agent, num_episodes, log=True, save_dir=task_dir, save_video=self.video)
 
             if self.video:
-                videos[task] = [wandb.Video(str(vid), fps=10, format="mp4") for vid in save_dir.glob('*.mp4')]
-
-        if sync_wandb:
-            # First delete existing summary items
-            for k in list(wandb.run.summary._json_dict.keys()):
-                wandb.run.summary._root_del((k,))
-            wandb.run.summary.update(mean_metrics)
-            wandb.run.summary['seed'] = seed
-            if self.video:
-                for task, task_videos in videos.items():
-                    for i, vid in enumerate(task_videos):
-                        wandb.run.summary[f'{task}/video_{i}'] = vid
-
+                videos[task] = sorted(task_dir.glob('*.mp4'))
         return mean_metrics, videos
 
     def get_agent(self,
@@ -3,8 +3,10 @@
 # (C) 2019, Daniel Mouritzen
 
 import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Set, Tuple, Union, cast
+from typing import Any, Dict, List, Set, Tuple, Union, cast
 
 import gym
 import gym.spaces
@@ -16,7 +18,7 @@ from project.agents import Agent
 from project.environments import wrappers
 from project.tasks import Task
 from project.util import PrettyPrinter, Statistics
-from project.util.planet.preprocess import preprocess
+from project.util.planet.preprocess import device_preprocessing, preprocess
 from project.util.tf import tf_nested_py_func
 from project.util.timing import Timer
 from project.util.typing import Observations, ObsTuple
@@ -34,6 +36,8 @@ class Simulator:
         self._metrics = list(task.metrics)
         self._seen_scenes: Set[str] = set()
         self._steps_seen = 0
+        self._scene_loads = 0
+        self._scene_load_time = 0.0
 
     @property
     def action_space(self) -> gym.Space:
@@ -51,6 +55,19 @@ class Simulator:
     def scenes_seen(self) -> int:
         return len(self._seen_scenes)
 
+    @property
+    def scene_loads(self) -> int:
+        """Number of scene loads, counted like steps_seen"""
+        return self._scene_loads
+
+    @property
+    def scene_load_time(self) -> float:
+        """Total time spent loading scenes in seconds, counted like steps_seen"""
+        return self._scene_load_time
+
+    def close(self) -> None:
+        self._env.close()
+
     def seed(self, seed: int) -> None:
         random.seed(seed)
         np.random.seed(seed)
@@ -82,6 +99,7 @@ class Simulator:
         Returns:
             Dict of mean metrics, including number of steps, score (total reward) and planning time
         """
+        assert agent.batch_size == 1, 'Use BatchedSimulator for agents with batch size > 1.'
         assert not ((save_data or save_video) and save_dir is None), 'Can\'t save data or videos without save_dir.'
         save_path = None if save_dir is None else Path(save_dir)
         if save_path is not None:
@@ -91,8 +109,9 @@ class Simulator:
         log_fn = logger.info if log else logger.trace
         log_fn(f'Simulating {num_episodes} episodes closed-loop.')
         statistics_file = save_path / 'eval.csv' if log and save_path else None
-        statistics = Statistics(['steps', 'score', 'plan_time', 'obs_time'] + self._metrics, save_file=statistics_file)
-        pp = PrettyPrinter(['episode', 'steps', 'score', 'plan_time', 'obs_time'] + self._metrics, log_fn=log_fn)
+        keys = ['steps', 'score', 'plan_time'] + list(agent.plan_statistics.keys()) + ['obs_time'] + self._metrics
+        statistics = Statistics(keys, save_file=statistics_file)
+        pp = PrettyPrinter(['episode'] + keys, log_fn=log_fn)
         pp.print_header()
         for episode in range(num_episodes):
             steps, score, metrics = self.run_episode(env, agent, count)
@@ -111,13 +130,15 @@ class Simulator:
         Returns:
             The episode duration in steps
             The total reward
-            The metrics received in the last step (plus the mean planning time per step as `metrics['plan_time']`)
+            The metrics received in the last step (plus the mean planning time per step as `metrics['plan_time']` and
+            the mean of each of the agent's plan_statistics)
         """
         done = tf.constant(False)
         score = tf.constant(0.0, tf.float32)
         steps = tf.constant(0, tf.int16)
         obs_time = tf.constant(0.0, tf.float32)
         plan_time = tf.constant(0.0, tf.float32)
+        plan_statistics = {k: tf.constant(0.0, tf.float32) for k in agent.plan_statistics.keys()}
         metrics: Dict[str, tf.Tensor] = {}
 
         agent.reset()
@@ -129,6 +150,8 @@ class Simulator:
             with Timer() as t:
                 action = agent.act()
             plan_time += t.interval
+            for k, v in agent.plan_statistics.items():
+                plan_statistics[k] += tf.cast(v, tf.float32)
             obs, reward, done, metrics = self._tf_step_env(env, action, count)
             score += reward
             steps += 1
@@ -136,6 +159,7 @@ class Simulator:
 
         metrics['obs_time'] = obs_time / tf.cast(steps, tf.float32)
         metrics['plan_time'] = plan_time / tf.cast(steps, tf.float32)
+        metrics.update({k: v / tf.cast(steps, tf.float32) for k, v in plan_statistics.items()})
         return steps, score, metrics
 
     def _select_obs(self, obs: Observations) -> Observations:
@@ -150,12 +174,18 @@ class Simulator:
             self._steps_seen += 1
             if 'scene' in info:
                 self._seen_scenes.add(info['scene'])
+            if info.get('scene_load_time'):
+                self._scene_loads += 1
+                self._scene_load_time += info['scene_load_time']
         obs, metrics = tf.nest.map_structure(lambda x: np.float32(x), (obs, metrics))
         return obs, reward, done, metrics
 
     @staticmethod
     def _tf_process_obs(obs: TensorObs) -> TensorObs:
-        obs['image'] = preprocess(obs['image'])
+        if device_preprocessing():
+            obs['image'] = tf.cast(obs['image'], tf.uint8)
+        else:
+            obs['image'] = preprocess(obs['image'])
         return obs
 
     def _tf_reset_env(self, env: gym.Env) -> TensorObs:
@@ -186,3 +216,134 @@ class Simulator:
         if isinstance(space, gym.spaces.Dict):
             return {k: Simulator._parse_dtype(v) for k, v in space.spaces.items()}
         raise NotImplementedError(f"Unsupported space '{space}.'")
+
+
+class BatchedSimulator(Simulator):
+    """
+    Runs `num_envs` environments in lockstep, with a single agent of batch size `num_envs` acting in all of them.
+
+    Environments are stepped in parallel from a thread pool, which gives true parallelism for environments running in
+    their own processes (like VectorHabitat). Finished episodes are recorded and the corresponding environment and agent
+    state are reset, until the requested number of episodes has been started.
+    """
+    def __init__(self, task: Task, num_envs: int, **kwargs: Any) -> None:
+        super().__init__(task, **kwargs)
+        self._envs = [self._env] + [wrappers.SelectObservations(task.env_ctor(**kwargs), task.observation_components)
+                                    for _ in range(num_envs - 1)]
+        self._executor = ThreadPoolExecutor(max_workers=num_envs)
+        self._lock = threading.Lock()
+
+    @property
+    def num_envs(self) -> int:
+        return len(self._envs)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+        for env in self._envs:
+            env.close()
+
+    def seed(self, seed: int) -> None:
+        super().seed(seed)
+        for i, env in enumerate(self._envs[1:], 1):
+            if hasattr(env, 'seed'):
+                env.seed(seed + i)
+
+    def run(self,
+            agent: Agent,
+            num_episodes: int = 1,
+            log: bool = False,
+            save_dir: Union[None, str, Path] = None,
+            save_data: bool = False,
+            save_video: bool = False,
+            count: bool = False,
+            ) -> Dict[str, float]:
+        """Same as Simulator.run, except that videos are not supported and the agent must have batch size num_envs"""
+        assert agent.batch_size == self.num_envs, f'Agent batch size {agent.batch_size} does not match {self.num_envs} envs.'
+        assert not save_video, 'BatchedSimulator does not support saving videos.'
+        assert not (save_data and save_dir is None), 'Can\'t save data without save_dir.'
+        save_path = None if save_dir is None else Path(save_dir)
+        if save_path is not None:
+            save_path.mkdir(parents=True, exist_ok=True)
+        envs: List[gym.Env] = self._envs
+        if save_data:
+            # The environments are stepped concurrently, so their episodes must go through a single EpisodeStore
+            first_env = wrappers.CollectGymDataset(self._envs[0], str(save_path))
+            envs = [first_env] + [wrappers.CollectGymDataset(env, str(save_path), store=first_env.store) for env in self._envs[1:]]
+
+        log_fn = logger.info if log else logger.trace
+        log_fn(f'Simulating {num_episodes} episodes closed-loop in {self.num_envs} environments.')
+        statistics_file = save_path / 'eval.csv' if log and save_path else None
+        keys = ['steps', 'score', 'plan_time'] + list(agent.plan_statistics.keys()) + ['obs_time'] + self._metrics
+        statistics = Statistics(keys, save_file=statistics_file)
+        pp = PrettyPrinter(['episode'] + keys, log_fn=log_fn)
+        pp.print_header()
+
+        num_started = min(num_episodes, self.num_envs)
+        active = np.arange(self.num_envs) < num_started
+        steps = np.zeros([self.num_envs], np.int32)
+        scores = np.zeros([self.num_envs], np.float32)
+        plan_times = np.zeros([self.num_envs], np.float32)
+        plan_statistics = {k: np.zeros([self.num_envs], np.float32) for k in agent.plan_statistics.keys()}
+        obs_times = np.zeros([self.num_envs], np.float32)
+        observations = list(self._executor.map(lambda env: self._select_obs(env.reset()), envs))
+        agent.reset()
+        with Timer() as t:
+            agent.observe(self._batch_obs(observations), action=None)
+        obs_times += t.interval
+        episode = 0
+        while active.any():
+            with Timer() as t:
+                actions = agent.act().numpy()
+            plan_times[active] += t.interval
+            for k, v in agent.plan_statistics.items():
+                plan_statistics[k][active] += float(v.numpy())
+            outputs = list(self._executor.map(lambda i: self._process_step(envs[i].step(actions[i]), count) if active[i] else None,
+                                              range(self.num_envs)))
+            resets = np.zeros([self.num_envs], bool)
+            for i, output in enumerate(outputs):
+                if output is None:
+                    continue
+                obs, reward, done, metrics = output
+                observations[i] = obs
+                steps[i] += 1
+                scores[i] += reward
+                if done:
+                    row = dict(steps=steps[i],
+                               score=scores[i],
+                               plan_time=plan_times[i] / steps[i],
+                               **{k: v[i] / steps[i] for k, v in plan_statistics.items()},
+                               obs_time=obs_times[i] / steps[i],
+                               **metrics)
+                    statistics.update(row)
+                    pp.print_row(dict(episode=episode, **row))
+                    episode += 1
+                    steps[i], scores[i], plan_times[i], obs_times[i] = 0, 0.0, 0.0, 0.0
+                    for v in plan_statistics.values():
+                        v[i] = 0.0
+                    if num_started < num_episodes:
+                        num_started += 1
+                        resets[i] = True
+                    else:
+                        active[i] = False
+            if resets.any():
+                reset_obs = self._executor.map(lambda i: self._select_obs(envs[i].reset()), np.flatnonzero(resets))
+                for i, obs in zip(np.flatnonzero(resets), reset_obs):
+                    observations[i] = obs
+                agent.reset(tf.constant(resets))
+            # Episodes that were just reset get a zero action, like the first observation in Simulator.run_episode
+            actions = np.where(resets.reshape([-1] + [1] * (actions.ndim - 1)), np.zeros_like(actions), actions)
+            with Timer() as t:
+                agent.observe(self._batch_obs(observations), tf.convert_to_tensor(actions))
+            obs_times[active] += t.interval
+        log_fn('Results:')
+        statistics.print(log_fn=log_fn)
+        return statistics.mean
+
+    def _process_step(self, output: ObsTuple, count: bool) -> ObsTuple:
+        with self._lock:  # Called from multiple threads
+            return super()._process_step(output, count)
+
+    def _batch_obs(self, observations: List[Observations]) -> TensorObs:
+        batch = tf.nest.map_structure(lambda *obs: tf.convert_to_tensor(np.stack(obs)), *observations)
+        batch = tf.nest.map_structure(lambda t, dtype: tf.cast(t, dtype), batch, self._observation_dtypes)
+        return self._tf_process_obs(batch)
@@ -2,14 +2,16 @@
 #
 # (C) 2019, Daniel Mouritzen
 
+import weakref
 from pathlib import Path
-from typing import Any, Dict, Iterator, Mapping, Optional, Sequence, Tuple, Type
+from typing import Any, Dict, Iterator, List, Mapping, Optional, Sequence, Tuple, Type
 
 import gin
 import tensorflow as tf
 from loguru import logger
 from tensorflow.python.keras.callbacks import configure_callbacks
 from tensorflow.python.keras.engine.training_v2 import TrainingContext
+from tensorflow.python.keras.mixed_precision.experimental.loss_scale_optimizer import LossScaleOptimizer
 from tensorflow.python.keras.utils.mode_keys import ModeKeys
 
 from project.agents import ModelBasedAgent, RandomAgent
@@ -17,22 +19,31 @@ from project.model import get_model, restore_model
 from project.tasks import Task
 from project.util.files import link_directory_contents
 from project.util.planet.numpy_episodes import numpy_episodes
+from project.util.planet.prioritized_sampler import needs_episode_losses, report_episode_losses
 from project.util.tf import get_distribution_strategy, reshape_known_dims, trace_graph
-from project.util.tf.callbacks import (CheckpointCallback,
+from project.util.tf.callbacks import (AsyncCollectionCallback,
+                                       AsyncEvaluateCallback,
+                                       CheckpointCallback,
                                        DataCollectionCallback,
                                        EvaluateCallback,
                                        LoggingCallback,
                                        PredictionSummariesCallback,
-                                       WandbCommitCallback)
-from project.util.timing import measure_time
+                                       ProfilerCallback,
+                                       WandbCommitCallback,
+                                       profile_callbacks)
+from project.util.tf.compilation import xla_function
+from project.util.tf.optimizers import GradientAccumulator
+from project.util.timing import Timer, measure_time
 
+from .async_evaluator import AsyncEvaluator
+from .collector import AsyncCollector
 from .evaluator import Evaluator, get_evaluation_agent
-from .simulator import Simulator
+from .simulator import BatchedSimulator, Simulator
 
 
 @measure_time
 @gin.configurable('training', whitelist=['tasks', 'num_seed_episodes', 'num_epochs', 'train_steps', 'test_steps',
-                                         'batch_shape', 'agent_cls'])
+                                         'batch_shape', 'agent_cls', 'num_collection_envs'])
 def train(logdir: Path,
           initial_data: Optional[str],
           checkpoint: Optional[Path] = None,
@@ -43,15 +54,27 @@ def train(logdir: Path,
           test_steps: int = gin.REQUIRED,
           batch_shape: Tuple[int, int] = (64, 64),
           agent_cls: Type[ModelBasedAgent] = gin.REQUIRED,
+          num_collection_envs: int = 1,
           ) -> None:
-    logger.info('Creating training environments.')
-    sims = {task.name: Simulator(task) for task in tasks}
-    evaluator = Evaluator(logdir=logdir, video=True)
+    dataset_dirs = {name: logdir / f'{name}_episodes' for name in ['train', 'test']}
+    # Collection workers are forked before TF is initialized, and don't start collecting until training begins
+    collector = AsyncCollector(tasks, agent_cls, dataset_dirs, logdir / 'collection_snapshots')
 
+    # The strategy is created next, since logical devices can only be configured before any TF ops are run
     distribution_strategy = get_distribution_strategy()
-    batch_shape = (distribution_strategy.num_replicas_in_sync * batch_shape[0], batch_shape[1])
+    # batch_shape is global, and the distributed dataset splits it evenly between replicas
+    assert batch_shape[0] % distribution_strategy.num_replicas_in_sync == 0, (
+        f'Batch size {batch_shape[0]} is not divisible by {distribution_strategy.num_replicas_in_sync} replicas')
+
+    # With asynchronous collection, the workers run their own environments, so these are only needed for seed episodes
+    sims: Dict[str, Simulator] = {}
+    if not collector.num_workers or not initial_data:
+        logger.info('Creating training environments.')
+        sims = {task.name: BatchedSimulator(task, num_collection_envs) if num_collection_envs > 1 else Simulator(task)
+                for task in tasks}
+    async_evaluator = AsyncEvaluator(logdir)
+    evaluator = None if async_evaluator.enabled else Evaluator(logdir=logdir, video=True)
 
-    dataset_dirs = {name: logdir / f'{name}_episodes' for name in ['train', 'test']}
     if initial_data:
         logger.info('Linking initial dataset.')
         for dataset in dataset_dirs.values():
@@ -60,25 +83,38 @@ def train(logdir: Path,
         for task, sim in sims.items():
             for phase, save_dir in dataset_dirs.items():
                 logger.info(f'Collecting {num_seed_episodes} initial episodes ({task} {phase}).')
-                sim.run(RandomAgent(sim.action_space), num_seed_episodes, save_dir=save_dir, save_data=True)
+                sim.run(RandomAgent(sim.action_space, batch_size=num_collection_envs),
+                        num_seed_episodes,
+                        save_dir=save_dir,
+                        save_data=True)
+    if collector.num_workers:
+        for sim in sims.values():
+            sim.close()
+        sims.clear()
 
     train_data, test_data = numpy_episodes(dataset_dirs['train'], dataset_dirs['test'], batch_shape)
     observation_components = {name for task in tasks for name in task.observation_components}
 
     writer = tf.summary.create_file_writer(str(logdir / 'tb_logs' / 'train'))
-    if checkpoint is None:
-        with trace_graph(writer):
-            model = get_model(observation_components, train_data.element_spec)
-        start_epoch = 0
-    else:
-        model, start_epoch = restore_model(checkpoint, logdir)
+    with distribution_strategy.scope():
+        if checkpoint is None:
+            with trace_graph(writer):
+                data_spec = {k: v for k, v in train_data.element_spec.items() if k != 'episode_index'}
+                model = get_model(observation_components, data_spec)
+            start_epoch = 0
+        else:
+            model, start_epoch = restore_model(checkpoint, logdir)
     model.summary(line_length=100, print_fn=logger.debug)
     # model.encoder.layer.layer._image_enc.summary(line_length=100, print_fn=logger.debug)
     # model.decoders['image'].layer._decoder.summary(line_length=100, print_fn=logger.debug)
 
-    train_agents = {task_name: agent_cls(sim.action_space, model) for task_name, sim in sims.items()}
-    eval_agents = {task_name: get_evaluation_agent(agent.action_space, model, train_agent=agent)
-                   for task_name, agent in train_agents.items()}
+    train_agents = {task_name: agent_cls(sim.action_space, model, batch_size=num_collection_envs)
+                    for task_name, sim in sims.items()}
+    # Evaluation runs a single environment, so batched training agents can't be reused
+    reusable_agents = {task_name: agent for task_name, agent in train_agents.items() if agent.batch_size == 1}
+    eval_sims = evaluator.sims if evaluator is not None else {}
+    eval_agents = {task_name: get_evaluation_agent(sim.action_space, model, train_agent=reusable_agents.get(task_name))
+                   for task_name, sim in eval_sims.items()}
 
     logger.info('Training...')
     callbacks = [
@@ -90,9 +126,10 @@ def train(logdir: Path,
                                        update_freq='epoch'),
         CheckpointCallback(filepath=str(logdir / 'checkpoint_epoch_{epoch:03d}_loss_{val_loss:.2f}.h5'),
                            verbose=1),
-        DataCollectionCallback(sims, train_agents, dataset_dirs),
-        EvaluateCallback(evaluator, eval_agents),
+        AsyncCollectionCallback(collector) if collector.num_workers else DataCollectionCallback(sims, train_agents, dataset_dirs),
+        AsyncEvaluateCallback(async_evaluator) if evaluator is None else EvaluateCallback(evaluator, eval_agents),
         PredictionSummariesCallback(model, dataset_dirs),
+        ProfilerCallback(logdir / 'profile.csv'),
         WandbCommitCallback(),
     ]
     fit_model(model=model,
@@ -103,7 +140,10 @@ def train(logdir: Path,
               steps_per_epoch=train_steps,
               validation_steps=test_steps,
               validation_freq=1,
-              callbacks=callbacks)
+              callbacks=callbacks,
+              distribution_strategy=distribution_strategy)
+    for sim in sims.values():
+        sim.close()
 
     logger.success('Run completed.')
 
@@ -118,10 +158,22 @@ def fit_model(model: tf.keras.Model,
               validation_steps: int,
               validation_freq: int,
               callbacks: Sequence[tf.keras.callbacks.Callback],
+              distribution_strategy: Optional[tf.distribute.Strategy] = None,
               ) -> None:
+    """
+    Training loop. With a multi-replica distribution strategy, each batch of the datasets is split between the replicas,
+    which compute gradients in parallel. These are averaged over replicas before being applied.
+
+    The time spent waiting for data, running steps, validating and in each callback is recorded by the global profiler.
+    """
+    distribution_strategy = distribution_strategy or tf.distribute.get_strategy()
+    if distribution_strategy.num_replicas_in_sync > 1:
+        train_data = distribution_strategy.experimental_distribute_dataset(train_data)
+        val_data = distribution_strategy.experimental_distribute_dataset(val_data)
     train_context = TrainingContext()
     train_data_iter = iter(train_data)
     val_data_iter = iter(val_data)
+    profile_callbacks(callbacks)
     train_callbacks = configure_callbacks(callbacks,
                                           model,
                                           epochs=epochs,
@@ -139,29 +191,32 @@ def fit_model(model: tf.keras.Model,
                                              train_data_iter,
                                              steps_per_epoch=steps_per_epoch,
                                              mode=ModeKeys.TRAIN,
-                                             context=train_context)
+                                             context=train_context,
+                                             distribution_strategy=distribution_strategy)
                 if train_result is not None:
                     epoch_logs.update(train_result)
                 if train_callbacks.model.stop_training:
                     break
                 if (epoch + 1) % validation_freq == 0:
-                    validation_callbacks = configure_callbacks(train_callbacks,
-                                                               model,
-                                                               epochs=1,
-                                                               steps_per_epoch=validation_steps,
-                                                               samples=validation_steps,
-                                                               verbose=0,
-                                                               mode=ModeKeys.TEST)
-                    val_context = TrainingContext()
-                    with val_context.on_start(model, validation_callbacks, use_samples=False, mode=ModeKeys.TEST):
-                        with val_context.on_epoch(epoch, ModeKeys.TEST):
-                            val_result = run_one_epoch(model,
-                                                       val_data_iter,
-                                                       steps_per_epoch=validation_steps,
-                                                       mode=ModeKeys.TEST,
-                                                       context=val_context)
-                            if val_result is not None:
-                                epoch_logs.update({f'val_{k}': v for k, v in val_result.items()})
+                    with Timer('validation'):
+                        validation_callbacks = configure_callbacks(train_callbacks,
+                                                                   model,
+                                                                   epochs=1,
+                                                                   steps_per_epoch=validation_steps,
+                                                                   samples=validation_steps,
+                                                                   verbose=0,
+                                                                   mode=ModeKeys.TEST)
+                        val_context = TrainingContext()
+                        with val_context.on_start(model, validation_callbacks, use_samples=False, mode=ModeKeys.TEST):
+                            with val_context.on_epoch(epoch, ModeKeys.TEST):
+                                val_result = run_one_epoch(model,
+                                                           val_data_iter,
+                                                           steps_per_epoch=validation_steps,
+                                                           mode=ModeKeys.TEST,
+                                                           context=val_context,
+                                                           distribution_strategy=distribution_strategy)
+                                if val_result is not None:
+                                    epoch_logs.update({f'val_{k}': v for k, v in val_result.items()})
 
 
 def run_one_epoch(model: tf.keras.Model,
@@ -169,54 +224,269 @@ def run_one_epoch(model: tf.keras.Model,
                   steps_per_epoch: int,
                   mode: str,
                   context: TrainingContext,
+                  distribution_strategy: Optional[tf.distribute.Strategy] = None,
                   ) -> Optional[Dict[str, float]]:
+    distribution_strategy = distribution_strategy or tf.distribute.get_strategy()
     model.reset_metrics()
     metrics = None
     for step in range(steps_per_epoch):
         with context.on_batch(step=step, mode=mode) as batch_logs:
-            inputs = next(iterator)
-            metrics = run_on_batch(model, inputs, training=mode == ModeKeys.TRAIN)
+            with Timer(f'{mode}/data_wait'):
+                inputs = dict(next(iterator))
+            episode_index = inputs.pop('episode_index', None)
+            report_losses = episode_index is not None and mode == ModeKeys.TRAIN and needs_episode_losses('train')
+            with Timer(f'{mode}/step') as t:
+                with distribution_strategy.scope():
+                    metrics = run_on_batch(model, inputs, training=mode == ModeKeys.TRAIN, sequence_losses=report_losses)
+                metrics = {k: v.numpy() for k, v in metrics.items()}  # Wait for the step to finish
+            metrics['step_time'] = t.interval
+            if report_losses:
+                episode_index = tf.concat(distribution_strategy.experimental_local_results(episode_index), axis=0)
+                report_episode_losses('train', episode_index[:, 0].numpy(), metrics.pop('sequence_loss'))
             batch_logs.update(metrics)
         if context.callbacks.model.stop_training:
             break
     return metrics
 
 
-@gin.configurable(whitelist=['gradient_clip_norm'])
-@tf.function
+@gin.configurable(whitelist=['gradient_clip_norm', 'micro_batches', 'profile_phases'])
 def run_on_batch(model: tf.keras.Model,
                  inputs: Mapping[str, tf.Tensor],
                  training: bool = False,
                  gradient_clip_norm: Optional[float] = None,
+                 group_losses: bool = True,
+                 micro_batches: int = 1,
+                 profile_phases: bool = False,
+                 sequence_losses: bool = False,
                  ) -> Dict[str, tf.Tensor]:
-    """Runs a single training or validation step on a single batch of data."""
+    """
+    Runs a single training or validation step on a single batch of data. If `sequence_losses` is set, the returned
+    metrics include the model loss of each sequence in the batch as `sequence_loss`, besides the scalar metrics.
+
+    If `micro_batches` is larger than one, the batch is split into that many parts along the first dimension, which are
+    run one after the other. Their gradients are accumulated and applied once, so peak activation memory is that of a
+    single micro-batch while the update uses the whole batch.
+
+    When called in the scope of a multi-replica distribution strategy, `inputs` must come from a distributed dataset.
+    Each replica runs a step on its part of the batch, and the returned metrics are averaged over replicas.
+
+    If `profile_phases` is set, training steps are split into a forward/backward pass and an optimizer update, which are
+    timed separately by the global profiler. This adds a synchronization point between them, so it is slightly slower.
+    Not supported with multiple replicas.
+    """
+    strategy = tf.distribute.get_strategy()
+    if strategy.num_replicas_in_sync > 1:
+        assert micro_batches == 1, 'Micro-batching is not supported with multiple replicas'
+        assert not profile_phases, 'Phase profiling is not supported with multiple replicas'
+        return _run_on_batch_distributed(strategy, model, inputs, training, gradient_clip_norm, group_losses, sequence_losses)
+    profile_phases = profile_phases and training
+    if micro_batches == 1 and not profile_phases:
+        return _run_on_batch(model, inputs, training, gradient_clip_norm, group_losses, sequence_losses)
+    batch_size = next(iter(inputs.values())).shape[0]
+    assert batch_size % micro_batches == 0, f'Batch size {batch_size} is not divisible by {micro_batches} micro-batches'
+    size = batch_size // micro_batches
+    if training and model not in _accumulators:
+        _accumulators[model] = GradientAccumulator(model.trainable_variables)
+    metric_sums: Dict[str, tf.Tensor] = {}
+    sequence_loss_parts: List[tf.Tensor] = []
+    for i in range(micro_batches):
+        micro_batch = {key: value[i * size:(i + 1) * size] for key, value in inputs.items()}
+        with Timer('train/forward_backward' if profile_phases else None):
+            metrics = _accumulate_micro_batch(model, micro_batch, training, group_losses, sequence_losses,
+                                              _accumulators.get(model))
+            if profile_phases:
+                # Wait for the pass to finish
+                for value in metrics.values():
+                    value.numpy()
+        if sequence_losses:
+            sequence_loss_parts.append(metrics.pop('sequence_loss'))
+        metric_sums = {key: metric_sums.get(key, 0.0) + value for key, value in metrics.items()}
+    metrics = {key: value / micro_batches for key, value in metric_sums.items()}
+    if sequence_losses:
+        metrics['sequence_loss'] = tf.concat(sequence_loss_parts, axis=0)
+    if training:
+        with Timer('train/apply_gradients' if profile_phases else None):
+            metrics.update(_apply_accumulated_gradients(model, _accumulators[model], micro_batches, gradient_clip_norm))
+            if profile_phases:
+                # Wait for the update to finish
+                for optimizer in model.optimizer:
+                    optimizer.iterations.numpy()
+    return metrics
+
+
+_accumulators: 'weakref.WeakKeyDictionary[tf.keras.Model, GradientAccumulator]' = weakref.WeakKeyDictionary()
+
+
+def _step(model: tf.keras.Model,
+          inputs: Mapping[str, tf.Tensor],
+          training: bool,
+          gradient_clip_norm: Optional[float],
+          group_losses: bool,
+          sequence_losses: bool,
+          ) -> Dict[str, tf.Tensor]:
+    metrics, gradients = _forward_backward(model, inputs, training, group_losses, sequence_losses)
+    if training:
+        metrics.update(apply_gradients(model, gradients, gradient_clip_norm))
+    return metrics
+
+
+_run_on_batch = xla_function('train_step')(_step)
+
+
+@xla_function('train_step')
+def _run_on_batch_distributed(strategy: tf.distribute.Strategy,
+                              model: tf.keras.Model,
+                              inputs: Mapping[str, Any],
+                              training: bool,
+                              gradient_clip_norm: Optional[float],
+                              group_losses: bool,
+                              sequence_losses: bool,
+                              ) -> Dict[str, tf.Tensor]:
+    def replica_step(replica_inputs: Mapping[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
+        return _step(model, replica_inputs, training, gradient_clip_norm, group_losses, sequence_losses)
+
+    metrics = strategy.experimental_run_v2(replica_step, args=(inputs,))
+    local_sequence_losses = strategy.experimental_local_results(metrics.pop('sequence_loss')) if sequence_losses else []
+    metrics = {key: strategy.reduce(tf.distribute.ReduceOp.MEAN, value, axis=None) for key, value in metrics.items()}
+    if sequence_losses:
+        metrics['sequence_loss'] = tf.concat(local_sequence_losses, axis=0)
+    return metrics
+
+
+@xla_function('train_step')
+def _accumulate_micro_batch(model: tf.keras.Model,
+                            inputs: Mapping[str, tf.Tensor],
+                            training: bool,
+                            group_losses: bool,
+                            sequence_losses: bool,
+                            accumulator: Optional[GradientAccumulator],
+                            ) -> Dict[str, tf.Tensor]:
+    metrics, gradients = _forward_backward(model, inputs, training, group_losses, sequence_losses)
+    if training:
+        assert accumulator is not None
+        accumulator.add(gradients)
+    return metrics
+
+
+@xla_function('train_step')
+def _apply_accumulated_gradients(model: tf.keras.Model,
+                                 accumulator: GradientAccumulator,
+                                 count: int,
+                                 gradient_clip_norm: Optional[float],
+                                 ) -> Dict[str, tf.Tensor]:
+    metrics = apply_gradients(model, accumulator.mean(count), gradient_clip_norm)
+    accumulator.reset()
+    return metrics
+
+
+def _forward_backward(model: tf.keras.Model,
+                      inputs: Mapping[str, tf.Tensor],
+                      training: bool,
+                      group_losses: bool,
+                      sequence_losses: bool = False,
+                      ) -> Tuple[Dict[str, tf.Tensor], Dict[str, List[Tuple[tf.Tensor, tf.Variable]]]]:
     inputs = {key: reshape_known_dims(tf.cast(inputs[key], spec.dtype), spec.shape)
               for key, spec in model.input_spec.items()}
     with tf.GradientTape(persistent=True) as tape:
-        model(inputs, training=training)
+        model(inputs, training=training, sequence_losses=sequence_losses)
         losses = model.per_layer_losses
         total_loss = model.total_loss
     metrics = {'loss': total_loss}
+    if sequence_losses:
+        metrics['sequence_loss'] = model.sequence_losses
     metrics.update({m.name: m.result() for m in model.metrics})
-    if training:
-        optimizers = dict(zip(model.optimizer_targets, model.optimizer))
-        gradients_per_optimizer: Dict[str, Dict[Any, tf.Tensor]] = {optimizer_name: {} for optimizer_name in optimizers.keys()}
-        for layer, loss in losses.items():
-            variables = layer.trainable_variables
-            optimizer_name = layer.name if layer.name in gradients_per_optimizer.keys() else 'model'
-            gradients = tape.gradient(loss, variables)
-            for var, grad in zip(variables, gradients):
-                if grad is not None:
-                    ref = var.experimental_ref()
-                    gradients_per_optimizer[optimizer_name][ref] = gradients_per_optimizer.get(ref, 0.0) + grad
-        for optimizer_name, gradients in gradients_per_optimizer.items():
-            if not gradients:
-                logger.warning(f'No gradients for optimizer {optimizer_name}')
-                continue
-            vars_ = list(var.deref() for var in gradients.keys())
-            grads = list(gradients.values())
-            if gradient_clip_norm:
-                grads, norm = tf.clip_by_global_norm(grads, gradient_clip_norm)
-                metrics[f'grad_norm_{optimizer_name}'] = norm
-            optimizers[optimizer_name].apply_gradients(zip(grads, vars_))
+    if not training:
+        return metrics, {}
+    optimizers = dict(zip(model.optimizer_targets, model.optimizer))
+    return metrics, compute_gradients(tape, losses, optimizers, group_losses)
+
+
+def apply_gradients(model: tf.keras.Model,
+                    gradients: Mapping[str, Sequence[Tuple[tf.Tensor, tf.Variable]]],
+                    gradient_clip_norm: Optional[float] = None,
+                    ) -> Dict[str, tf.Tensor]:
+    """
+    Clips gradients per optimizer and applies them. Returns gradient norms and loss scales as metrics.
+
+    In a replica context with multiple replicas, gradients are averaged over replicas before clipping, so that all
+    replicas clip (and report) the same gradients.
+    """
+    optimizers = dict(zip(model.optimizer_targets, model.optimizer))
+    replica_context = tf.distribute.get_replica_context()
+    num_replicas = replica_context.num_replicas_in_sync if replica_context is not None else 1
+    metrics = {}
+    for optimizer_name, grads_and_vars in gradients.items():
+        if not grads_and_vars:
+            logger.warning(f'No gradients for optimizer {optimizer_name}')
+            continue
+        grads, vars_ = zip(*grads_and_vars)
+        if num_replicas > 1:
+            grads = replica_context.all_reduce(tf.distribute.ReduceOp.MEAN, list(grads))
+        if gradient_clip_norm:
+            grads, norm = tf.clip_by_global_norm(grads, gradient_clip_norm)
+            metrics[f'grad_norm_{optimizer_name}'] = norm
+        if num_replicas > 1:
+            # Optimizers sum gradients over replicas when applying them, which would undo the averaging
+            grads = [grad / num_replicas for grad in grads]
+        optimizers[optimizer_name].apply_gradients(zip(grads, vars_))
+        if isinstance(optimizers[optimizer_name], LossScaleOptimizer):
+            metrics[f'loss_scale_{optimizer_name}'] = optimizers[optimizer_name].loss_scale()
     return metrics
+
+
+def compute_gradients(tape: tf.GradientTape,
+                      losses: Mapping[tf.keras.layers.Layer, tf.Tensor],
+                      optimizers: Mapping[str, tf.keras.optimizers.Optimizer],
+                      group_losses: bool = True,
+                      ) -> Dict[str, List[Tuple[tf.Tensor, tf.Variable]]]:
+    """
+    Computes gradients of per-layer losses, routed to the optimizer named after the layer (or 'model' if there is none).
+
+    Variables of a layer with its own optimizer are only updated by that optimizer, even if the layer is part of a layer
+    with a different optimizer. With `group_losses`, the losses are summed per optimizer, so a single backward pass is
+    needed for each optimizer. Otherwise there is one backward pass per layer, and gradients are summed per variable.
+    The tape must be persistent if there is more than one optimizer or layer.
+    """
+    def get_optimizer_name(layer: tf.keras.layers.Layer) -> str:
+        return layer.name if layer.name in optimizers.keys() else 'model'
+
+    owned_variables = {var.experimental_ref(): get_optimizer_name(layer)
+                       for layer in losses.keys() if get_optimizer_name(layer) != 'model'
+                       for var in layer.trainable_variables}
+    losses_per_optimizer: Dict[str, Dict[tf.keras.layers.Layer, tf.Tensor]] = {name: {} for name in optimizers.keys()}
+    variables_per_optimizer: Dict[str, Dict[Any, tf.Variable]] = {name: {} for name in optimizers.keys()}
+    for layer, loss in losses.items():
+        optimizer_name = get_optimizer_name(layer)
+        losses_per_optimizer[optimizer_name][layer] = loss
+        for var in layer.trainable_variables:
+            ref = var.experimental_ref()
+            if owned_variables.get(ref, optimizer_name) == optimizer_name:
+                variables_per_optimizer[optimizer_name][ref] = var
+
+    def gradients(optimizer: tf.keras.optimizers.Optimizer,
+                  loss: tf.Tensor,
+                  variables: Sequence[tf.Variable],
+                  ) -> List[Optional[tf.Tensor]]:
+        if isinstance(optimizer, LossScaleOptimizer):
+            return optimizer.get_unscaled_gradients(tape.gradient(optimizer.get_scaled_loss(loss), variables))
+        return tape.gradient(loss, variables)
+
+    result = {}
+    for optimizer_name, layer_losses in losses_per_optimizer.items():
+        optimizer = optimizers[optimizer_name]
+        variables = variables_per_optimizer[optimizer_name]
+        summed: Dict[Any, tf.Tensor] = {}
+        if group_losses and layer_losses:
+            refs = list(variables.keys())
+            for ref, grad in zip(refs, gradients(optimizer, tf.add_n(list(layer_losses.values())), list(variables.values()))):
+                if grad is not None:
+                    summed[ref] = grad
+        else:
+            for layer, loss in layer_losses.items():
+                refs = [var.experimental_ref() for var in layer.trainable_variables
+                        if var.experimental_ref() in variables]
+                for ref, grad in zip(refs, gradients(optimizer, loss, [variables[ref] for ref in refs])):
+                    if grad is not None:
+                        summed[ref] = summed[ref] + grad if ref in summed else grad
+        result[optimizer_name] = [(grad, variables[ref]) for ref, grad in summed.items()]
+    return result
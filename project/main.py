@@ -17,7 +17,7 @@ import wandb.settings
 from loguru import logger
 from tensorflow.python.util import deprecation
 
-from project.execution import Evaluator, run_baseline, train
+from project.execution import Evaluator, run_baseline, run_benchmark, train
 from project.util.logging import init_logging
 
 
@@ -124,6 +124,10 @@ class Main:
                                                                 seed=seed,
                                                                 sync_wandb=wandb.run.resumed and not no_sync)
 
+    def benchmark(self, name: str) -> None:
+        with self._catch():
+            run_benchmark(name, self.logdir, self.checkpoint)
+
     def run_baseline(self, run_type: str, exp_config: str, num_processes: Optional[int]) -> None:
         try:
             with self._catch():
@@ -14,10 +14,14 @@ from loguru import logger
 
 from project import networks
 from project.util.files import get_latest_checkpoint
+from project.util.planet.preprocess import preprocess
 from project.util.system import is_debugging
 from project.util.tf import auto_shape, combine_dims, swap_dims
 from project.util.tf.discounting import lambda_return
 from project.util.tf.losses import binary_crossentropy, mse
+from project.util.tf.precision import float32_island, needs_loss_scaling, set_mixed_precision_policy
+from project.util.tf.remat import recompute_grad
+from project.util.tf.tracing import count_traces
 from project.util.timing import measure_time
 
 
@@ -36,6 +40,7 @@ class Model(auto_shape.Model):
         self._observation_components = list(observation_components)
         self._data_spec = data_spec
         self._batch_size = next(iter(data_spec.values())).shape[0]
+        self.sequence_losses: Optional[tf.Tensor] = None  # Per-sequence model loss of the last call, if requested
 
         if disable_tf_optimization or is_debugging():
             logger.warning('Running without tf.function optimization.')
@@ -135,6 +140,14 @@ class Model(auto_shape.Model):
     def _get_mask(data: Mapping[str, tf.Tensor]) -> tf.Tensor:
         return tf.sequence_mask(data['length'], tf.shape(data['reward'])[1])
 
+    @staticmethod
+    def preprocess(data: Mapping[str, tf.Tensor]) -> Dict[str, tf.Tensor]:
+        """Preprocess raw uint8 images (see `device_preprocessing`). Already preprocessed images are left as is."""
+        data = dict(data)
+        if 'image' in data and data['image'].dtype == tf.uint8:
+            data['image'] = preprocess(data['image'])
+        return data
+
     @property
     def dummy_data(self) -> Dict[str, tf.Tensor]:
         """Create dummy data suitable for initializing the model's weights"""
@@ -150,13 +163,13 @@ class Model(auto_shape.Model):
                     data: Mapping[str, tf.Tensor],
                     **kwargs: Any,
                     ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
-        embedded = self.encoder(data, **kwargs)
+        embedded = self.encoder(self.preprocess(data), **kwargs)
         prior, posterior = self.rnn.closed_loop(embedded, data['action'], mask=self._get_mask(data), **kwargs)
         return prior, posterior
 
     @gin.configurable(whitelist=['context'])
     def open_loop(self, data: Mapping[str, tf.Tensor], context: int = 5, **kwargs: Any) -> Tuple[tf.Tensor, ...]:
-        embedded = self.encoder(data, **kwargs)
+        embedded = self.encoder(self.preprocess(data), **kwargs)
         mask = self._get_mask(data)
         context = min(mask.shape[1] - 1, context)
         _, closed_loop = self.rnn.closed_loop(embedded[:, :context],
@@ -172,16 +185,19 @@ class Model(auto_shape.Model):
                     tf.nest.map_structure(lambda x, y: tf.concat([x, y], 1), closed_loop, open_loop))
 
     def decode(self, state_features: tf.Tensor, **kwargs: Any) -> Dict[str, tf.Tensor]:
+        """Decode features into float32 reconstructions (regardless of the mixed precision setting)"""
         reconstructions = {}
         for name, decoder in self.decoders.items():
-            reconstructions[name] = decoder(state_features, **kwargs)
+            reconstructions[name] = tf.cast(decoder(state_features, **kwargs), tf.float32)
         return reconstructions
 
-    def call(self, inputs: Mapping[str, tf.Tensor], **kwargs: Any) -> tf.Tensor:
-        inputs = dict(inputs)  # Shallow copy input dict so we can modify it safely
+    def call(self, inputs: Mapping[str, tf.Tensor], sequence_losses: bool = False, **kwargs: Any) -> tf.Tensor:
+        inputs = self.preprocess(inputs)  # This also makes a shallow copy, so we can modify the dict safely
         if self._batch_size and tf.nest.flatten(inputs)[0].shape[0] is None:
-            # Workaround for keras making the batch dimension undefined
-            tf.nest.map_structure(lambda x: x.set_shape([self._batch_size] + x.shape[1:]), inputs)
+            # Workaround for keras making the batch dimension undefined. The data spec has the global batch size, which
+            # is split evenly between replicas.
+            batch_size = self._batch_size // tf.distribute.get_strategy().num_replicas_in_sync
+            tf.nest.map_structure(lambda x: x.set_shape([batch_size] + x.shape[1:]), inputs)
         if inputs['length'].shape.ndims > 1:
             inputs['length'] = inputs['length'][:, 0]
         mask = self._get_mask(inputs)
@@ -191,6 +207,13 @@ class Model(auto_shape.Model):
         reconstruction_losses = self.reconstruction_loss(inputs, reconstructions, mask)
         for name, (loss, scale) in reconstruction_losses.items():
             self.add_named_loss(loss, name=f'{name}_recon', scaling=scale)
+        self.sequence_losses = None
+        if sequence_losses:
+            self.sequence_losses = self.compute_sequence_losses(inputs,
+                                                                reconstructions,
+                                                                {name: scale for name, (_, scale) in reconstruction_losses.items()},
+                                                                self.rnn.state_divergence(posterior, prior),
+                                                                mask)
 
         if self._dreamer:
             imagined_states = self.imagine_forward(posterior)
@@ -206,10 +229,21 @@ class Model(auto_shape.Model):
 
         return tf.constant(0.0)
 
-    @gin.configurable(whitelist=['horizon'])
-    def imagine_forward(self, initial_states: Tuple[tf.Tensor, ...], horizon: int = 15, **kwargs: Any) -> Tuple[tf.Tensor, ...]:
+    @gin.configurable(whitelist=['horizon', 'checkpoint_segment_length'])
+    def imagine_forward(self,
+                        initial_states: Tuple[tf.Tensor, ...],
+                        horizon: int = 15,
+                        checkpoint_segment_length: Optional[int] = None,
+                        **kwargs: Any,
+                        ) -> Tuple[tf.Tensor, ...]:
+        """
+        Imagine trajectories of `horizon` steps from each state using the action network. If `checkpoint_segment_length`
+        is set, activations are only kept at segment boundaries and recomputed in the backward pass.
+        """
         initial_states = tf.nest.map_structure(lambda x: tf.stop_gradient(x[:, :-1]), initial_states)
         initial_states = combine_dims(initial_states, [0, 1])  # type: ignore[assignment]
+        if checkpoint_segment_length and horizon > checkpoint_segment_length:
+            return self._checkpointed_imagination(initial_states, horizon, checkpoint_segment_length, **kwargs)
 
         def step_fn(prev: Tuple[tf.Tensor, ...], index: tf.Tensor) -> Tuple[tf.Tensor, ...]:
             features = tf.stop_gradient(self.rnn.state_to_features(prev))
@@ -221,7 +255,44 @@ class Model(auto_shape.Model):
         states = swap_dims(states, 0, 1)
         return cast(Tuple[tf.Tensor, ...], states)
 
+    def _checkpointed_imagination(self,
+                                  initial_states: Tuple[tf.Tensor, ...],
+                                  horizon: int,
+                                  segment_length: int,
+                                  **kwargs: Any,
+                                  ) -> Tuple[tf.Tensor, ...]:
+        predictor = self.rnn.predictor.open_loop_predictor
+        num_states = initial_states[0].shape[0]
+        # Sampling noise is drawn up front, so that recomputed segments sample the same actions and states
+        action_noise = tf.random.normal([horizon, num_states] + self._data_spec['action'].shape[2:].as_list())
+        state_noise = tf.random.normal([horizon, num_states, predictor.noise_size])
+
+        @recompute_grad
+        def imagine_segment(states: Tuple[tf.Tensor, ...],
+                            segment_action_noise: tf.Tensor,
+                            segment_state_noise: tf.Tensor,
+                            ) -> Tuple[tf.Tensor, ...]:
+            trajectory = []
+            for t in range(segment_action_noise.shape[0]):
+                features = tf.stop_gradient(self.rnn.state_to_features(states))
+                action_dist = self.action_network(features[tf.newaxis, :], **kwargs)
+                action = action_dist.sample_from_noise(segment_action_noise[tf.newaxis, t])[0, :]
+                states = predictor.prior(action, states, segment_state_noise[t])
+                trajectory.append(states)
+            return tuple(tf.stack(s, axis=1) for s in zip(*trajectory))
+
+        states = tuple(initial_states)
+        segments = []
+        for start in range(0, horizon, segment_length):
+            segment = imagine_segment(states,
+                                      action_noise[start:start + segment_length],
+                                      state_noise[start:start + segment_length])
+            segments.append(segment)
+            states = tuple(x[:, -1] for x in segment)
+        return tuple(tf.concat(s, axis=1) for s in zip(*segments))
+
     @gin.configurable(whitelist=['lambda_'])
+    @float32_island
     def compute_action_return(self,
                               values: tf.Tensor,
                               rewards: tf.Tensor,
@@ -239,6 +310,7 @@ class Model(auto_shape.Model):
         return tf.reduce_mean(return_)
 
     @gin.configurable(whitelist=['lambda_'])
+    @float32_island
     def compute_value_loss(self,
                            values: tf.Tensor,
                            rewards: tf.Tensor,
@@ -256,6 +328,26 @@ class Model(auto_shape.Model):
         loss *= self.discount_factors(discounts)
         return tf.reduce_mean(loss)
 
+    @float32_island
+    def compute_sequence_losses(self,
+                                targets: Mapping[str, tf.Tensor],
+                                reconstructions: Mapping[str, tf.Tensor],
+                                scales: Mapping[str, float],
+                                divergence: tf.Tensor,
+                                mask: tf.Tensor,
+                                ) -> tf.Tensor:
+        """
+        Model loss of each sequence in the batch: the scaled reconstruction losses plus the divergence, averaged over
+        the valid time steps of the sequence. Used to prioritize episodes, so no gradients flow through it.
+        """
+        step_losses = tf.stop_gradient(divergence)
+        for name, reconstruction in reconstructions.items():
+            loss = self.loss_fns[name](reconstruction, tf.cast(targets[name], tf.float32), reduce=False)
+            loss = tf.reduce_mean(tf.reshape(loss, loss.shape[:2].as_list() + [-1]), axis=-1)
+            step_losses += scales[name] * tf.stop_gradient(loss)
+        mask = tf.cast(mask, tf.float32)
+        return tf.reduce_sum(step_losses * mask, axis=1) / tf.maximum(tf.reduce_sum(mask, axis=1), 1.0)
+
     @staticmethod
     def discount_factors(discounts: tf.Tensor) -> tf.Tensor:
         """[1, gamma, gamma**2, ...]"""
@@ -263,6 +355,7 @@ class Model(auto_shape.Model):
 
     @gin.configurable(whitelist=['scales'])
     @tf.function(experimental_relax_shapes=True)
+    @count_traces
     def reconstruction_loss(self,
                             targets: Mapping[str, tf.Tensor],
                             reconstructions: Mapping[str, tf.Tensor],
@@ -277,14 +370,18 @@ class Model(auto_shape.Model):
             losses[name] = (self.loss_fns[name](reconstruction, target, mask, name=f'{name}_recon_loss'), scale)
         return losses
 
+    @property
+    def additional_data(self) -> Dict[str, Any]:
+        """Arguments to get_model needed to recreate this model"""
+        return {'observation_components': self._observation_components,
+                'data_spec': self._data_spec}
+
     def save_weights(self, filepath: str, **kwargs: Any) -> None:
         super().save_weights(filepath, **kwargs)
         path = Path(filepath)
         additional_data_file = path.parent / 'checkpoint_additional_data.pickle'
-        additional_data = {'observation_components': self._observation_components,
-                           'data_spec': self._data_spec}
         with open(additional_data_file, 'wb') as f1:
-            pickle.dump(additional_data, f1, pickle.HIGHEST_PROTOCOL)
+            pickle.dump(self.additional_data, f1, pickle.HIGHEST_PROTOCOL)
         latest_checkpoint_file = path.parent / 'checkpoint_latest'
         with open(latest_checkpoint_file, 'w') as f2:
             f2.write(path.name)
@@ -298,6 +395,10 @@ def get_model(observation_components: Iterable[str],
               ) -> Model:
     """Returns a built model with random weights"""
     assert 'model' in optimizers.keys(), 'No optimizer specified for base model'
+    set_mixed_precision_policy()
+    if needs_loss_scaling():
+        optimizers = {name: tf.keras.mixed_precision.experimental.LossScaleOptimizer(optimizer, loss_scale='dynamic')
+                      for name, optimizer in optimizers.items()}
     logger.info(f'Building model...')
     model = Model(observation_components, data_spec)
     model.compile(optimizer=list(optimizers.values()), loss=None)
@@ -24,9 +24,45 @@ class OpenLoopPredictor(auto_shape.AbstractRNNCell):
     def __init__(self, **kwargs: Any) -> None:
         super().__init__(dynamic=False, **kwargs)
 
-    def prior(self, prev_action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+    def prior(self,
+              prev_action: tf.Tensor,
+              prev_state_unpacked: Tuple[tf.Tensor, ...],
+              noise: Optional[tf.Tensor] = None,
+              ) -> Tuple[tf.Tensor, ...]:
+        """
+        Compute the prior state. If `noise` of shape [batch, noise_size] is given, it is used as the standard normal noise
+        for sampling, which makes the result deterministic.
+        """
         raise NotImplementedError
 
+    @property
+    def noise_size(self) -> int:
+        """Size of the standard normal noise used to sample a single state"""
+        return 0
+
+    def rollout_step(self, prev_action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+        """Single step of rollout(). Subclasses can override this with a cheaper equivalent of prior()."""
+        return self.prior(prev_action, prev_state_unpacked)
+
+    def rollout(self, actions: tf.Tensor, initial_state: Tuple[tf.Tensor, ...], xla: bool = False) -> Tuple[tf.Tensor, ...]:
+        """
+        Predict states for `actions` of shape [batch, time, ...], like RNN(self, return_sequences=True) does. The time
+        loop is unrolled into the graph, which avoids the per-step overhead of the RNN layer's while loop for short, fixed
+        horizons as used in planning. If `xla` is set, the rollout is compiled with XLA.
+        """
+        if xla:
+            return tuple(tf.xla.experimental.compile(lambda a, *s: self._unrolled_rollout(a, s),
+                                                     [actions] + list(initial_state)))
+        return self._unrolled_rollout(actions, tuple(initial_state))
+
+    def _unrolled_rollout(self, actions: tf.Tensor, initial_state: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+        state = initial_state
+        states = []
+        for t in range(actions.shape[1]):
+            state = self.rollout_step(actions[:, t], state)
+            states.append(state)
+        return tuple(tf.stack(s, axis=1) for s in zip(*states))
+
     @classmethod
     def state_to_features(cls, state: Tuple[tf.Tensor, ...]) -> tf.Tensor:
         raise NotImplementedError
@@ -65,16 +101,66 @@ class Predictor(auto_shape.AbstractRNNCell):
     def __init__(self, name: str = 'predictor', **kwargs: Any) -> None:
         super().__init__(dynamic=False, name=name, **kwargs)
 
-    def prior(self, prev_action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+    def prior(self,
+              prev_action: tf.Tensor,
+              prev_state_unpacked: Tuple[tf.Tensor, ...],
+              noise: Optional[tf.Tensor] = None,
+              ) -> Tuple[tf.Tensor, ...]:
+        if noise is not None:
+            return self.open_loop_predictor.prior(prev_action, prev_state_unpacked, noise)
         return cast(Tuple[tf.Tensor, ...], self.open_loop_predictor(prev_action, prev_state_unpacked)[0])
 
     def posterior(self,
                   prev_action: tf.Tensor,
                   latent_obs: tf.Tensor,
                   prev_state_unpacked: Tuple[tf.Tensor, ...],
+                  noise: Optional[tf.Tensor] = None,
                   ) -> Tuple[tf.Tensor, ...]:
         raise NotImplementedError
 
+    @property
+    def noise_size(self) -> int:
+        """Size of the noise used by step(), which samples both the prior and the posterior"""
+        return 2 * self.open_loop_predictor.noise_size
+
+    def step(self,
+             inputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
+             prev_state_unpacked: Tuple[tf.Tensor, ...],
+             noise: Optional[tf.Tensor] = None,
+             ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
+        """Compute prior and posterior for a single time step. See OpenLoopPredictor.prior() for the use of `noise`."""
+        obs, action, use_obs = inputs
+        prior_noise, posterior_noise = (None, None) if noise is None else tf.split(noise, 2, axis=-1)
+        prior = self.prior(action, prev_state_unpacked, prior_noise)
+        posterior = tf.cond(tf.reduce_any(use_obs),
+                            lambda: self.posterior(action, obs, prev_state_unpacked, posterior_noise),
+                            lambda: prior)
+        return prior, posterior
+
+    def closed_loop_rollout(self,
+                            inputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
+                            initial_state: Tuple[tf.Tensor, ...],
+                            mask: tf.Tensor,
+                            noise: Optional[tf.Tensor] = None,
+                            ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
+        """
+        Compute priors and posteriors for inputs of shape [batch, time, ...], like RNN(self, return_sequences=True) does,
+        with the time loop unrolled. The state is not updated at time steps where `mask` is False. `noise` should have
+        shape [batch, time, noise_size].
+        """
+        state = tuple(initial_state)
+        priors, posteriors = [], []
+        for t in range(mask.shape[1]):
+            step_inputs = tf.nest.map_structure(lambda x: x[:, t], inputs)
+            prior, posterior = self.step(step_inputs, state, None if noise is None else noise[:, t])
+            prior, posterior = tf.nest.map_structure(lambda new, old: tf.where(mask[:, t, tf.newaxis], new, tf.cast(old, new.dtype)),
+                                                     (prior, posterior),
+                                                     (state, state))
+            state = posterior
+            priors.append(prior)
+            posteriors.append(posterior)
+        return tuple(tf.stack(s, axis=1) for s in zip(*priors)), tuple(tf.stack(s, axis=1) for s in zip(*posteriors))
+
     @classmethod
     def state_to_features(cls, state: Tuple[tf.Tensor, ...]) -> tf.Tensor:
         return cls.open_loop_predictor_class.state_to_features(state)
@@ -102,9 +188,5 @@ class Predictor(auto_shape.AbstractRNNCell):
              inputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
              prev_state_unpacked: Tuple[tf.Tensor, ...],
              ) -> Tuple[Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]], Tuple[tf.Tensor, ...]]:
-        obs, action, use_obs = inputs
-        prior = self.prior(action, prev_state_unpacked)
-        posterior = tf.cond(tf.reduce_any(use_obs),
-                            lambda: self.posterior(action, obs, prev_state_unpacked),
-                            lambda: prior)
+        prior, posterior = self.step(inputs, prev_state_unpacked)
         return (prior, posterior), posterior
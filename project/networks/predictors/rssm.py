@@ -24,6 +24,7 @@ from tensorflow_probability import distributions as tfd
 
 from project.util.planet.mask import apply_mask
 from project.util.tf import auto_shape
+from project.util.tf.precision import cast_floats
 
 from ..basic import SequentialBlock
 from .base import OpenLoopPredictor, Predictor, State
@@ -85,16 +86,32 @@ class SequentialNormalBlock(auto_shape.Layer):
         self._mean_layer = auto_shape.Dense(output_size, activation=None)
         self._stddev_layer = auto_shape.Dense(output_size, activation='softplus')
 
-    def call(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, ...]:
+    def call(self, inputs: tf.Tensor, noise: Optional[tf.Tensor] = None) -> Tuple[tf.Tensor, ...]:
+        """If `noise` is given, it is used as the standard normal noise of a reparameterized sample"""
+        mean, stddev = self.moments(inputs)
+        if self._mean_only:
+            sample = mean
+        elif noise is not None:
+            sample = mean + stddev * tf.cast(noise, mean.dtype)
+        else:
+            sample = tfd.MultivariateNormalDiag(mean, stddev).sample()
+        return tuple(StateDist(mean, stddev, sample))
+
+    def moments(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor]:
         hidden = self._hidden_layers(inputs)
         mean = self._mean_layer(hidden)
         stddev = self._stddev_layer(hidden)
         stddev += self._min_stddev
+        return mean, stddev
+
+    def fast_sample(self, inputs: tf.Tensor) -> Tuple[tf.Tensor, ...]:
+        """Same as calling the layer, but samples with a reparameterized standard normal instead of going through tfp"""
+        mean, stddev = self.moments(inputs)
         if self._mean_only:
             sample = mean
         else:
-            sample = tfd.MultivariateNormalDiag(mean, stddev).sample()
-        return tuple(StateDist(mean, stddev, sample))
+            sample = mean + stddev * tf.random.normal(tf.shape(mean), dtype=mean.dtype)
+        return mean, stddev, sample
 
 
 @gin.configurable(module='predictors', whitelist=['state_size', 'belief_size', 'embed_size', 'mean_only', 'min_stddev',
@@ -159,21 +176,35 @@ class OpenLoopRSSMPredictor(OpenLoopPredictor):
     def state_size(self) -> Tuple[int, ...]:
         return self._state_size, self._state_size, self._state_size, self._belief_size
 
+    @property
+    def noise_size(self) -> int:
+        return 0 if self.prior_kwargs['mean_only'] else self._state_size
+
     def transition(self, action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> tf.Tensor:
         """Compute next (deterministic) belief."""
+        # Inputs that come from outside the model (e.g. agent state variables) may not have the compute dtype yet
+        action, prev_state_unpacked = cast_floats((action, prev_state_unpacked), self._compute_dtype)
         prev_state = FullState(*prev_state_unpacked)
         hidden = tf.concat([prev_state.state.sample, action], -1)
         hidden = self._input_layers(hidden)
         belief, _ = self._cell(hidden, [prev_state.belief])
         return belief
 
-    def prior(self, action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+    def prior(self,
+              action: tf.Tensor,
+              prev_state_unpacked: Tuple[tf.Tensor, ...],
+              noise: Optional[tf.Tensor] = None,
+              ) -> Tuple[tf.Tensor, ...]:
         """Compute prior next state by applying the transition dynamics."""
         belief = self.transition(action, prev_state_unpacked)
-        prior_state = self._prior_dist(belief)
+        prior_state = self._prior_dist(belief, noise=noise)
         prior = FullState(state=StateDist(*prior_state), belief=belief)
         return tuple(prior)
 
+    def rollout_step(self, prev_action: tf.Tensor, prev_state_unpacked: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+        belief = self.transition(prev_action, prev_state_unpacked)
+        return tuple(FullState(state=StateDist(*self._prior_dist.fast_sample(belief)), belief=belief))
+
 
 @gin.configurable(module='predictors')
 class RSSMPredictor(Predictor):
@@ -209,10 +240,11 @@ class RSSMPredictor(Predictor):
                   action: tf.Tensor,
                   latent_obs: tf.Tensor,
                   prev_state_unpacked: Tuple[tf.Tensor, ...],
+                  noise: Optional[tf.Tensor] = None,
                   ) -> Tuple[tf.Tensor, ...]:
         """Compute posterior state from previous state and current observation."""
         belief = self.open_loop_predictor.transition(action, prev_state_unpacked)
-        hidden = tf.concat([belief, latent_obs], -1)
-        posterior_state_unpacked = self._posterior_dist(hidden)
+        hidden = tf.concat([belief, tf.cast(latent_obs, belief.dtype)], -1)
+        posterior_state_unpacked = self._posterior_dist(hidden, noise=noise)
         posterior = FullState(state=StateDist(*posterior_state_unpacked), belief=belief)
         return tuple(posterior)
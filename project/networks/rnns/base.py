@@ -11,6 +11,9 @@ import tensorflow as tf
 from project.networks.predictors import Predictor
 from project.util.tf import auto_shape
 from project.util.tf.losses import reduce_loss
+from project.util.tf.precision import float32_island
+from project.util.tf.remat import recompute_grad
+from project.util.tf.tracing import count_traces
 
 
 class RNN(abc.ABC, auto_shape.Layer):
@@ -71,7 +74,9 @@ class RNN(abc.ABC, auto_shape.Layer):
              ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
         raise NotImplementedError
 
+    @float32_island
     @tf.function(experimental_relax_shapes=True)
+    @count_traces
     def divergence_loss(self,
                         prior: Tuple[tf.Tensor, ...],
                         posterior: Tuple[tf.Tensor, ...],
@@ -85,17 +90,24 @@ class RNN(abc.ABC, auto_shape.Layer):
         return divergence_loss
 
 
-@gin.configurable(module='rnns', whitelist=['divergence_loss_scale', 'divergence_loss_free_nats'])
+@gin.configurable(module='rnns', whitelist=['divergence_loss_scale', 'divergence_loss_free_nats', 'checkpoint_segment_length'])
 class SimpleRNN(RNN):
+    """
+    RNN running a single predictor. If `checkpoint_segment_length` is set, training sequences are split into segments of
+    that many time steps, and only the states at segment boundaries are kept for the backward pass. Activations within
+    each segment are recomputed, so activation memory grows with the segment length rather than the sequence length.
+    """
     def __init__(self,
                  predictor_class: Type[Predictor],
                  *,
                  divergence_loss_scale: float = 1.0,
                  divergence_loss_free_nats: float = 3.0,
+                 checkpoint_segment_length: Optional[int] = None,
                  name: str = 'simple_rnn',
                  ) -> None:
         self.divergence_loss_scale = divergence_loss_scale
         self.divergence_loss_free_nats = divergence_loss_free_nats
+        self.checkpoint_segment_length = checkpoint_segment_length
         self._predictor = predictor_class(name=f'{name}_predictor')
         self.rnn = auto_shape.RNN(self._predictor, return_sequences=True, name=f'{name}_inner')
         super().__init__(predictor_class=predictor_class, name=name)
@@ -121,7 +133,34 @@ class SimpleRNN(RNN):
              ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
         prior: Tuple[tf.Tensor, ...]
         posterior: Tuple[tf.Tensor, ...]
-        prior, posterior = self.rnn(inputs, initial_state=initial_state, mask=mask, training=training)
+        length = inputs[1].shape[1]
+        if self.checkpoint_segment_length and training is True and length > self.checkpoint_segment_length:
+            prior, posterior = self._checkpointed_rnn(inputs, initial_state, mask)
+        else:
+            prior, posterior = self.rnn(inputs, initial_state=initial_state, mask=mask, training=training)
         divergence_loss = self.divergence_loss(prior, posterior, mask=mask, free_nats=self.divergence_loss_free_nats)
         self.add_named_loss(divergence_loss, name='divergence', scaling=self.divergence_loss_scale)
         return prior, posterior
+
+    def _checkpointed_rnn(self,
+                          inputs: Tuple[tf.Tensor, tf.Tensor, tf.Tensor],
+                          initial_state: Optional[Tuple[tf.Tensor, ...]],
+                          mask: Optional[tf.Tensor],
+                          ) -> Tuple[Tuple[tf.Tensor, ...], Tuple[tf.Tensor, ...]]:
+        batch_size, length = inputs[1].shape[:2]
+        if initial_state is None:
+            initial_state = self._predictor.zero_state(batch_size)
+        if mask is None:
+            mask = tf.ones([batch_size, length], tf.bool)
+        # Sampling noise is drawn up front, so that recomputed segments sample the same states
+        noise = tf.random.normal([batch_size, length, self._predictor.noise_size])
+        rollout = recompute_grad(self._predictor.closed_loop_rollout)
+        state = tuple(initial_state)
+        priors, posteriors = [], []
+        for start in range(0, length, self.checkpoint_segment_length):
+            segment = slice(start, start + self.checkpoint_segment_length)
+            prior, posterior = rollout(tf.nest.map_structure(lambda x: x[:, segment], inputs), state, mask[:, segment], noise[:, segment])
+            priors.append(prior)
+            posteriors.append(posterior)
+            state = tuple(x[:, -1] for x in posterior)
+        return tuple(tf.concat(s, axis=1) for s in zip(*priors)), tuple(tf.concat(s, axis=1) for s in zip(*posteriors))
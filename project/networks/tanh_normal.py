@@ -29,6 +29,8 @@ from .wrappers import ExtraBatchDim
 class TanhNormalDistribution(tfd.Distribution):
     """Normal distribution transformed with a tanh function. Mean, stddev and mode are approximated by sampling."""
     def __init__(self, mean: tf.Tensor, std: tf.Tensor, feature_dims: int = 1, num_samples: int = 100) -> None:
+        self._normal_mean = mean
+        self._normal_std = std
         dist = tfd.Normal(mean, std)
         dist = tfd.TransformedDistribution(dist, TanhBijector())
         dist = tfd.Independent(dist, feature_dims)
@@ -49,6 +51,10 @@ class TanhNormalDistribution(tfd.Distribution):
     def sample(self, *args: Any, **kwargs: Any) -> tf.Tensor:
         return self._dist.sample(*args, **kwargs)
 
+    def sample_from_noise(self, noise: tf.Tensor) -> tf.Tensor:
+        """Reparameterized sample using the given standard normal noise, which must have the shape of a single sample"""
+        return tf.nn.tanh(self._normal_mean + self._normal_std * tf.cast(noise, self._normal_mean.dtype))
+
     def _mean(self) -> tf.Tensor:
         samples = self._dist.sample(self._num_samples)
         return tf.reduce_mean(samples, 0)
@@ -5,7 +5,7 @@
 from __future__ import annotations
 
 import abc
-from typing import Optional, Tuple, Union
+from typing import Dict, Optional, Tuple, Union
 from typing_extensions import Protocol
 
 import gym.spaces
@@ -32,7 +32,12 @@ class Planner(abc.ABC):
 
     def _objective_fn(self, state: Tuple[tf.Tensor, ...]) -> tf.Tensor:
         obj = self._objective_decoder(self._predictor.state_to_features(state), training=False)
-        return tf.reduce_sum(obj, axis=1)
+        return tf.reduce_sum(tf.cast(obj, tf.float32), axis=1)
+
+    @property
+    def statistics(self) -> Dict[str, tf.Variable]:
+        """Scalar statistics about the last planning call"""
+        return {}
 
     @classmethod
     @abc.abstractmethod
@@ -45,3 +50,8 @@ class Planner(abc.ABC):
                    visualization_goal: Optional[tf.Tensor] = None,
                    ) -> tf.Tensor:
         raise NotImplementedError
+
+    def get_actions(self, initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...]) -> tf.Tensor:
+        """Get actions for a batch of initial states. Planners that can plan for a whole batch at once should override this."""
+        return tf.stack([self.get_action(tuple(s[i:i + 1] for s in initial_state))
+                         for i in range(initial_state[0].shape[0])])
@@ -4,7 +4,7 @@
 
 from __future__ import annotations
 
-from typing import Callable, Optional, Tuple, Union
+from typing import Callable, Dict, Optional, Sequence, Tuple, Union
 
 import gin
 import gym.spaces
@@ -17,9 +17,13 @@ from tensorflow.keras.layers import RNN
 from project.model import Model
 from project.networks.predictors import OpenLoopPredictor
 from project.util.tf import scan
+from project.util.tf.compilation import xla_function
+from project.util.tf.tracing import count_traces
 
 from .base import DecoderFunction, Planner
 
+RolloutFunction = Callable[[tf.Tensor, Tuple[tf.Tensor, ...]], Tuple[tf.Tensor, ...]]
+
 
 @tf.function
 def simulate_plan(actions: tf.Tensor) -> tf.Tensor:
@@ -58,9 +62,54 @@ def plot_positions(positions: np.ndarray, values: np.ndarray, goal: np.ndarray,
     plt.close()
 
 
-@tf.function(experimental_autograph_options=tf.autograph.experimental.Feature.ASSERT_STATEMENTS)
+def iterate_until_converged(refit_fn: Callable[[tf.Tensor, tf.Tensor, tf.Tensor], Tuple[tf.Tensor, tf.Tensor, tf.Tensor]],
+                            mean: tf.Tensor,
+                            std_dev: tf.Tensor,
+                            iterations: int,
+                            batch_shape: Sequence[int] = (),
+                            std_dev_threshold: Optional[float] = None,
+                            improvement_threshold: Optional[float] = None,
+                            ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Apply `refit_fn(iteration, mean, std_dev) -> (mean, std_dev, score)` up to `iterations` times, where `score` has
+    shape `batch_shape`. If a threshold is given, stop early once the norm of std_dev or the improvement of the score
+    since the previous iteration falls below it for all batch elements.
+    Returns the final mean and std_dev, and the number of iterations that were run.
+    """
+    if std_dev_threshold is None and improvement_threshold is None:
+        for i in range(iterations):
+            mean, std_dev, _ = refit_fn(tf.constant(i), mean, std_dev)
+        return mean, std_dev, tf.constant(iterations)
+
+    def converged(std_dev: tf.Tensor, improvement: tf.Tensor) -> tf.Tensor:
+        result = tf.zeros(batch_shape, tf.bool)
+        if std_dev_threshold is not None:
+            result |= tf.norm(tf.reshape(std_dev, list(batch_shape) + [-1]), axis=-1) < std_dev_threshold
+        if improvement_threshold is not None:
+            result |= improvement < improvement_threshold
+        return tf.reduce_all(result)
+
+    def cond(i: tf.Tensor, mean: tf.Tensor, std_dev: tf.Tensor, score: tf.Tensor, improvement: tf.Tensor) -> tf.Tensor:
+        return (i < iterations) & ((i == 0) | ~converged(std_dev, improvement))
+
+    def body(i: tf.Tensor,
+             mean: tf.Tensor,
+             std_dev: tf.Tensor,
+             score: tf.Tensor,
+             improvement: tf.Tensor,
+             ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor, tf.Tensor]:
+        mean, std_dev, new_score = refit_fn(i, mean, std_dev)
+        return i + 1, mean, std_dev, new_score, new_score - score
+
+    initial_score = tf.fill(batch_shape, -np.inf)
+    initial_improvement = tf.fill(batch_shape, np.inf)
+    i, mean, std_dev, _, _ = tf.while_loop(cond, body, [tf.constant(0), mean, std_dev, initial_score, initial_improvement])
+    return mean, std_dev, i
+
+
+@xla_function('planner', experimental_autograph_options=tf.autograph.experimental.Feature.ASSERT_STATEMENTS)
 def cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
-                         rnn: RNN,
+                         rollout_fn: RolloutFunction,
                          objective_fn: Callable[[Tuple[tf.Tensor, ...]], tf.Tensor],
                          action_space: gym.spaces.box,
                          horizon: int = 12,
@@ -70,7 +119,9 @@ def cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...
                          mean: Optional[tf.Tensor] = None,
                          std_dev: Optional[tf.Tensor] = None,
                          visualization_goal: Optional[tf.Tensor] = None,
-                         ) -> Tuple[tf.Tensor, tf.Tensor]:
+                         std_dev_threshold: Optional[float] = None,
+                         improvement_threshold: Optional[float] = None,
+                         ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
     """
     Calculates an action sequence of length `horizon` using the following method:
     ```
@@ -79,7 +130,8 @@ def cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...
         sample `amount` action sequences from mean and stddev
         predict objective for all action sequences
         update mean and stddev based on best `top_k` action sequences
-    return mean, std_dev
+        stop if norm(std_dev) < std_dev_threshold or mean top_k objective improved less than improvement_threshold
+    return mean, std_dev, number of iterations
     ```
     """
     action_shape = action_space.low.shape
@@ -95,14 +147,14 @@ def cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...
     else:
         std_dev = std_dev[:horizon]
 
-    for i in range(iterations):
+    def refit(i: tf.Tensor, mean: tf.Tensor, std_dev: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
         # Sample action proposals from belief.
         normal = tf.random.normal((amount, horizon) + action_shape)
         actions = normal * std_dev[tf.newaxis, :, :] + mean[tf.newaxis, :, :]
         actions = tf.clip_by_value(actions, action_space.low, action_space.high)
 
         # Evaluate proposal actions.
-        states = rnn(actions, initial_state=initial_state, training=False)
+        states = rollout_fn(actions, initial_state)
         objective = objective_fn(states)
 
         # Re-fit belief to the best ones.
@@ -115,13 +167,86 @@ def cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...
             positions = simulate_plan(best_actions)
             scores_normalized = best_scores - tf.reduce_min(best_scores)
             scores_normalized = scores_normalized / tf.reduce_max(scores_normalized)
-            tf.numpy_function(plot_positions, [positions, scores_normalized, visualization_goal, tf.constant(i)], [])
+            tf.numpy_function(plot_positions, [positions, scores_normalized, visualization_goal, i], [])
+        return mean, std_dev, tf.reduce_mean(best_scores)
+
+    return iterate_until_converged(refit, mean, std_dev, iterations,
+                                   std_dev_threshold=std_dev_threshold,
+                                   improvement_threshold=improvement_threshold)
+
+
+@xla_function('planner')
+def batched_cross_entropy_method(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
+                                 rollout_fn: RolloutFunction,
+                                 objective_fn: Callable[[Tuple[tf.Tensor, ...]], tf.Tensor],
+                                 action_space: gym.spaces.box,
+                                 horizon: int = 12,
+                                 amount: int = 1000,
+                                 top_k: int = 100,
+                                 iterations: int = 10,
+                                 mean: Optional[tf.Tensor] = None,
+                                 std_dev: Optional[tf.Tensor] = None,
+                                 std_dev_threshold: Optional[float] = None,
+                                 improvement_threshold: Optional[float] = None,
+                                 ) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+    """
+    Same as cross_entropy_method, but plans independently for each of the K batch elements of `initial_state` in a
+    single graph. `mean` and `std_dev` have shape [K, horizon] + action_shape. When stopping early, iteration continues
+    until all K plans have converged.
+    """
+    action_shape = action_space.low.shape
+    batch_size = initial_state[0].shape[0]
+    initial_state = tf.nest.map_structure(
+        lambda x: tf.reshape(tf.tile(x[:, tf.newaxis], [1, amount] + [1] * (x.shape.ndims - 1)),
+                             [batch_size * amount] + x.shape[1:].as_list()),
+        initial_state)
+
+    if mean is None:
+        mean = tf.stack([tf.stack([(action_space.high + action_space.low) / 2] * horizon, 0)] * batch_size, 0)
+    else:
+        mean = mean[:, :horizon]
+    if std_dev is None:
+        std_dev = tf.stack([tf.stack([(action_space.high - action_space.low) / 2] * horizon, 0)] * batch_size, 0)
+    else:
+        std_dev = std_dev[:, :horizon]
+
+    def refit(i: tf.Tensor, mean: tf.Tensor, std_dev: tf.Tensor) -> Tuple[tf.Tensor, tf.Tensor, tf.Tensor]:
+        # Sample action proposals from belief.
+        normal = tf.random.normal((batch_size, amount, horizon) + action_shape)
+        actions = normal * std_dev[:, tf.newaxis] + mean[:, tf.newaxis]
+        actions = tf.clip_by_value(actions, action_space.low, action_space.high)
+
+        # Evaluate proposal actions.
+        states = rollout_fn(tf.reshape(actions, (batch_size * amount, horizon) + action_shape), initial_state)
+        objective = tf.reshape(objective_fn(states), [batch_size, amount])
+
+        # Re-fit belief to the best ones.
+        best_scores, indices = tf.nn.top_k(objective, top_k, sorted=False)
+        best_actions = tf.gather(actions, indices, batch_dims=1)
+        mean, variance = tf.nn.moments(best_actions, 1)
+        std_dev = tf.sqrt(variance + 1e-6)
+        return mean, std_dev, tf.reduce_mean(best_scores, axis=1)
 
-    return mean, std_dev
+    return iterate_until_converged(refit, mean, std_dev, iterations, [batch_size],
+                                   std_dev_threshold=std_dev_threshold,
+                                   improvement_threshold=improvement_threshold)
 
 
-@gin.configurable(whitelist=['horizon', 'amount', 'top_k', 'iterations'])
+@gin.configurable(whitelist=['horizon', 'amount', 'top_k', 'iterations', 'warm_iterations', 'warm_amount', 'warm_std_dev',
+                             'std_dev_threshold', 'improvement_threshold', 'fused_rollout', 'xla_rollout'])
 class CrossEntropyMethod(Planner):
+    """
+    With `fused_rollout`, candidate action sequences are evaluated using the predictor's unrolled rollout method instead
+    of an RNN layer, optionally compiled with XLA (`xla_rollout`).
+
+    If `std_dev_threshold` or `improvement_threshold` is given, planning stops before the given number of iterations
+    once the plan has converged (see iterate_until_converged). The number of iterations used in the last call is
+    available in `statistics['plan_iterations']`.
+
+    When warm started from the previous plan (see get_warm_started_plan), `warm_iterations` and `warm_amount` are used
+    instead of `iterations` and `amount` (with `top_k` scaled accordingly). If `warm_std_dev` is given, the standard
+    deviation of the shifted plan is reset to this fraction of the prior standard deviation, otherwise it is kept.
+    """
     def __init__(self,
                  predictor: OpenLoopPredictor,
                  objective_decoder: DecoderFunction,
@@ -130,13 +255,29 @@ class CrossEntropyMethod(Planner):
                  amount: int = 1000,
                  top_k: int = 100,
                  iterations: int = 10,
+                 warm_iterations: Optional[int] = None,
+                 warm_amount: Optional[int] = None,
+                 warm_std_dev: Optional[float] = None,
+                 std_dev_threshold: Optional[float] = None,
+                 improvement_threshold: Optional[float] = None,
+                 fused_rollout: bool = False,
+                 xla_rollout: bool = False,
                  ) -> None:
         super().__init__(predictor, objective_decoder, action_space)
         self.horizon = horizon
         self.amount = amount
         self.top_k = top_k
         self.iterations = iterations
+        self.warm_iterations = iterations if warm_iterations is None else warm_iterations
+        self.warm_amount = amount if warm_amount is None else warm_amount
+        self.warm_top_k = max(1, top_k * self.warm_amount // amount)
+        self.warm_std_dev = warm_std_dev
+        self.std_dev_threshold = std_dev_threshold
+        self.improvement_threshold = improvement_threshold
+        self._iterations_used = tf.Variable(0, trainable=False, name='plan_iterations')
         self._rnn = RNN(predictor, return_sequences=True, name='planner_rnn')
+        self.fused_rollout = fused_rollout
+        self.xla_rollout = xla_rollout
 
     @classmethod
     def from_model(cls, model: Model, action_space: gym.spaces.box) -> CrossEntropyMethod:
@@ -144,7 +285,17 @@ class CrossEntropyMethod(Planner):
                    objective_decoder=model.decoders['reward'],
                    action_space=action_space)
 
+    @property
+    def statistics(self) -> Dict[str, tf.Variable]:
+        return {'plan_iterations': self._iterations_used}
+
+    def _rollout(self, actions: tf.Tensor, initial_state: Tuple[tf.Tensor, ...]) -> Tuple[tf.Tensor, ...]:
+        if self.fused_rollout:
+            return self._predictor.rollout(actions, initial_state, xla=self.xla_rollout)
+        return self._rnn(actions, initial_state=initial_state, training=False)
+
     @tf.function
+    @count_traces
     def get_action(self,
                    initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                    visualization_goal: Optional[tf.Tensor] = None,
@@ -153,23 +304,102 @@ class CrossEntropyMethod(Planner):
         return mean[0, :]
 
     @tf.function
+    @count_traces
     def get_plan(self,
                  initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                  initial_mean: Optional[tf.Tensor] = None,
                  initial_std_dev: Optional[tf.Tensor] = None,
                  visualization_goal: Optional[tf.Tensor] = None,
+                 warm: bool = False,
                  ) -> Tuple[tf.Tensor, tf.Tensor]:
         mean: tf.Tensor
         std_dev: tf.Tensor
-        mean, std_dev = cross_entropy_method(initial_state,
-                                             self._rnn,
-                                             self._objective_fn,
-                                             self.action_space,
-                                             self.horizon,
-                                             self.amount,
-                                             self.top_k,
-                                             self.iterations,
-                                             initial_mean,
-                                             initial_std_dev,
-                                             visualization_goal)
+        mean, std_dev, iterations = cross_entropy_method(initial_state,
+                                                         self._rollout,
+                                                         self._objective_fn,
+                                                         self.action_space,
+                                                         self.horizon,
+                                                         self.warm_amount if warm else self.amount,
+                                                         self.warm_top_k if warm else self.top_k,
+                                                         self.warm_iterations if warm else self.iterations,
+                                                         initial_mean,
+                                                         initial_std_dev,
+                                                         visualization_goal,
+                                                         self.std_dev_threshold,
+                                                         self.improvement_threshold)
+        self._iterations_used.assign(iterations)
+        return mean, std_dev
+
+    @tf.function
+    @count_traces
+    def get_warm_started_plan(self,
+                              initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
+                              previous_mean: tf.Tensor,
+                              previous_std_dev: tf.Tensor,
+                              warm: tf.Tensor,
+                              visualization_goal: Optional[tf.Tensor] = None,
+                              ) -> Tuple[tf.Tensor, tf.Tensor]:
+        """
+        Plan starting from the previous plan shifted by one time step, with the last step taken from the prior. `warm`
+        is a boolean of shape [batch_size] (or a scalar if the plan is unbatched) indicating which batch elements have a
+        valid previous plan; the others start from the prior. The warm settings are only used if all elements are warm.
+        """
+        batched = previous_mean.shape.ndims > len(self.action_space.low.shape) + 1
+        prior_mean, prior_std_dev = self._prior()
+        if batched:
+            prior_mean = tf.broadcast_to(prior_mean, previous_mean.shape)
+            prior_std_dev = tf.broadcast_to(prior_std_dev, previous_std_dev.shape)
+        horizon_axis = 1 if batched else 0
+        mean = tf.concat([tf.gather(previous_mean, tf.range(1, self.horizon), axis=horizon_axis),
+                          tf.gather(prior_mean, [self.horizon - 1], axis=horizon_axis)], horizon_axis)
+        if self.warm_std_dev is None:
+            std_dev = tf.concat([tf.gather(previous_std_dev, tf.range(1, self.horizon), axis=horizon_axis),
+                                 tf.gather(prior_std_dev, [self.horizon - 1], axis=horizon_axis)], horizon_axis)
+        else:
+            std_dev = self.warm_std_dev * prior_std_dev
+        warm_mask = tf.reshape(warm, warm.shape.as_list() + [1] * (mean.shape.ndims - warm.shape.ndims))
+        mean = tf.where(warm_mask, mean, prior_mean)
+        std_dev = tf.where(warm_mask, std_dev, prior_std_dev)
+        if batched:
+            def plan(warm: bool) -> Tuple[tf.Tensor, tf.Tensor]:
+                return self.get_batched_plan(initial_state, mean, std_dev, warm=warm)
+        else:
+            def plan(warm: bool) -> Tuple[tf.Tensor, tf.Tensor]:
+                return self.get_plan(initial_state, mean, std_dev, visualization_goal, warm=warm)
+        return tf.cond(tf.reduce_all(warm), lambda: plan(True), lambda: plan(False))
+
+    def _prior(self) -> Tuple[tf.Tensor, tf.Tensor]:
+        mean = tf.stack([(self.action_space.high + self.action_space.low) / 2] * self.horizon, 0)
+        std_dev = tf.stack([(self.action_space.high - self.action_space.low) / 2] * self.horizon, 0)
+        return tf.cast(mean, tf.float32), tf.cast(std_dev, tf.float32)
+
+    @tf.function
+    @count_traces
+    def get_actions(self, initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...]) -> tf.Tensor:
+        mean, std_dev = self.get_batched_plan(initial_state)
+        return mean[:, 0]
+
+    @tf.function
+    @count_traces
+    def get_batched_plan(self,
+                         initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
+                         initial_mean: Optional[tf.Tensor] = None,
+                         initial_std_dev: Optional[tf.Tensor] = None,
+                         warm: bool = False,
+                         ) -> Tuple[tf.Tensor, tf.Tensor]:
+        mean: tf.Tensor
+        std_dev: tf.Tensor
+        mean, std_dev, iterations = batched_cross_entropy_method(initial_state,
+                                                                 self._rollout,
+                                                                 self._objective_fn,
+                                                                 self.action_space,
+                                                                 self.horizon,
+                                                                 self.warm_amount if warm else self.amount,
+                                                                 self.warm_top_k if warm else self.top_k,
+                                                                 self.warm_iterations if warm else self.iterations,
+                                                                 initial_mean,
+                                                                 initial_std_dev,
+                                                                 self.std_dev_threshold,
+                                                                 self.improvement_threshold)
+        self._iterations_used.assign(iterations)
         return mean, std_dev
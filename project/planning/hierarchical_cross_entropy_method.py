@@ -14,6 +14,7 @@ import tensorflow as tf
 from project.model import Model
 from project.networks import DenseVAE
 from project.networks.predictors import OpenLoopPredictor
+from project.util.tf.tracing import count_traces
 
 from .base import DecoderFunction, Planner
 from .cross_entropy_method import CrossEntropyMethod
@@ -56,6 +57,7 @@ class HierarchicalCrossEntropyMethod(Planner):
                    objective_decoder=model.decoders['reward'])
 
     @tf.function
+    @count_traces
     def get_action(self,
                    initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                    visualization_goal: Optional[tf.Tensor] = None,
@@ -64,6 +66,7 @@ class HierarchicalCrossEntropyMethod(Planner):
         return mean[0, :]
 
     @tf.function
+    @count_traces
     def get_plan(self,
                  initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                  initial_mean: Optional[tf.Tensor] = None,
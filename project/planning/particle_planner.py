@@ -14,12 +14,14 @@ from project.model import Model
 from project.networks.predictors import OpenLoopPredictor
 from project.networks.predictors.rssm import FullState
 from project.util.tf import combine_dims, split_dim
+from project.util.tf.compilation import xla_function
 from project.util.tf.discounting import lambda_return
+from project.util.tf.tracing import count_traces
 
 from .base import DecoderFunction, Planner
 
 
-@tf.function(experimental_autograph_options=tf.autograph.experimental.Feature.ASSERT_STATEMENTS)
+@xla_function('planner', experimental_autograph_options=tf.autograph.experimental.Feature.ASSERT_STATEMENTS)
 def particle_planner(initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                      predictor: OpenLoopPredictor,
                      reward_decoder: DecoderFunction,
@@ -120,6 +122,7 @@ class ParticlePlanner(Planner):
                    action_space=action_space)
 
     @tf.function
+    @count_traces
     def get_action(self,
                    initial_state: Tuple[Union[tf.Tensor, tf.Variable], ...],
                    visualization_goal: Optional[tf.Tensor] = None,
@@ -53,9 +53,11 @@ def habitat_task(training: bool,
         kwargs.setdefault('action_repeat', action_repeat)
         kwargs.setdefault('max_duration', max_length)
         kwargs.setdefault('wrappers', [(wrapper, kwarg_fn(kwargs)) for wrapper, kwarg_fn in wrappers])
+        # Without composite actions, each action is 3 Habitat steps (turn, move, turn)
+        steps_per_action = 1 if gin.query_parameter('Habitat.composite_actions') else 3
         kwargs = dict(habitat.get_config(training=training,
                                          top_down_map=kwargs.get('capture_video', False),
-                                         max_steps=max_length * action_repeat * 3),  # times 3 because TURN_ANGLE is really 3 actions
+                                         max_steps=max_length * action_repeat * steps_per_action),
                       **kwargs)
         return habitat.VectorHabitat(habitat_env_ctor, kwargs)
     return Task('habitat', env_ctor, max_length, state_components, observation_components, metrics)
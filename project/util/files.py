@@ -10,6 +10,9 @@ from typing import Optional
 def link_directory_contents(source: Path, dest: Path) -> None:
     dest.mkdir(parents=True, exist_ok=True)
     for src_file in source.iterdir():
+        if src_file.is_dir():
+            # Directories such as episode stores are written to, so they must not be shared
+            continue
         dest_file = dest / src_file.name
         dest_file.symlink_to(os.path.relpath(src_file, dest))
 
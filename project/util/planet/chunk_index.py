@@ -0,0 +1,56 @@
+# chunk_index.py: Index of chunk offsets in an episode store
+#
+# (C) 2020, Daniel Mouritzen
+
+import numpy as np
+
+from .episode_store import EpisodeStore
+
+
+class ChunkIndex:
+    """Valid chunk offsets for each episode of an EpisodeStore.
+
+    Offsets are sampled with the same semantics as chunk_sequence with randomize=True: successful episodes are extended
+    by `success_padding` copies of their last element, and the offset of a window of `window` time steps is uniformly
+    distributed over all positions where it fits (or zero if the episode is shorter than the window).
+    """
+    def __init__(self, window: int, success_padding: int = 0) -> None:
+        self._window = window
+        self._success_padding = success_padding
+        self._lengths = np.zeros([0], dtype=np.int64)
+        self._padded_lengths = np.zeros([0], dtype=np.int64)
+
+    @property
+    def window(self) -> int:
+        return self._window
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self._lengths
+
+    @property
+    def padded_lengths(self) -> np.ndarray:
+        return self._padded_lengths
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+    def update(self, store: EpisodeStore) -> int:
+        """Add episodes that have been appended to the store since the last update. Returns the number of new episodes."""
+        new = range(len(self), len(store))
+        if not new:
+            return 0
+        assert store.spec is not None
+        lengths = store.lengths[new.start:new.stop].astype(np.int64)
+        padded_lengths = lengths.copy()
+        if self._success_padding and 'success' in store.spec:
+            success = np.array([store.read(i, lengths[j] - 1, keys={'success'})['success'][-1] for j, i in enumerate(new)])
+            padded_lengths += self._success_padding * success.astype(bool)
+        self._lengths = np.concatenate([self._lengths, lengths])
+        self._padded_lengths = np.concatenate([self._padded_lengths, padded_lengths])
+        return len(new)
+
+    def sample_offsets(self, episodes: np.ndarray) -> np.ndarray:
+        """Sample a random window offset for each of the given episode indices."""
+        max_offsets = np.maximum(0, self._padded_lengths[episodes] - self._window)
+        return np.random.randint(0, max_offsets + 1, dtype=np.int64)
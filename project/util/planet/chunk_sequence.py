@@ -16,8 +16,11 @@ from typing import Dict, Optional, cast
 
 import tensorflow as tf
 
+from project.util.tf.tracing import count_traces
+
 
 @tf.function
+@count_traces
 def chunk_sequence(sequence: Dict[str, tf.Tensor],
                    chunk_length: int,
                    randomize: bool = True,
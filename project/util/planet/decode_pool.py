@@ -0,0 +1,141 @@
+# decode_pool.py: Background decoding of episode files
+#
+# (C) 2020, Daniel Mouritzen
+
+import os
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Set
+
+import numpy as np
+import tensorflow as tf
+from loguru import logger
+
+Episode = Dict[str, np.ndarray]
+
+_pools: Dict[str, 'DecodePool'] = {}
+_pools_lock = threading.Lock()
+
+
+class DecodePool:
+    """Watches a directory for new episode files and decodes them in background threads.
+
+    Decoded episodes are put in a bounded queue, so decoding pauses when the consumer falls behind. Decompression and
+    file reading mostly happen outside the GIL, so threads are sufficient to keep the decoding off the critical path of
+    the consumer.
+    """
+    def __init__(self,
+                 directory: str,
+                 reader: Callable[[str], Episode],
+                 num_workers: int = 2,
+                 queue_size: int = 100,
+                 scan_interval: float = 1.0,
+                 name: str = 'decode_pool',
+                 ) -> None:
+        self._directory = directory
+        self._reader = reader
+        self._scan_interval = scan_interval
+        self._name = name
+        self._filenames: 'queue.Queue[str]' = queue.Queue()
+        self._episodes: 'queue.Queue[Episode]' = queue.Queue(maxsize=queue_size)
+        self._seen: Set[str] = set()
+        self._lock = threading.Lock()
+        self._latencies: List[float] = []
+        self._num_decoded = 0
+        self._num_failed = 0
+        self._initial_files: Set[str] = set()  # Files found by the first scan
+        self._num_failed_initial = 0
+        self._num_delivered = 0
+        self._initial_scan = threading.Event()
+        self._stop = threading.Event()
+        self._threads = [threading.Thread(target=self._scan, name=f'{name}_scan', daemon=True)]
+        self._threads += [threading.Thread(target=self._work, name=f'{name}_worker_{i}', daemon=True)
+                          for i in range(num_workers)]
+        for thread in self._threads:
+            thread.start()
+        with _pools_lock:
+            _pools[name] = self
+
+    def get_ready(self, wait: bool = False, wait_all: bool = False) -> List[Episode]:
+        """Returns all episodes decoded so far. If wait_all is set, blocks until all files found by the first scan of the
+        directory have been decoded or have failed to decode. If wait is set, then blocks until at least one episode is
+        available."""
+        episodes = []
+        if wait_all:
+            self._initial_scan.wait()
+            while self._num_delivered + len(episodes) + self._num_failed_initial < len(self._initial_files):
+                try:
+                    episodes.append(self._episodes.get(timeout=self._scan_interval))
+                except queue.Empty:
+                    continue
+        if wait and not episodes:
+            episodes.append(self._episodes.get())
+        while True:
+            try:
+                episodes.append(self._episodes.get_nowait())
+            except queue.Empty:
+                self._num_delivered += len(episodes)
+                return episodes
+
+    def metrics(self) -> Dict[str, float]:
+        """Returns current queue depth and mean decode latency since the last call."""
+        with self._lock:
+            latencies, self._latencies = self._latencies, []
+            num_decoded = self._num_decoded
+        return {'queue_depth': self._episodes.qsize(),
+                'pending_files': self._filenames.qsize(),
+                'decode_latency': float(np.mean(latencies)) if latencies else 0.0,
+                'episodes_decoded': num_decoded}
+
+    def close(self) -> None:
+        self._stop.set()
+        with _pools_lock:
+            if _pools.get(self._name) is self:
+                del _pools[self._name]
+
+    def _scan(self) -> None:
+        while not self._stop.is_set():
+            filenames = [filename for filename in sorted(tf.io.gfile.glob(os.path.join(self._directory, '*.npz')))
+                         if filename not in self._seen]
+            if not self._initial_scan.is_set():
+                # Must be set before the files are queued, so failures are attributed correctly
+                self._initial_files = set(filenames)
+            for filename in filenames:
+                self._seen.add(filename)
+                self._filenames.put(filename)
+            self._initial_scan.set()
+            self._stop.wait(self._scan_interval)
+
+    def _work(self) -> None:
+        while not self._stop.is_set():
+            try:
+                filename = self._filenames.get(timeout=self._scan_interval)
+            except queue.Empty:
+                continue
+            start = time.perf_counter()
+            try:
+                episode = self._reader(filename)
+            except Exception as e:
+                logger.warning(f'Failed to decode {filename}: {e}')
+                with self._lock:
+                    self._num_failed += 1
+                    if filename in self._initial_files:
+                        self._num_failed_initial += 1
+                continue
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+                self._num_decoded += 1
+            while not self._stop.is_set():
+                try:
+                    self._episodes.put(episode, timeout=self._scan_interval)
+                    break
+                except queue.Full:
+                    continue
+
+
+def decode_pool_metrics() -> Dict[str, float]:
+    """Metrics of all active decode pools, prefixed by pool name"""
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {f'{name}/{key}': value for name, pool in pools for key, value in pool.metrics().items()}
@@ -0,0 +1,166 @@
+# episode_store.py: Append-only memory-mapped episode storage
+#
+# (C) 2020, Daniel Mouritzen
+
+"""Append-only columnar episode store.
+
+Each key of an episode is stored in its own uncompressed binary file (`<key>.bin`), with the time steps of all episodes
+concatenated along the first axis. The file `index.bin` holds one `(start, length)` row of int64 per episode, and
+`names.txt` the corresponding episode names. Readers memory-map the data files, so slices of episodes can be read without
+loading whole episodes into memory.
+
+Episodes are appended by writing the data files first and the index last, so a reader that only looks at complete index
+rows never sees a partially written episode. Data left behind by an append that did not finish is truncated before the
+next append. Appending requires an exclusive lock on `index.bin`, so there can only be one writer at a time. Several
+threads can write through a single EpisodeStore, whose appends are serialized.
+"""
+
+import fcntl
+import json
+import os
+import threading
+from typing import BinaryIO, Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+Episode = Dict[str, np.ndarray]
+
+_INDEX_DTYPE = np.dtype('<i8')
+
+STORE_DIR = 'store'  # Name of the store subdirectory inside an episode directory
+
+
+class EpisodeStore:
+    def __init__(self, directory: str) -> None:
+        self._directory = os.path.expanduser(directory)
+        self._spec: Optional[Dict[str, Tuple[np.dtype, Tuple[int, ...]]]] = None
+        self._index = np.zeros((0, 2), dtype=_INDEX_DTYPE)
+        self._names: List[str] = []
+        self._arrays: Dict[str, np.memmap] = {}
+        self._num_rows = 0
+        self._append_lock = threading.Lock()
+        self.refresh()
+
+    @property
+    def directory(self) -> str:
+        return self._directory
+
+    @property
+    def spec(self) -> Optional[Dict[str, Tuple[np.dtype, Tuple[int, ...]]]]:
+        """Mapping from key to dtype and per-step shape, or None if the store is empty."""
+        return self._spec
+
+    @property
+    def names(self) -> List[str]:
+        return self._names
+
+    @property
+    def lengths(self) -> np.ndarray:
+        return self._index[:, 1]
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def exists(self) -> bool:
+        return os.path.isfile(self._path('spec.json'))
+
+    def refresh(self) -> int:
+        """Pick up episodes appended since the last refresh. Returns the number of new episodes."""
+        if not self.exists():
+            return 0
+        if self._spec is None:
+            with open(self._path('spec.json')) as f:
+                spec = json.load(f)
+            self._spec = {key: (np.dtype(value['dtype']), tuple(value['shape'])) for key, value in spec.items()}
+        old_len = len(self._index)
+        index = np.fromfile(self._path('index.bin'), dtype=_INDEX_DTYPE)
+        index = index[:len(index) // 2 * 2].reshape((-1, 2))
+        if len(index) == old_len:
+            return 0
+        with open(self._path('names.txt')) as f:
+            names = f.read().splitlines()
+        self._index = index
+        self._names = names[:len(index)]
+        self._open_arrays()
+        return len(index) - old_len
+
+    def read(self, episode: int, start: int = 0, stop: Optional[int] = None, keys: Optional[Set[str]] = None) -> Episode:
+        """Read time steps `start:stop` of an episode. The returned arrays are copies, not views of the memory map."""
+        offset, length = self._index[episode]
+        stop = length if stop is None else min(stop, length)
+        start = min(start, stop)
+        return {key: np.array(array[offset + start:offset + stop])
+                for key, array in self._arrays.items()
+                if keys is None or key in keys}
+
+    def append(self, episode: Episode, name: str) -> None:
+        """Append an episode. Raises RuntimeError if another writer is appending to the store at the same time."""
+        os.makedirs(self._directory, exist_ok=True)
+        with self._append_lock, open(self._path('index.bin'), 'ab') as index_file:
+            try:
+                fcntl.flock(index_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                raise RuntimeError(f'Another writer is appending to the episode store in {self._directory}.') from None
+            self._discard_incomplete()
+            self._append(episode, name, index_file)
+        self.refresh()
+
+    def _append(self, episode: Episode, name: str, index_file: BinaryIO) -> None:
+        episode = {key: np.ascontiguousarray(value) for key, value in episode.items()}
+        if self._spec is None:
+            self._spec = {key: (value.dtype, value.shape[1:]) for key, value in episode.items()}
+            spec = {key: {'dtype': dtype.str, 'shape': list(shape)} for key, (dtype, shape) in self._spec.items()}
+            with open(self._path('spec.json'), 'w') as f:
+                json.dump(spec, f)
+        if set(episode.keys()) != set(self._spec.keys()):
+            raise ValueError(f'Episode keys {sorted(episode.keys())} do not match store keys {sorted(self._spec.keys())}.')
+        lengths = {len(value) for value in episode.values()}
+        if len(lengths) != 1:
+            raise ValueError(f'Episode sequences have different lengths: {lengths}')
+        length = lengths.pop()
+        for key, value in episode.items():
+            shape = self._spec[key][1]
+            if value.shape[1:] != shape:
+                raise ValueError(f"Shape {value.shape[1:]} of '{key}' does not match store shape {shape}.")
+        for key, value in episode.items():
+            dtype = self._spec[key][0]
+            with open(self._path(f'{key}.bin'), 'ab') as f:
+                f.write(value.astype(dtype, copy=False).tobytes())
+        with open(self._path('names.txt'), 'a') as f:
+            f.write(name + '\n')
+        index_file.write(np.array([self._num_rows, length], dtype=_INDEX_DTYPE).tobytes())
+
+    def _discard_incomplete(self) -> None:
+        """Truncate data beyond the last complete index row, e.g. from a writer that crashed while appending"""
+        if not self.exists():
+            return
+        index_path = self._path('index.bin')
+        excess = os.path.getsize(index_path) % (2 * _INDEX_DTYPE.itemsize)
+        if excess:
+            os.truncate(index_path, os.path.getsize(index_path) - excess)
+        self.refresh()
+        assert self._spec is not None
+        for key, (dtype, shape) in self._spec.items():
+            path = self._path(f'{key}.bin')
+            size = self._num_rows * dtype.itemsize * int(np.prod(shape))
+            if os.path.exists(path) and os.path.getsize(path) > size:
+                os.truncate(path, size)
+        if os.path.exists(self._path('names.txt')):
+            with open(self._path('names.txt'), 'r+') as f:
+                names = f.read().splitlines(keepends=True)
+                if len(names) > len(self._index):
+                    f.seek(0)
+                    f.truncate()
+                    f.writelines(names[:len(self._index)])
+
+    def _open_arrays(self) -> None:
+        assert self._spec is not None
+        self._num_rows = int(self._index[-1].sum()) if len(self._index) else 0
+        self._arrays = {}
+        if not self._num_rows:
+            return
+        for key, (dtype, shape) in self._spec.items():
+            self._arrays[key] = np.memmap(self._path(f'{key}.bin'), dtype=dtype, mode='r', shape=(self._num_rows,) + shape)
+
+    def _path(self, filename: str) -> str:
+        return os.path.join(self._directory, filename)
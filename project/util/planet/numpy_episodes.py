@@ -18,20 +18,25 @@
 import functools
 import os
 import random
-from typing import Any, Dict, Generator, Iterable, List, Optional, Tuple, TypeVar
+from typing import Any, Callable, Dict, Generator, Iterable, List, Optional, Tuple, TypeVar
 
 import gin
 import numpy as np
 import tensorflow as tf
 from scipy.ndimage import interpolation
 
+from .chunk_index import ChunkIndex
 from .chunk_sequence import chunk_sequence
-from .preprocess import preprocess
+from .decode_pool import DecodePool
+from .episode_store import STORE_DIR, EpisodeStore
+from .preprocess import device_preprocessing, preprocess
+from .prioritized_sampler import PrioritizedSampler
 
 Episode = Dict[str, np.ndarray]
 
 
-@gin.configurable(whitelist=['num_chunks', 'loader_update_every', 'train_action_noise', 'success_padding'])
+@gin.configurable(whitelist=['num_chunks', 'loader_update_every', 'train_action_noise', 'success_padding',
+                             'use_episode_store', 'decode_workers', 'decode_queue_size', 'prioritized'])
 def numpy_episodes(train_dir: str,
                    test_dir: str,
                    shape: Tuple[int, int],
@@ -39,6 +44,10 @@ def numpy_episodes(train_dir: str,
                    loader_update_every: int = 1000,
                    train_action_noise: float = 0.3,
                    success_padding: int = 0,
+                   use_episode_store: bool = False,
+                   decode_workers: int = 0,
+                   decode_queue_size: int = 100,
+                   prioritized: bool = False,
                    ) -> Tuple[tf.data.Dataset, tf.data.Dataset]:
     """Read sequences stored as compressed Numpy files as a TensorFlow dataset.
 
@@ -51,17 +60,50 @@ def numpy_episodes(train_dir: str,
         train_action_noise: Amount of noise to add to actions of training episodes
         success_padding: Number of padding elements equal to the last element to
             add after successful episodes.
+        use_episode_store: Read episodes from the memory-mapped EpisodeStore in
+            each directory instead of the NPZ files. Requires episodes to be
+            collected with CollectGymDataset.episode_store enabled.
+        decode_workers: If nonzero, new NPZ files are decoded by this many
+            background threads instead of inside the generator.
+        decode_queue_size: Maximum number of decoded episodes waiting to be
+            picked up by the generator when using decode_workers.
+        prioritized: Sample episodes using a PrioritizedSampler instead of
+            splitting evenly between new and old episodes. Requires
+            use_episode_store. The sampled episode indices are included under
+            the key `episode_index`, so losses can be reported back with
+            report_episode_losses('train', ...).
 
     Returns:
         Structured data from numpy episodes as Tensors.
     """
-    loader = recent_loader
+    assert use_episode_store or not prioritized, 'Prioritized sampling requires use_episode_store'
     dtypes, shapes, _ = _read_spec(train_dir)
+    chunked = False
+    loaders: Dict[str, Callable[..., Generator[Episode, None, None]]]
+    if use_episode_store:
+        for directory in (train_dir, test_dir):
+            import_npz_episodes(directory)
+        # The loader yields chunks directly, unless the number of chunks depends on episode length
+        chunked = num_chunks is not None
+        loaders = {phase: functools.partial(store_loader, chunk_length=shape[1], num_chunks=num_chunks,
+                                            success_padding=success_padding,
+                                            sampler=PrioritizedSampler(name=phase) if prioritized else None)
+                   for phase in ['train', 'test']}
+        if prioritized:
+            dtypes['episode_index'], shapes['episode_index'] = tf.int32, (None,)
+    elif decode_workers:
+        loader = functools.partial(pooled_loader, num_workers=decode_workers, queue_size=decode_queue_size)
+        loaders = {'train': loader, 'test': loader}
+    else:
+        loaders = {'train': recent_loader, 'test': recent_loader}
+    if chunked:
+        shapes = {key: (shape[1],) + value[1:] for key, value in shapes.items()}
+        dtypes['length'], shapes['length'] = tf.int32, (1,)
     train = tf.data.Dataset.from_generator(
-        functools.partial(loader, train_dir, loader_update_every, train_action_noise),
+        functools.partial(loaders['train'], train_dir, loader_update_every, train_action_noise),
         dtypes, shapes)
     test = tf.data.Dataset.from_generator(
-        functools.partial(loader, test_dir, loader_update_every),
+        functools.partial(loaders['test'], test_dir, loader_update_every),
         dtypes, shapes)
 
     def chunking(x: Dict[str, tf.Tensor]) -> tf.data.Dataset:
@@ -72,12 +114,13 @@ def numpy_episodes(train_dir: str,
         sequence['image'] = preprocess(sequence['image'])
         return sequence
 
-    train, test = (dataset
-                   .flat_map(chunking)
-                   .batch(shape[0], drop_remainder=True)
-                   .map(sequence_preprocess_fn, tf.data.experimental.AUTOTUNE)
-                   .prefetch(tf.data.experimental.AUTOTUNE)
-                   for dataset in (train, test))
+    if not chunked:
+        train, test = (dataset.flat_map(chunking) for dataset in (train, test))
+    train, test = (dataset.batch(shape[0], drop_remainder=True) for dataset in (train, test))
+    if not device_preprocessing():
+        # Otherwise images are kept as uint8 and preprocessed by the model
+        train, test = (dataset.map(sequence_preprocess_fn, tf.data.experimental.AUTOTUNE) for dataset in (train, test))
+    train, test = (dataset.prefetch(tf.data.experimental.AUTOTUNE) for dataset in (train, test))
     return train, test
 
 
@@ -118,6 +161,83 @@ def recent_loader(directory: str,
             recent[filename] = episode_reader(filename, action_noise=action_noise)
 
 
+def pooled_loader(directory: str,
+                  update_every: int,
+                  action_noise: Optional[float] = None,
+                  num_workers: int = 2,
+                  queue_size: int = 100,
+                  ) -> Generator[Episode, None, None]:
+    """Same as recent_loader, but new files are decoded in the background by a DecodePool"""
+    pool = DecodePool(directory,
+                      functools.partial(episode_reader, action_noise=action_noise),
+                      num_workers=num_workers,
+                      queue_size=queue_size,
+                      name=os.path.basename(directory))
+    recent: List[Episode] = []
+    cache: List[Episode] = []
+    try:
+        while True:
+            episodes: List[Episode] = []
+            episodes += _sample(recent, update_every // 2)
+            episodes += _sample(cache, update_every // 2)
+            for episode in _permuted(episodes, update_every):
+                yield episode
+            cache += recent
+            # The first call waits for the whole initial backlog, like recent_loader does
+            recent = pool.get_ready(wait=not cache, wait_all=not cache)
+    finally:
+        pool.close()
+
+
+def store_loader(directory: str,
+                 update_every: int,
+                 action_noise: Optional[float] = None,
+                 chunk_length: Optional[int] = None,
+                 num_chunks: Optional[int] = None,
+                 success_padding: int = 0,
+                 sampler: Optional[PrioritizedSampler] = None,
+                 ) -> Generator[Episode, None, None]:
+    """Same sampling as recent_loader, but reads from the EpisodeStore in `directory`.
+
+    If `chunk_length` and `num_chunks` are set, chunks are yielded directly instead
+    of episodes. Their offsets are sampled from a ChunkIndex, and only the time
+    steps covered by the chunks are read from the store. Otherwise whole episodes
+    are read, to be chunked by chunk_sequence.
+
+    If `sampler` is given, episodes are sampled from it instead, and the index of
+    the episode is added to each time step under the key `episode_index`.
+    """
+    store = EpisodeStore(os.path.join(directory, STORE_DIR))
+    index = ChunkIndex(chunk_length * num_chunks, success_padding) if chunk_length and num_chunks else None
+    num_old = 0
+    while True:
+        if index is not None:
+            index.update(store)
+        if sampler is not None:
+            _add_to_sampler(sampler, store)
+            episodes = sampler.sample(update_every)
+        else:
+            indices: List[int] = []
+            indices += _sample(range(num_old, len(store)), update_every // 2)
+            indices += _sample(range(num_old), update_every // 2)
+            episodes = np.array(list(_permuted(indices, update_every)), dtype=np.int64)
+        if index is None:
+            for episode in episodes:
+                steps = _read_steps(store, episode, 0, int(store.lengths[episode]), action_noise)
+                yield _add_episode_index(steps, episode) if sampler is not None else steps
+        else:
+            assert chunk_length and num_chunks
+            offsets = index.sample_offsets(episodes)
+            stops = np.minimum(offsets + index.window, index.padded_lengths[episodes])
+            for episode, offset, stop in zip(episodes, offsets, stops):
+                steps = _read_steps(store, episode, offset, stop, action_noise)
+                if sampler is not None:
+                    steps = _add_episode_index(steps, episode)
+                yield from _split_chunks(steps, chunk_length, num_chunks, int(index.padded_lengths[episode]))
+        num_old = len(store)
+        store.refresh()
+
+
 def reload_loader(directory: str,
                   update_every: Optional[int] = None,
                   action_noise: Optional[float] = None,
@@ -170,6 +290,77 @@ def episode_reader(filename: str,
     return episode
 
 
+def _read_steps(store: EpisodeStore,
+                index: int,
+                start: int,
+                stop: int,
+                action_noise: Optional[float],
+                ) -> Episode:
+    """Read time steps `start:stop` of an episode, where steps after the end of the episode repeat the last element."""
+    length = int(store.lengths[index])
+    steps = np.minimum(np.arange(start, stop), length - 1)
+    read_start, read_stop = int(steps[0]), int(steps[-1]) + 1
+    episode = {key: _convert_type(value) for key, value in store.read(index, read_start, read_stop).items()}
+    rewards = _convert_type(store.read(index, 0, read_stop, keys={'reward'})['reward'])
+    episode['return'] = np.cumsum(rewards)[read_start:]
+    if action_noise:
+        seed = np.frombuffer(store.names[index].encode(), dtype=np.uint8)
+        noise = np.random.RandomState(seed).normal(0, action_noise, (length,) + episode['action'].shape[1:])
+        episode['action'] += noise[read_start:read_stop].astype(episode['action'].dtype)
+    return {key: value[steps - read_start] for key, value in episode.items()}
+
+
+def _add_to_sampler(sampler: PrioritizedSampler, store: EpisodeStore) -> None:
+    new = range(len(sampler), len(store))
+    if not new:
+        return
+    returns = np.array([np.sum(store.read(i, keys={'reward'})['reward']) for i in new])
+    if store.spec is not None and 'success' in store.spec:
+        successes = np.array([store.read(i, int(store.lengths[i]) - 1, keys={'success'})['success'][-1] for i in new])
+    else:
+        successes = np.zeros([len(new)])
+    sampler.add(returns, successes)
+
+
+def _add_episode_index(sequence: Episode, index: int) -> Episode:
+    sequence['episode_index'] = np.full([len(sequence['reward'])], index, dtype=np.int32)
+    return sequence
+
+
+def _split_chunks(sequence: Episode,
+                  chunk_length: int,
+                  num_chunks: int,
+                  padded_length: int,
+                  ) -> Generator[Episode, None, None]:
+    """Zero-pad a sequence to `num_chunks * chunk_length` steps and split it, adding a `length` key like chunk_sequence."""
+    used_length = chunk_length * num_chunks
+    length = np.array([min(chunk_length, padded_length)], dtype=np.int32)
+    for key, value in sequence.items():
+        if len(value) < used_length:
+            padding = np.zeros((used_length - len(value),) + value.shape[1:], dtype=value.dtype)
+            sequence[key] = np.concatenate([value, padding])
+    for i in range(num_chunks):
+        chunk = {key: value[i * chunk_length:(i + 1) * chunk_length] for key, value in sequence.items()}
+        chunk['length'] = length
+        yield chunk
+
+
+def import_npz_episodes(directory: str) -> int:
+    """Append NPZ episodes that are missing from the EpisodeStore, e.g. linked
+    initial data. Returns the number of imported episodes."""
+    store = EpisodeStore(os.path.join(directory, STORE_DIR))
+    names = set(store.names)
+    imported = 0
+    for filename in sorted(tf.io.gfile.glob(os.path.join(directory, '*.npz'))):
+        name = os.path.splitext(os.path.basename(filename))[0]
+        if name in names:
+            continue
+        with np.load(filename) as episode:
+            store.append(dict(episode), name)
+        imported += 1
+    return imported
+
+
 def _read_spec(directory: str,
                numpy_types: bool = False,
                ) -> Tuple[Dict[str, Any], Dict[str, Tuple[Optional[int]]], int]:
@@ -16,6 +16,12 @@ import gin
 import tensorflow as tf
 
 
+@gin.configurable(whitelist=['enabled'])
+def device_preprocessing(enabled: bool = False) -> bool:
+    """Whether images are kept as uint8 until they reach the model, which then preprocesses them on its device"""
+    return enabled
+
+
 @gin.configurable(whitelist=['bits'])
 def preprocess(image: tf.Tensor, bits: int = 5) -> tf.Tensor:
     bins = 2 ** bits
@@ -0,0 +1,178 @@
+# prioritized_sampler.py: Sum-tree based prioritized sampling of episodes
+#
+# (C) 2020, Daniel Mouritzen
+
+import threading
+from typing import Dict, Optional
+
+import gin
+import numpy as np
+
+_samplers: Dict[str, 'PrioritizedSampler'] = {}
+_samplers_lock = threading.Lock()
+
+
+class SumTree:
+    """Binary tree where each node holds the sum of its children, allowing O(log n) updates and sampling.
+
+    The capacity is doubled when it is exceeded.
+    """
+    def __init__(self, capacity: int = 1024) -> None:
+        self._capacity = 1
+        while self._capacity < capacity:
+            self._capacity *= 2
+        self._tree = np.zeros([2 * self._capacity])
+        self._size = 0
+
+    def __len__(self) -> int:
+        return self._size
+
+    @property
+    def total(self) -> float:
+        return float(self._tree[1])
+
+    @property
+    def priorities(self) -> np.ndarray:
+        return self._tree[self._capacity:self._capacity + self._size]
+
+    def append(self, priorities: np.ndarray) -> None:
+        new_size = self._size + len(priorities)
+        if new_size > self._capacity:
+            old = self.priorities.copy()
+            while self._capacity < new_size:
+                self._capacity *= 2
+            self._tree = np.zeros([2 * self._capacity])
+            self._size = 0
+            self.set(np.arange(len(old)), old)
+        self._size = new_size
+        self.set(np.arange(new_size - len(priorities), new_size), priorities)
+
+    def set(self, indices: np.ndarray, priorities: np.ndarray) -> None:
+        if not len(indices):
+            return
+        assert np.all(priorities >= 0), 'Priorities must be non-negative'
+        self._size = max(self._size, int(np.max(indices, initial=-1)) + 1)
+        nodes = np.asarray(indices) + self._capacity
+        self._tree[nodes] = priorities
+        nodes = np.unique(nodes // 2)
+        while nodes[0] >= 1:
+            self._tree[nodes] = self._tree[2 * nodes] + self._tree[2 * nodes + 1]
+            nodes = np.unique(nodes // 2)
+
+    def sample(self, amount: int) -> np.ndarray:
+        """Stratified sampling of `amount` indices with probability proportional to their priority"""
+        targets = (np.arange(amount) + np.random.uniform(size=amount)) / amount * self.total
+        nodes = np.ones([amount], dtype=np.int64)
+        while nodes[0] < self._capacity:
+            left = 2 * nodes
+            go_right = targets >= self._tree[left]
+            targets = np.where(go_right, targets - self._tree[left], targets)
+            nodes = left + go_right
+        # Guard against rounding errors leading to zero-priority leaves
+        return np.minimum(nodes - self._capacity, self._size - 1)
+
+
+@gin.configurable(whitelist=['recency', 'success_weight', 'return_scale', 'loss_exponent'])
+class PrioritizedSampler:
+    """Samples episode indices with configurable priorities, backed by a SumTree.
+
+    The priority of episode i is the product of the following factors:
+        recency ** i: Favors newer episodes. A value of 1 disables recency weighting.
+        1 + success_weight * success: Favors successful episodes.
+        exp(return_scale * return): Favors episodes with high return.
+        (loss + eps) ** loss_exponent: Favors episodes with high model loss, as reported by report_losses().
+
+    Episodes without a reported loss use the largest loss seen when their priority was last computed, so that they are
+    likely to be sampled soon after being added.
+    """
+    _MAX_RECENCY_FACTOR = 1e100
+
+    def __init__(self,
+                 name: Optional[str] = None,
+                 recency: float = 1.0,
+                 success_weight: float = 0.0,
+                 return_scale: float = 0.0,
+                 loss_exponent: float = 0.0,
+                 ) -> None:
+        assert recency >= 1.0, 'recency must be at least 1'
+        self._recency = recency
+        self._success_weight = success_weight
+        self._return_scale = return_scale
+        self._loss_exponent = loss_exponent
+        self._tree = SumTree()
+        self._base = np.zeros([0])
+        self._losses = np.zeros([0])
+        self._max_loss = 1.0
+        self._recency_offset = 0
+        self._lock = threading.Lock()
+        if name is not None:
+            with _samplers_lock:
+                _samplers[name] = self
+
+    def __len__(self) -> int:
+        return len(self._tree)
+
+    def add(self, returns: np.ndarray, successes: np.ndarray) -> None:
+        """Add new episodes with the given total returns and success flags"""
+        if not len(returns):
+            return
+        with self._lock:
+            indices = np.arange(len(self), len(self) + len(returns))
+            if self._recency ** float(indices[-1] - self._recency_offset) > self._MAX_RECENCY_FACTOR:
+                # Renormalize to avoid overflow. This is O(n), but happens rarely.
+                self._base /= self._recency ** float(len(self) - self._recency_offset)
+                self._recency_offset = len(self)
+                self._tree.set(np.arange(len(self)), self._priorities(np.arange(len(self))))
+            base = self._recency ** (indices - self._recency_offset).astype(np.float64)
+            base *= 1 + self._success_weight * successes.astype(np.float64)
+            base *= np.exp(self._return_scale * returns.astype(np.float64))
+            self._base = np.concatenate([self._base, base])
+            self._losses = np.concatenate([self._losses, np.full([len(indices)], np.nan)])
+            self._tree.append(self._priorities(indices))
+
+    def sample(self, amount: int) -> np.ndarray:
+        """Sample `amount` episode indices in random order"""
+        with self._lock:
+            if not len(self):
+                return np.zeros([0], dtype=np.int64)
+            indices = self._tree.sample(amount)
+        # Stratified sampling returns sorted indices, so batches would otherwise hold episodes of similar age
+        np.random.shuffle(indices)
+        return indices
+
+    @property
+    def uses_losses(self) -> bool:
+        return bool(self._loss_exponent)
+
+    def report_losses(self, indices: np.ndarray, losses: np.ndarray) -> None:
+        if not self._loss_exponent:
+            return
+        losses = np.broadcast_to(losses, np.shape(indices))
+        with self._lock:
+            indices, position = np.unique(indices, return_index=True)
+            self._losses[indices] = losses[position]
+            self._max_loss = max(self._max_loss, float(np.max(losses)))
+            self._tree.set(indices, self._priorities(indices))
+
+    def _priorities(self, indices: np.ndarray) -> np.ndarray:
+        priorities = self._base[indices]
+        if self._loss_exponent:
+            losses = self._losses[indices]
+            losses = np.where(np.isnan(losses), self._max_loss, losses)
+            priorities = priorities * (np.maximum(losses, 0) + 1e-6) ** self._loss_exponent
+        return priorities
+
+
+def needs_episode_losses(name: str) -> bool:
+    """Whether the PrioritizedSampler registered under `name` uses the losses reported by report_episode_losses"""
+    with _samplers_lock:
+        sampler = _samplers.get(name)
+    return sampler is not None and sampler.uses_losses
+
+
+def report_episode_losses(name: str, indices: np.ndarray, losses: np.ndarray) -> None:
+    """Report model losses for sampled episodes to the PrioritizedSampler registered under `name`, if any"""
+    with _samplers_lock:
+        sampler = _samplers.get(name)
+    if sampler is not None:
+        sampler.report_losses(indices, losses)
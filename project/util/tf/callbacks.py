@@ -5,7 +5,17 @@
 import time
 from functools import partial
 from pathlib import Path
-from typing import Any, Dict, Mapping, MutableMapping, Optional, SupportsFloat, Tuple, Union
+from typing import (Any,
+                    Callable,
+                    Dict,
+                    Iterable,
+                    Mapping,
+                    MutableMapping,
+                    Optional,
+                    Sequence,
+                    SupportsFloat,
+                    Tuple,
+                    Union)
 
 import gin
 import matplotlib.pyplot as plt
@@ -15,14 +25,17 @@ from loguru import logger
 from tensorflow.keras import callbacks
 
 from project.agents import Agent
-from project.execution import Evaluator, Simulator
+from project.execution import AsyncCollector, AsyncEvaluator, Evaluator, Simulator
+from project.execution.async_evaluator import EvaluationResult
 from project.model import Model
 from project.util import PrettyPrinter, Statistics
+from project.util.planet.decode_pool import decode_pool_metrics
 from project.util.planet.numpy_episodes import episode_reader
-from project.util.planet.preprocess import postprocess, preprocess
+from project.util.planet.preprocess import device_preprocessing, postprocess, preprocess
 from project.util.system import get_memory_usage
 from project.util.tf.summaries import prediction_trajectory_summary, video_summary
-from project.util.timing import measure_time
+from project.util.tf.tracing import new_retraces
+from project.util.timing import Profiler, Timer, get_profiler, measure_time
 
 
 @gin.configurable(whitelist=['period'])
@@ -69,11 +82,66 @@ class DataCollectionCallback(callbacks.Callback):
                     total_episodes += episodes
                     if count_seen:
                         wandb.log({f'{task}/{phase}/steps_seen': sim.steps_seen,
-                                   f'{task}/{phase}/scenes_seen': sim.scenes_seen}, step=epoch)
+                                   f'{task}/{phase}/scenes_seen': sim.scenes_seen,
+                                   f'{task}/{phase}/scene_loads': sim.scene_loads,
+                                   f'{task}/{phase}/scene_load_time': sim.scene_load_time}, step=epoch)
                 mean_metrics = {k: v / total_episodes for k, v in mean_metrics.items()}
                 wandb.log({f'{task}/train/{k}': v for k, v in mean_metrics.items()}, step=epoch)
 
 
+@gin.configurable(whitelist=['period'])
+class AsyncCollectionCallback(callbacks.Callback):
+    """
+    Publishes weight snapshots for an AsyncCollector every `period` epochs, enforces its staleness bound and reports the
+    collection throughput compared to the training throughput.
+    """
+    def __init__(self, collector: AsyncCollector, period: int = 1) -> None:
+        super().__init__()
+        self._collector = collector
+        self._period = period
+        self._steps_seen: Dict[str, int] = {}
+        self._train_steps = 0
+        self._prev_time = time.time()
+
+    def on_train_begin(self, logs: Any = None) -> None:
+        self._collector.publish(self.model)
+        self._prev_time = time.time()
+
+    def on_train_batch_end(self, batch: int, logs: Any = None) -> None:
+        self._train_steps += 1
+
+    def on_train_end(self, logs: Any = None) -> None:
+        self._collector.close()
+
+    def on_epoch_end(self, epoch: int, logs: Any = None) -> None:
+        results = self._collector.results()
+        staleness = [self._collector.version - result.version for result in results]
+        if self._period and (epoch + 1) % self._period == 0:
+            self._collector.publish(self.model)
+        wait_time = self._collector.wait_for_workers()
+        current_time = time.time()
+        elapsed = current_time - self._prev_time
+        env_steps = sum(result.steps for result in results)
+        logger.info(f'Collected {len(results)} episodes ({env_steps} steps) in the background. Throughput: '
+                    f'{env_steps / elapsed:.3g} env steps/s, {self._train_steps / elapsed:.3g} train steps/s.')
+        wandb.log({'collection/episodes': len(results),
+                   'collection/env_steps_per_sec': env_steps / elapsed,
+                   'collection/train_steps_per_sec': self._train_steps / elapsed,
+                   'collection/staleness': sum(staleness) / len(staleness) if staleness else 0.0,
+                   'collection/wait_time': wait_time},
+                  step=epoch)
+        for task in {result.task for result in results}:
+            task_results = [result for result in results if result.task == task]
+            self._steps_seen[task] = self._steps_seen.get(task, 0) + sum(result.steps for result in task_results
+                                                                         if result.phase == 'train')
+            metrics = {f'{task}/train/{k}': sum(result.metrics[k] for result in task_results) / len(task_results)
+                       for k in task_results[0].metrics.keys()}
+            metrics[f'{task}/train/steps_seen'] = self._steps_seen[task]
+            wandb.log(metrics, step=epoch)
+        self._train_steps = 0
+        self._prev_time = current_time
+
+
 @gin.configurable(whitelist=['period', 'num_episodes'])
 class EvaluateCallback(callbacks.Callback):
     """Evaluates current model"""
@@ -106,6 +174,40 @@ class EvaluateCallback(callbacks.Callback):
                           step=epoch)
 
 
+class AsyncEvaluateCallback(callbacks.Callback):
+    """
+    Hands new checkpoints to an AsyncEvaluator and logs finished evaluations, tagged with the epoch of the checkpoint.
+    This callback should come after CheckpointCallback.
+    """
+    def __init__(self, evaluator: AsyncEvaluator) -> None:
+        super().__init__()
+        self._evaluator = evaluator
+        self._epoch = 0
+
+    def on_epoch_end(self, epoch: int, logs: Any = None) -> None:
+        self._epoch = epoch
+        self._log_results(self._evaluator.poll())
+
+    def on_train_end(self, logs: Any = None) -> None:
+        self._evaluator.poll()  # Submit the last checkpoint
+        self._epoch += 1  # The last epoch has already been committed
+        self._log_results(self._evaluator.close())
+
+    def _log_results(self, results: Sequence[EvaluationResult]) -> None:
+        # Results arrive after later epochs have been logged, so they are logged at the current step with the epoch
+        for result in results:
+            logger.info(f'Evaluation of checkpoint from epoch {result.epoch}: '
+                        + ', '.join(f'{task} {metrics}' for task, metrics in result.metrics.items()))
+            row: Dict[str, Any] = {f'{task}/eval/{k}': v
+                                   for task, task_metrics in result.metrics.items()
+                                   for k, v in task_metrics.items()}
+            row.update({f'{task}/eval/epoch': result.epoch for task in result.metrics.keys()})
+            row.update({f'{task}/eval/video_{i}': wandb.Video(str(video), fps=10, format="mp4")
+                        for task, task_videos in result.videos.items()
+                        for i, video in enumerate(task_videos)})
+            wandb.log(row, step=self._epoch)
+
+
 @gin.configurable(whitelist=['epoch_log_period', 'epoch_header_period', 'batch_log_period', 'batch_header_period'])
 class LoggingCallback(callbacks.Callback):
     """Logs metrics"""
@@ -181,11 +283,73 @@ class LoggingCallback(callbacks.Callback):
         wandb_row['step_time'] = epoch_time / self._steps
         wandb_row['steps'] = log_epoch * self._steps
         wandb_row['memory'] = get_memory_usage()
+        wandb_row.update({f'data/{k}': v for k, v in decode_pool_metrics().items()})
+        retraces = new_retraces()
+        if retraces:
+            logger.warning(f'Retraced tf.functions: {", ".join(f"{name} ({count}x)" for name, count in retraces.items())}')
+        wandb_row['retraces'] = sum(retraces.values())
         self._prev_time = current_time
         self._steps = 0
         wandb.log(wandb_row, step=epoch)
 
 
+@gin.configurable(whitelist=['log_top'])
+class ProfilerCallback(callbacks.Callback):
+    """
+    Exports the phase timings recorded by the global profiler to wandb and optionally a CSV file at the end of each
+    epoch. This callback should come just before WandbCommitCallback, so the other callbacks' timings are included.
+    """
+    def __init__(self, csv_path: Optional[Path] = None, log_top: int = 5) -> None:
+        super().__init__()
+        self._csv_path = csv_path
+        self._log_top = log_top
+
+    def on_epoch_end(self, epoch: int, logs: Optional[Mapping[str, SupportsFloat]] = None) -> None:
+        summary = get_profiler().summary()
+        if self._log_top:
+            slowest = list(summary.items())[:self._log_top]
+            logger.debug('Slowest phases: ' + ', '.join(f'{phase} ({stats["total"]:.3g}s)' for phase, stats in slowest))
+        wandb.log({f'profile/{phase}/{k}': v for phase, stats in summary.items() for k, v in stats.items()}, step=epoch)
+        if self._csv_path is not None:
+            Profiler.write_csv(self._csv_path, summary, epoch)
+
+
+# Keras hooks, with the legacy hooks that their default implementations call
+_CALLBACK_HOOKS = {'on_train_begin': None,
+                   'on_train_end': None,
+                   'on_test_begin': None,
+                   'on_test_end': None,
+                   'on_epoch_begin': None,
+                   'on_epoch_end': None,
+                   'on_train_batch_begin': 'on_batch_begin',
+                   'on_train_batch_end': 'on_batch_end',
+                   'on_test_batch_begin': None,
+                   'on_test_batch_end': None}
+
+
+def profile_callbacks(callback_list: Iterable[callbacks.Callback]) -> None:
+    """
+    Make the global profiler record the time spent in each hook of each callback, as `callbacks/<class>.<hook>`. Hooks
+    that aren't overridden are skipped. Callbacks that are already profiled are left unchanged.
+    """
+    def overrides(callback: callbacks.Callback, hook: Optional[str]) -> bool:
+        return hook is not None and getattr(type(callback), hook) is not getattr(callbacks.Callback, hook)
+
+    def timed(hook_fn: Callable[..., None], name: str) -> Callable[..., None]:
+        def wrapper(*args: Any, **kwargs: Any) -> None:
+            with Timer(name):
+                hook_fn(*args, **kwargs)
+        return wrapper
+
+    for callback in callback_list:
+        if getattr(callback, '_profiled', False):
+            continue
+        for hook, legacy_hook in _CALLBACK_HOOKS.items():
+            if overrides(callback, hook) or overrides(callback, legacy_hook):
+                setattr(callback, hook, timed(getattr(callback, hook), f'callbacks/{type(callback).__name__}.{hook}'))
+        callback._profiled = True
+
+
 class WandbCommitCallback(callbacks.Callback):
     """Simply makes wandb upload the metrics immediately at the end of the epoch. This callback should be last."""
     def on_epoch_end(self, epoch: int, logs: Optional[Mapping[str, SupportsFloat]] = None) -> None:
@@ -214,7 +378,8 @@ class PredictionSummariesCallback(callbacks.Callback):
             episode = episode_reader(str(episode_file))
             if success is None or bool(episode['success'][-1]) == success:
                 episode = {k: tf.convert_to_tensor(v) for k, v in episode.items()}
-                episode['image'] = preprocess(episode['image'])
+                if not device_preprocessing():
+                    episode['image'] = preprocess(episode['image'])
                 episode['length'] = tf.convert_to_tensor(episode['reward'].shape[0])
                 episodes.append(episode)
             if len(episodes) >= self._batch_episodes:
@@ -254,7 +419,7 @@ class PredictionSummariesCallback(callbacks.Callback):
         summaries = {}
         prior, posterior = self._model.closed_loop(episode_batch, training=False)
         open_loop = self._model.open_loop(episode_batch, training=False)
-        target_images = self._postprocess_images(episode_batch['image'])
+        target_images = self._postprocess_images(self._model.preprocess(episode_batch)['image'])
         for name, states in [('closed_loop/prior', prior), ('closed_loop/posterior', posterior), ('open_loop', open_loop)]:
             summaries[f'{base_name}/{name}'] = video_summary(target_images, self._get_reconstructions(states)['image'])
         open_loop_predictions = self._get_reconstructions(open_loop)
@@ -0,0 +1,134 @@
+# compilation.py: Configurable XLA compilation of tf.functions
+#
+# (C) 2020, Daniel Mouritzen
+
+import contextlib
+import functools
+import re
+import threading
+from typing import Any, Callable, Iterator, Optional, Sequence, Set, TypeVar, cast
+
+import gin
+import tensorflow as tf
+from loguru import logger
+
+from .tracing import count_traces
+
+T = TypeVar('T', bound=Callable[..., Any])
+
+XLA_FAMILIES = ('train_step', 'planner', 'observe', 'act')
+STATEFUL_FAMILIES = ('train_step', 'observe', 'act')  # Functions that update variables, so they can't be repeated
+
+# Errors raised when XLA fails to compile a cluster. They are also raised by ordinary ops, so is_compile_error() checks
+# the message as well.
+_XLA_ERRORS = (tf.errors.InvalidArgumentError, tf.errors.UnimplementedError, tf.errors.InternalError)
+_COMPILE_ERROR_PATTERN = re.compile(r'\bXLA\b|[Cc]ompil')
+_NODE_NAMES_PATTERN = re.compile(r'\[\[.*?\]\]', re.DOTALL)  # Node names of ops run by XLA contain e.g. 'xla_run'
+
+_failed: Set[str] = set()  # Names of functions that failed to compile
+_tracing_fallback = threading.local()
+
+
+@gin.configurable('xla', whitelist=['families'])
+def xla_enabled(family: str, families: Sequence[str] = ()) -> bool:
+    """Whether functions in `family` should be compiled with XLA"""
+    assert family in XLA_FAMILIES, f'Unknown function family {family!r}. Available families: {", ".join(XLA_FAMILIES)}'
+    unknown = set(families) - set(XLA_FAMILIES)
+    assert not unknown, f'Unknown function families {unknown} in config. Available families: {", ".join(XLA_FAMILIES)}'
+    return family in families
+
+
+def is_compile_error(error: tf.errors.OpError) -> bool:
+    """Whether `error` was raised because XLA failed to compile a cluster, rather than by an op at runtime"""
+    return isinstance(error, _XLA_ERRORS) and bool(_COMPILE_ERROR_PATTERN.search(_NODE_NAMES_PATTERN.sub('', error.message)))
+
+
+@contextlib.contextmanager
+def _fallback_tracing() -> Iterator[None]:
+    previous = getattr(_tracing_fallback, 'active', False)
+    _tracing_fallback.active = True
+    try:
+        yield
+    finally:
+        _tracing_fallback.active = previous
+
+
+class XlaFunction:
+    """
+    A tf.function which is traced with its ops marked for XLA compilation if this is enabled for its family. Ops that
+    XLA doesn't support (e.g. tf.numpy_function) are left out of the compiled clusters and run as usual.
+
+    If compilation fails when the function is called eagerly, a warning is logged and this function is run without XLA
+    from then on, including any XlaFunctions it calls. The failed call is repeated without XLA, unless the function is
+    in one of STATEFUL_FAMILIES. Those may have updated variables before the failing cluster, so the error is raised
+    instead. Other errors are raised as usual.
+    """
+    def __init__(self,
+                 name: str,
+                 family: str,
+                 compiled: Callable[..., Any],
+                 plain: Callable[..., Any],
+                 fallback: Callable[..., Any],
+                 ) -> None:
+        self._name = name
+        self._family = family
+        self._compiled = compiled
+        self._plain = plain
+        # Separate function that is only traced after a failure, so nested XlaFunctions are traced without XLA as well
+        self._fallback = fallback
+
+    def __get__(self, instance: Any, owner: Optional[type] = None) -> 'XlaFunction':
+        if instance is None:
+            return self
+        return XlaFunction(self._name,
+                           self._family,
+                           self._compiled.__get__(instance, owner),  # type: ignore[attr-defined]
+                           self._plain.__get__(instance, owner),  # type: ignore[attr-defined]
+                           self._fallback.__get__(instance, owner))  # type: ignore[attr-defined]
+
+    def __call__(self, *args: Any, **kwargs: Any) -> Any:
+        if self._name in _failed:
+            return self._call_fallback(*args, **kwargs)
+        if not xla_enabled(self._family) or getattr(_tracing_fallback, 'active', False):
+            return self._plain(*args, **kwargs)
+        if not tf.executing_eagerly():
+            # Compilation errors are raised when the outermost function is run, which handles the fallback
+            return self._compiled(*args, **kwargs)
+        try:
+            return self._compiled(*args, **kwargs)
+        except _XLA_ERRORS as e:
+            if not is_compile_error(e):
+                raise
+            _failed.add(self._name)
+            if self._family in STATEFUL_FAMILIES:
+                logger.warning(f'XLA compilation of {self._name} failed, later calls will run without XLA: {e}')
+                raise
+            logger.warning(f'XLA compilation of {self._name} failed, running it without XLA: {e}')
+            return self._call_fallback(*args, **kwargs)
+
+    def _call_fallback(self, *args: Any, **kwargs: Any) -> Any:
+        with _fallback_tracing():  # XlaFunctions called by this one are traced without XLA
+            return self._fallback(*args, **kwargs)
+
+
+def xla_function(family: str, **kwargs: Any) -> Callable[[T], T]:
+    """
+    Drop-in replacement for the tf.function decorator that creates an XlaFunction. Works for methods as well. Traces are
+    counted with count_traces.
+    """
+    def decorator(func: T) -> T:
+        func = count_traces(func)
+
+        @functools.wraps(func)
+        def jit_scoped(*args: Any, **func_kwargs: Any) -> Any:
+            if tf.executing_eagerly():  # E.g. if functions are run eagerly for debugging
+                return func(*args, **func_kwargs)
+            with tf.xla.experimental.jit_scope():
+                return func(*args, **func_kwargs)
+
+        return cast(T, XlaFunction(f'{func.__module__}.{func.__qualname__}',
+                                   family,
+                                   tf.function(jit_scoped, **kwargs),
+                                   tf.function(func, **kwargs),
+                                   tf.function(func, **kwargs)))
+    return decorator
@@ -32,10 +32,21 @@ def _gpu_id_from_name(name: str) -> int:
     return int(name.split(':')[-1])
 
 
-@gin.configurable('tf.gpus', whitelist=['gpu_ids', 'memory_growth'])
-def get_distribution_strategy(gpu_ids: Optional[Sequence[int]] = None, memory_growth: bool = True) -> tf.distribute.Strategy:
+@gin.configurable('tf.gpus', whitelist=['gpu_ids', 'memory_growth', 'num_cpu_devices'])
+def get_distribution_strategy(gpu_ids: Optional[Sequence[int]] = None,
+                              memory_growth: bool = True,
+                              num_cpu_devices: int = 1,
+                              ) -> tf.distribute.Strategy:
+    """
+    Returns a OneDeviceStrategy for a single device, or a MirroredStrategy for multiple GPUs. Without GPUs, the CPU can be
+    split into `num_cpu_devices` logical devices, so that data-parallel training can be run (and tested) on one machine.
+    """
     available_gpus = tf.config.experimental.list_physical_devices('GPU')
     if not available_gpus:
+        if num_cpu_devices > 1:
+            _split_cpu(num_cpu_devices)
+            logger.info(f'No GPUs found; running on {num_cpu_devices} logical CPU devices')
+            return tf.distribute.MirroredStrategy([f'/cpu:{i}' for i in range(num_cpu_devices)])
         logger.warning('No GPUs found; running on CPU')
         return tf.distribute.OneDeviceStrategy('/cpu:0')
 
@@ -53,8 +64,22 @@ def get_distribution_strategy(gpu_ids: Optional[Sequence[int]] = None, memory_gr
         logger.debug('Running on single GPU')
         return tf.distribute.OneDeviceStrategy(f'/gpu:{_gpu_id_from_name(available_gpus[0].name)}')
 
-    logger.warning(f'Running on multiple GPUs, this probably won\'t work.')
-    return tf.distribute.MirroredStrategy()
+    logger.info(f'Running on {len(available_gpus)} GPUs')
+    return tf.distribute.MirroredStrategy([f'/gpu:{_gpu_id_from_name(gpu.name)}' for gpu in available_gpus])
+
+
+def _split_cpu(num_devices: int) -> None:
+    """Split the first physical CPU into logical devices. This must happen before the TF runtime is initialized."""
+    cpu = tf.config.experimental.list_physical_devices('CPU')[0]
+    try:
+        tf.config.experimental.set_virtual_device_configuration(
+            cpu, [tf.config.experimental.VirtualDeviceConfiguration() for _ in range(num_devices)])
+    except RuntimeError:
+        # The runtime is already initialized, e.g. because this function was called before
+        pass
+    num_logical = len(tf.config.experimental.list_logical_devices('CPU'))
+    assert num_logical >= num_devices, (f'Could not split CPU into {num_devices} logical devices (found {num_logical}). '
+                                        f'Make sure the distribution strategy is created before running any TF ops.')
 
 
 @contextmanager
@@ -3,7 +3,7 @@
 # (C) 2019, Daniel Mouritzen
 
 from types import MethodType
-from typing import Callable, Iterable, List, NoReturn, Optional, Tuple, cast
+from typing import Any, Callable, Dict, Iterable, List, NoReturn, Optional, Tuple, cast
 
 import gin
 import tensorflow as tf
@@ -35,3 +35,31 @@ def with_global_norm_clipping(optimizer: optimizers.Optimizer = gin.REQUIRED,
     optimizer._compute_gradients = MethodType(_compute_gradients, optimizer)
     optimizer.get_config = MethodType(get_config, optimizer)
     return optimizer
+
+
+class GradientAccumulator:
+    """
+    Sums gradients over several steps, so they can be applied at once. Gradients are grouped by optimizer name, as
+    returned by `project.execution.train.compute_gradients`.
+    """
+    def __init__(self, variables: Iterable[tf.Variable]) -> None:
+        self._sums = {var.experimental_ref(): tf.Variable(tf.zeros_like(var), trainable=False) for var in variables}
+        self._optimizer_names: Dict[Any, str] = {}
+
+    def add(self, gradients: Dict[str, List[Tuple[tf.Tensor, tf.Variable]]]) -> None:
+        for optimizer_name, grads_and_vars in gradients.items():
+            for grad, var in grads_and_vars:
+                ref = var.experimental_ref()
+                self._optimizer_names[ref] = optimizer_name
+                self._sums[ref].assign_add(tf.convert_to_tensor(grad))
+
+    def mean(self, count: int) -> Dict[str, List[Tuple[tf.Tensor, tf.Variable]]]:
+        """Mean gradients over `count` steps for all variables that have received gradients"""
+        gradients: Dict[str, List[Tuple[tf.Tensor, tf.Variable]]] = {}
+        for ref, optimizer_name in self._optimizer_names.items():
+            gradients.setdefault(optimizer_name, []).append((self._sums[ref] / count, ref.deref()))
+        return gradients
+
+    def reset(self) -> None:
+        for grad_sum in self._sums.values():
+            grad_sum.assign(tf.zeros_like(grad_sum))
@@ -0,0 +1,59 @@
+# precision.py: Mixed precision utilities
+#
+# (C) 2020, Daniel Mouritzen
+
+import functools
+from typing import Any, Callable, Optional, TypeVar, cast
+
+import gin
+import tensorflow as tf
+
+from project.util.typing import Nested
+
+T = TypeVar('T', bound=Callable[..., Any])
+
+
+@gin.configurable('mixed_precision', whitelist=['enabled', 'dtype'])
+def mixed_precision_dtype(enabled: bool = False, dtype: Optional[str] = None) -> Optional[tf.DType]:
+    """
+    Returns the compute dtype to use for mixed precision, or None if it is disabled. If dtype is not given, float16 is
+    used when a GPU is available. Most CPU kernels support neither float16 nor bfloat16, so without a GPU the dtype must
+    be given explicitly. Variables are always kept in float32.
+    """
+    if not enabled:
+        return None
+    if dtype is None:
+        if not tf.config.experimental.list_physical_devices('GPU'):
+            raise ValueError('Mixed precision without a GPU requires mixed_precision.dtype to be set explicitly')
+        dtype = 'float16'
+    return tf.as_dtype(dtype)
+
+
+def set_mixed_precision_policy() -> None:
+    """Set the global Keras dtype policy according to the config. Only affects layers created after this call."""
+    dtype = mixed_precision_dtype()
+    # TF 2.0 names, later versions call these 'mixed_float16' etc.
+    policy = 'float32' if dtype is None else f'{dtype.name}_with_float32_vars'
+    tf.keras.mixed_precision.experimental.set_policy(policy)
+
+
+def needs_loss_scaling() -> bool:
+    """float16 gradients can underflow, so losses need to be scaled. bfloat16 has the same range as float32."""
+    return mixed_precision_dtype() == tf.float16
+
+
+def cast_floats(structure: Nested[tf.Tensor], dtype: tf.DType) -> Nested[tf.Tensor]:
+    """Cast all floating point tensors in a nested structure to dtype, leaving other tensors unchanged"""
+    def cast_float(x: Any) -> Any:
+        if isinstance(x, (tf.Tensor, tf.Variable)) and x.dtype.is_floating and x.dtype != dtype:
+            return tf.cast(x, dtype)
+        return x
+    return tf.nest.map_structure(cast_float, structure)
+
+
+def float32_island(func: T) -> T:
+    """Decorator casting all floating point tensor arguments to float32, for numerically sensitive computations"""
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        return func(*cast_floats(list(args), tf.float32), **cast_floats(kwargs, tf.float32))
+    return cast(T, wrapper)
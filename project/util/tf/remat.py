@@ -0,0 +1,55 @@
+# remat.py: Gradient checkpointing (rematerialization)
+#
+# (C) 2020, Daniel Mouritzen
+
+import functools
+from typing import Any, Callable, List, Optional, Sequence, TypeVar, cast
+
+import tensorflow as tf
+
+T = TypeVar('T', bound=Callable[..., Any])
+
+
+def recompute_grad(func: T) -> T:
+    """
+    Decorator making `func` discard its intermediate activations after the forward pass and recompute them from its
+    inputs in the backward pass, trading compute for memory.
+
+    Unlike tf.recompute_grad, nested inputs and outputs are supported. Only floating point inputs are differentiated;
+    other inputs (e.g. masks) are treated as constants. The recomputation must give the same result as the forward pass,
+    so `func` must be deterministic given its inputs (random noise should be passed in rather than sampled inside), must
+    not create variables, and should not update state such as batch norm statistics.
+    """
+    @functools.wraps(func)
+    def wrapper(*args: Any) -> Any:
+        flat_args = tf.nest.flatten(args)
+        float_indices = [i for i, x in enumerate(flat_args) if tf.is_tensor(x) and x.dtype.is_floating]
+
+        def call(float_args: Sequence[tf.Tensor]) -> Any:
+            full_args = list(flat_args)
+            for i, x in zip(float_indices, float_args):
+                full_args[i] = x
+            return func(*tf.nest.pack_sequence_as(args, full_args))
+
+        @tf.custom_gradient
+        def inner(*float_args: tf.Tensor) -> Any:
+            outputs = call(float_args)
+
+            # Variables must be received through **kwargs, since tf.custom_gradient doesn't detect keyword-only arguments
+            def grad_fn(*output_grads: Optional[tf.Tensor], **kwargs: Any) -> Any:
+                variables: Optional[List[tf.Variable]] = kwargs.get('variables')
+                with tf.GradientTape() as tape:
+                    tape.watch(float_args)
+                    recomputed = tf.nest.flatten(call(float_args))
+                output_grads = tuple(tf.zeros_like(x) if grad is None else grad for x, grad in zip(recomputed, output_grads))
+                sources = list(float_args) + list(variables or [])
+                grads = tape.gradient(recomputed, sources, output_gradients=output_grads)
+                if variables is None:
+                    return grads
+                return grads[:len(float_args)], grads[len(float_args):]
+
+            return outputs, grad_fn
+
+        return inner(*[flat_args[i] for i in float_indices])
+
+    return cast(T, wrapper)
@@ -0,0 +1,79 @@
+# tracing.py: Detection of tf.function retracing
+#
+# (C) 2020, Daniel Mouritzen
+
+import functools
+import inspect
+import threading
+from typing import Any, Callable, Dict, Hashable, Mapping, Sequence, Tuple, TypeVar, cast
+
+import numpy as np
+import tensorflow as tf
+from loguru import logger
+
+T = TypeVar('T', bound=Callable[..., Any])
+
+_traces: Dict[str, Dict[Hashable, int]] = {}
+_reported_retraces: Dict[str, int] = {}
+_lock = threading.Lock()
+
+
+def count_traces(func: T) -> T:
+    """
+    Decorator counting how often `func` is traced. It should be placed below tf.function, so that it only runs when
+    tracing. Every trace after the first is logged together with a description of the arguments that triggered it. For
+    methods, the first trace for each instance is not counted as a retrace.
+    """
+    name = func.__qualname__
+    is_method = next(iter(inspect.signature(func).parameters), None) == 'self'
+
+    @functools.wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        _record_trace(name, id(args[0]) if is_method and args else None, args, kwargs)
+        return func(*args, **kwargs)
+
+    return cast(T, wrapper)
+
+
+@tf.autograph.experimental.do_not_convert
+def _record_trace(name: str, key: Hashable, args: Sequence[Any], kwargs: Mapping[str, Any]) -> None:
+    with _lock:
+        traces = _traces.setdefault(name, {})
+        traces[key] = traces.get(key, 0) + 1
+        count = traces[key]
+    if count > 1:
+        logger.debug(f'Retracing {name} (trace {count}) with arguments {describe_arguments(args, kwargs)}')
+
+
+@tf.autograph.experimental.do_not_convert
+def describe_arguments(args: Sequence[Any], kwargs: Mapping[str, Any], max_length: int = 500) -> str:
+    """Short description of function arguments, giving shape and dtype for tensors and values for Python scalars"""
+    def describe(x: Any) -> str:
+        if isinstance(x, (tf.Tensor, tf.Variable, np.ndarray)):
+            return f'{tf.as_dtype(x.dtype).name}{list(x.shape)}'
+        if isinstance(x, tf.TensorSpec):
+            return f'spec:{x.dtype.name}{x.shape.as_list() if x.shape.rank is not None else "[?]"}'
+        if x is None or isinstance(x, (bool, int, float, str)):
+            return repr(x)
+        return type(x).__name__
+
+    description = str(tf.nest.map_structure(describe, (list(args), dict(kwargs))))
+    return description if len(description) <= max_length else description[:max_length - 3] + '...'
+
+
+def trace_counts() -> Dict[str, Tuple[int, int]]:
+    """Number of traces and retraces of each function decorated with count_traces"""
+    with _lock:
+        return {name: (sum(traces.values()), sum(count - 1 for count in traces.values()))
+                for name, traces in _traces.items()}
+
+
+def new_retraces() -> Dict[str, int]:
+    """Number of retraces of each function since the last call to this function, for functions that were retraced"""
+    retraces = {}
+    for name, (_, count) in trace_counts().items():
+        new = count - _reported_retraces.get(name, 0)
+        if new:
+            retraces[name] = new
+            _reported_retraces[name] = count
+    return retraces
@@ -2,13 +2,23 @@
 #
 # (C) 2019, Daniel Mouritzen
 
+import csv
+import threading
 import time
-from typing import Any, Callable, Optional, cast, overload
+from collections import deque
+from pathlib import Path
+from typing import Any, Callable, Deque, Dict, Optional, Sequence, cast, overload
 
+import gin
+import numpy as np
 from loguru import logger
 
 
 class Timer:
+    """Context manager measuring wall time. If a name is given, the interval is also recorded by the global profiler."""
+    def __init__(self, name: Optional[str] = None) -> None:
+        self.name = name
+
     def __enter__(self) -> 'Timer':
         self.start = time.perf_counter()
         return self
@@ -16,6 +26,68 @@ class Timer:
     def __exit__(self, *args: Any) -> None:
         self.end = time.perf_counter()
         self.interval = self.end - self.start
+        if self.name is not None:
+            get_profiler().record(self.name, self.interval)
+
+
+@gin.configurable('profiler', whitelist=['window', 'percentiles'])
+class Profiler:
+    """
+    Collects durations of named phases. Percentiles are computed over the last `window` durations of each phase, while
+    counts and totals are reset on each call to summary().
+    """
+    def __init__(self, window: int = 1000, percentiles: Sequence[float] = (50, 90, 99)) -> None:
+        self._window = window
+        self._percentiles = percentiles
+        self._durations: Dict[str, Deque[float]] = {}
+        self._counts: Dict[str, int] = {}
+        self._totals: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def record(self, phase: str, duration: float) -> None:
+        with self._lock:
+            self._durations.setdefault(phase, deque(maxlen=self._window)).append(duration)
+            self._counts[phase] = self._counts.get(phase, 0) + 1
+            self._totals[phase] = self._totals.get(phase, 0.0) + duration
+
+    def summary(self, reset: bool = True) -> Dict[str, Dict[str, float]]:
+        """Statistics for each phase recorded since the last summary, sorted by total time"""
+        with self._lock:
+            summary = {}
+            for phase, count in self._counts.items():
+                durations = np.array(self._durations[phase])
+                stats = {'count': count, 'total': self._totals[phase], 'mean': self._totals[phase] / count}
+                stats.update({f'p{p:g}': v for p, v in zip(self._percentiles, np.percentile(durations, self._percentiles))})
+                summary[phase] = stats
+            if reset:
+                self._counts.clear()
+                self._totals.clear()
+        return dict(sorted(summary.items(), key=lambda item: -item[1]['total']))
+
+    @staticmethod
+    def write_csv(path: Path, summary: Dict[str, Dict[str, float]], epoch: int) -> None:
+        """Append a summary to a CSV file with one row per phase, writing a header if the file is new"""
+        if not summary:
+            return
+        fields = ['epoch', 'phase'] + list(next(iter(summary.values())).keys())
+        write_header = not path.exists()
+        with path.open('a', newline='') as f:
+            writer = csv.DictWriter(f, fields)
+            if write_header:
+                writer.writeheader()
+            for phase, stats in summary.items():
+                writer.writerow({'epoch': epoch, 'phase': phase, **stats})
+
+
+_profiler: Optional[Profiler] = None
+
+
+def get_profiler() -> Profiler:
+    """The global profiler. It is created on first use, so gin config must be parsed before any named timers are run."""
+    global _profiler
+    if _profiler is None:
+        _profiler = Profiler()
+    return _profiler
 
 
 @overload
@@ -38,11 +110,13 @@ def measure_time(func: Optional[Callable] = None, *,
                  log_fn: Callable[[str], None] = logger.debug,
                  name: Optional[str] = None,
                  ) -> Callable:
+    """Decorator logging the duration of each call. The durations are also recorded by the global profiler."""
     def wrapper(fn: Callable) -> Callable:
+        fn_name = name or fn.__name__
+
         def timed(*args: Any, **kwargs: Any) -> Any:
-            with Timer() as t:
+            with Timer(fn_name) as t:
                 result = fn(*args, **kwargs)
-            fn_name = name or fn.__name__
             log_fn(f'Call to {fn_name} finished in {t.interval:.3g}s')
             return result
         return cast(Callable, timed)
@@ -0,0 +1,3 @@
+# __init__.py
+#
+# (C) 2020, Daniel Mouritzen
@@ -0,0 +1,74 @@
+# test_episode_store.py: Tests for EpisodeStore
+#
+# (C) 2020, Daniel Mouritzen
+
+import os
+from pathlib import Path
+from typing import Dict
+
+import numpy as np
+import pytest
+
+from project.util.planet.episode_store import EpisodeStore
+
+
+def make_episode(length: int, value: float = 0.0) -> Dict[str, np.ndarray]:
+    return {'image': np.full([length, 2, 2], value, np.uint8),
+            'reward': np.arange(length, dtype=np.float32) + value}
+
+
+def test_append_and_read(tmp_path: Path) -> None:
+    store = EpisodeStore(str(tmp_path))
+    assert len(store) == 0 and not store.exists()
+    store.append(make_episode(3, 1.0), 'a')
+    store.append(make_episode(5, 2.0), 'b')
+    assert len(store) == 2
+    assert store.names == ['a', 'b']
+    np.testing.assert_array_equal(store.lengths, [3, 5])
+    np.testing.assert_array_equal(store.read(1)['reward'], make_episode(5, 2.0)['reward'])
+    np.testing.assert_array_equal(store.read(1, 1, 3, keys={'reward'})['reward'], [3.0, 4.0])
+    assert set(store.read(0, keys={'reward'}).keys()) == {'reward'}
+
+
+def test_refresh_picks_up_appends(tmp_path: Path) -> None:
+    reader = EpisodeStore(str(tmp_path))
+    writer = EpisodeStore(str(tmp_path))
+    writer.append(make_episode(2), 'a')
+    assert len(reader) == 0
+    assert reader.refresh() == 1
+    assert reader.names == ['a']
+
+
+def test_discard_partial_append(tmp_path: Path) -> None:
+    store = EpisodeStore(str(tmp_path))
+    store.append(make_episode(3, 1.0), 'a')
+    # Simulate a writer that crashed after writing the data, the name and half an index row
+    with open(tmp_path / 'image.bin', 'ab') as f:
+        f.write(np.zeros([4, 2, 2], np.uint8).tobytes())
+    with open(tmp_path / 'reward.bin', 'ab') as f:
+        f.write(np.zeros([4], np.float32).tobytes())
+    with open(tmp_path / 'names.txt', 'a') as f:
+        f.write('crashed\n')
+    with open(tmp_path / 'index.bin', 'ab') as f:
+        f.write(np.array([3], '<i8').tobytes())
+
+    store = EpisodeStore(str(tmp_path))
+    assert len(store) == 1
+    store.append(make_episode(2, 5.0), 'b')
+    assert store.names == ['a', 'b']
+    assert os.path.getsize(tmp_path / 'index.bin') == 2 * 2 * 8
+    np.testing.assert_array_equal(store.read(0)['reward'], make_episode(3, 1.0)['reward'])
+    np.testing.assert_array_equal(store.read(1)['image'], make_episode(2, 5.0)['image'])
+    np.testing.assert_array_equal(store.read(1)['reward'], make_episode(2, 5.0)['reward'])
+
+
+def test_append_rejects_mismatched_episodes(tmp_path: Path) -> None:
+    store = EpisodeStore(str(tmp_path))
+    store.append(make_episode(3), 'a')
+    with pytest.raises(ValueError):
+        store.append({'image': np.zeros([3, 2, 2], np.uint8)}, 'missing_key')
+    with pytest.raises(ValueError):
+        store.append({'image': np.zeros([3, 2, 2], np.uint8), 'reward': np.zeros([2], np.float32)}, 'lengths')
+    with pytest.raises(ValueError):
+        store.append({'image': np.zeros([3, 3, 2], np.uint8), 'reward': np.zeros([3], np.float32)}, 'shape')
+    assert EpisodeStore(str(tmp_path)).names == ['a']
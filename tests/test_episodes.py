@@ -0,0 +1,94 @@
+# test_episodes.py: Tests for episode indexing and scheduling
+#
+# (C) 2020, Daniel Mouritzen
+
+import itertools
+import random
+from collections import Counter
+from math import inf
+from types import SimpleNamespace
+from typing import Any, List, Mapping, Sequence
+
+import pytest
+
+from project.environments.episodes import CurriculumEpisodeIterator, EpisodeIndex, SceneAffinityEpisodeIterator
+
+
+def make_episodes(lengths_per_scene: Mapping[str, Sequence[float]]) -> List[Any]:
+    return [SimpleNamespace(scene_id=scene, episode_id=f'{scene}_{i}', info={'geodesic_distance': length})
+            for scene, lengths in lengths_per_scene.items()
+            for i, length in enumerate(lengths)]
+
+
+def test_empty_index() -> None:
+    index = EpisodeIndex([])
+    assert len(index) == 0
+    assert index.scenes == []
+    assert index.min_length == inf
+    assert index.count(10.0) == 0
+    assert index.sample(10.0) is None
+    assert index.sample(10.0, scene='a') is None
+
+
+def test_index_count_and_sample() -> None:
+    random.seed(0)
+    index = EpisodeIndex(make_episodes({'a': [3.0, 1.0, 2.0], 'b': [5.0, 0.5]}))
+    assert len(index) == 5
+    assert index.min_length == 0.5
+    assert index.count(2.0) == 3
+    assert index.count(2.0, scene='a') == 2
+    assert index.count(2.0, scene='unknown') == 0
+    for _ in range(100):
+        episode = index.sample(2.0, scene='a')
+        assert episode.scene_id == 'a' and episode.info['geodesic_distance'] <= 2.0
+    assert index.sample(0.1) is None
+
+
+def test_curriculum_replaces_long_episodes_from_same_scene() -> None:
+    random.seed(0)
+    episodes = make_episodes({'a': [1.0, 10.0], 'b': [10.0, 2.0]})
+    iterator = CurriculumEpisodeIterator(iter(episodes * 10), EpisodeIndex(episodes))
+    iterator.max_length = 5.0
+    for original in episodes * 10:
+        episode = next(iterator)
+        assert episode.scene_id == original.scene_id
+        assert episode.info['geodesic_distance'] <= 5.0
+
+
+def test_curriculum_falls_back_to_other_scenes() -> None:
+    episodes = make_episodes({'a': [10.0], 'b': [2.0]})
+    iterator = CurriculumEpisodeIterator(iter(episodes), EpisodeIndex(episodes))
+    iterator.max_length = 5.0
+    assert next(iterator).scene_id == 'b'
+    iterator.max_length = 1.0  # Nothing is short enough, so the original episode is kept
+    assert next(iterator).scene_id == 'b'
+
+
+def test_scene_affinity_in_order() -> None:
+    episodes = make_episodes({'a': [1.0, 2.0, 3.0], 'b': [4.0], 'c': [5.0, 6.0]})
+    iterator = SceneAffinityEpisodeIterator(episodes, episodes_per_scene=2, shuffle=False)
+    ids = [episode.episode_id for episode in itertools.islice(iterator, 8)]
+    assert ids == ['a_0', 'a_1', 'b_0', 'b_0', 'c_0', 'c_1', 'a_2', 'a_0']
+
+
+def test_scene_affinity_shuffled() -> None:
+    random.seed(0)
+    episodes = make_episodes({'a': [1.0] * 30, 'b': [1.0] * 10})
+    iterator = SceneAffinityEpisodeIterator(episodes, episodes_per_scene=5, shuffle=True)
+    sampled = list(itertools.islice(iterator, 4000))
+    # Scenes only change every episodes_per_scene episodes
+    for block in range(0, len(sampled), 5):
+        assert len({episode.scene_id for episode in sampled[block:block + 5]}) == 1
+    # Scenes are weighted by their number of episodes, so every episode is about equally likely
+    scene_counts = Counter(episode.scene_id for episode in sampled)
+    assert scene_counts['a'] / len(sampled) == pytest.approx(0.75, abs=0.05)
+    # The first 30 episodes from scene a are a permutation of all its episodes
+    first_a = [episode.episode_id for episode in sampled if episode.scene_id == 'a'][:30]
+    assert sorted(first_a) == sorted(f'a_{i}' for i in range(30))
+
+
+def test_scene_affinity_rejects_invalid_arguments() -> None:
+    with pytest.raises(AssertionError):
+        SceneAffinityEpisodeIterator(make_episodes({'a': [1.0]}), episodes_per_scene=0)
+    with pytest.raises(AssertionError):
+        SceneAffinityEpisodeIterator([], episodes_per_scene=1)
@@ -0,0 +1,70 @@
+# test_prioritized_sampler.py: Tests for SumTree and PrioritizedSampler
+#
+# (C) 2020, Daniel Mouritzen
+
+import numpy as np
+import pytest
+
+from project.util.planet.prioritized_sampler import PrioritizedSampler, SumTree
+
+
+def test_sum_tree_total_and_update() -> None:
+    tree = SumTree(capacity=4)
+    tree.append(np.array([1.0, 2.0, 3.0]))
+    assert len(tree) == 3
+    assert tree.total == pytest.approx(6.0)
+    tree.set(np.array([1]), np.array([0.5]))
+    assert tree.total == pytest.approx(4.5)
+    np.testing.assert_allclose(tree.priorities, [1.0, 0.5, 3.0])
+
+
+def test_sum_tree_grows() -> None:
+    tree = SumTree(capacity=2)
+    tree.append(np.array([1.0, 2.0]))
+    tree.append(np.array([3.0, 4.0, 5.0]))
+    assert len(tree) == 5
+    assert tree.total == pytest.approx(15.0)
+    np.testing.assert_allclose(tree.priorities, [1.0, 2.0, 3.0, 4.0, 5.0])
+
+
+def test_sum_tree_sample_is_stratified() -> None:
+    np.random.seed(0)
+    tree = SumTree()
+    tree.append(np.ones([100]))
+    indices = tree.sample(100)
+    assert np.all(np.diff(indices) >= 0)
+    # One sample per equally likely stratum, so each leaf is sampled exactly once
+    np.testing.assert_array_equal(indices, np.arange(100))
+
+
+def test_sum_tree_skips_zero_priorities() -> None:
+    np.random.seed(0)
+    tree = SumTree()
+    tree.append(np.array([0.0, 1.0, 0.0, 3.0, 0.0]))
+    indices = tree.sample(1000)
+    assert set(indices) == {1, 3}
+    assert np.mean(indices == 3) == pytest.approx(0.75, abs=0.01)
+
+
+def test_sampler_recency() -> None:
+    np.random.seed(0)
+    sampler = PrioritizedSampler(recency=2.0)
+    sampler.add(np.zeros([3]), np.zeros([3], bool))
+    indices = sampler.sample(7000)
+    np.testing.assert_allclose(np.bincount(indices) / 7000, [1 / 7, 2 / 7, 4 / 7], atol=0.01)
+
+
+def test_sampler_losses() -> None:
+    np.random.seed(0)
+    sampler = PrioritizedSampler(loss_exponent=1.0)
+    assert sampler.uses_losses
+    sampler.add(np.zeros([2]), np.zeros([2], bool))
+    sampler.report_losses(np.array([0, 1]), np.array([1.0, 3.0]))
+    indices = sampler.sample(4000)
+    assert np.mean(indices == 1) == pytest.approx(0.75, abs=0.01)
+
+
+def test_sampler_empty() -> None:
+    sampler = PrioritizedSampler()
+    assert not sampler.uses_losses
+    assert len(sampler.sample(10)) == 0